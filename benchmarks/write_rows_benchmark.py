@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""Benchmark of the ways ckanpackager can write datastore records as CSV rows
+
+Generates synthetic records (dictionaries as decoded from the datastore's JSON, some of them
+missing fields) and times writing them to a CSV file the way DatastorePackageTask used to (one
+dict lookup per field and a unicodecsv writerow per record) and with RowProjector (a single
+itemgetter per record, a page of rows at a time written by a plain csv writer).
+
+Usage: write_rows_benchmark.py [options]
+
+Options:
+    -h --help       Show this screen.
+    -r ROWS         Number of records [default: 500000]
+    -f FIELDS       Number of fields of each record [default: 30]
+    -m MISSING      Fraction of the records missing a field [default: 0.1]
+    -p PAGE         Number of records in each page [default: 1000]
+    -t DIR          Directory in which to create the files [default: /tmp]
+"""
+import csv
+import itertools
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import docopt
+import unicodecsv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ckanpackager.lib.row_projector import RowProjector
+
+
+def make_records(count, field_count, missing):
+    """Return the field names and `count` pseudo random records"""
+    rand = random.Random(42)
+    words = [u'Animalia', u'Chordata', u'Aves', u'Passeriformes', u'Fringillidae', u'London',
+             u'Tring', u'PreservedSpecimen', u'NHMUK', u'skin', u'skeleton', u'\xe9t\xe9', u'egg']
+    fields = [u'field_{}'.format(i) for i in range(field_count)]
+    records = []
+    for row_id in xrange(count):
+        record = {u'_id': row_id}
+        for i, field in enumerate(fields):
+            if i % 3 == 0:
+                record[field] = rand.randint(0, 10 ** 9)
+            elif i % 3 == 1:
+                record[field] = rand.uniform(-180, 180)
+            else:
+                record[field] = u' '.join(rand.sample(words, 2))
+        if rand.random() < missing:
+            del record[rand.choice(fields)]
+        records.append(record)
+    return [u'_id'] + fields, records
+
+
+def pages(records, page_size):
+    """Split the records into pages, as returned by CkanResource.get_pages"""
+    return [records[i:i + page_size] for i in xrange(0, len(records), page_size)]
+
+
+def write_loop(f, pages, fields):
+    """Write the records the way DatastorePackageTask used to"""
+    writer = unicodecsv.writer(f, encoding='utf-8', quotechar='"', lineterminator="\n")
+    for record in itertools.chain.from_iterable(pages):
+        row = []
+        for field_id in fields:
+            row.append(record.get(field_id, None))
+        writer.writerow(row)
+
+
+def write_projected(f, pages, fields):
+    """Write the records with RowProjector"""
+    writer = csv.writer(f, quotechar='"', lineterminator="\n")
+    projector = RowProjector(fields)
+    for records in pages:
+        writer.writerows(projector.rows(records))
+
+
+if __name__ == '__main__':
+    args = docopt.docopt(__doc__)
+    count = int(args['-r'])
+    work = tempfile.mkdtemp(dir=args['-t'])
+    try:
+        print "Generating {} records...".format(count)
+        fields, records = make_records(count, int(args['-f']), float(args['-m']))
+        records = pages(records, int(args['-p']))
+        print "{:<20} {:>10} {:>12} {:>10}".format('writer', 'seconds', 'rows/s', 'MB')
+        outputs = []
+        for name, write in [('loop + unicodecsv', write_loop), ('projector', write_projected)]:
+            path = os.path.join(work, '{}.csv'.format(write.__name__))
+            with open(path, 'wb') as f:
+                start = time.time()
+                write(f, records, fields)
+                duration = time.time() - start
+            outputs.append(path)
+            print "{:<20} {:>10.2f} {:>12.0f} {:>10.1f}".format(
+                name, duration, count / duration, os.path.getsize(path) / 1048576.0)
+        with open(outputs[0], 'rb') as a, open(outputs[1], 'rb') as b:
+            if a.read() != b.read():
+                print "The files written differ!"
+    finally:
+        shutil.rmtree(work)
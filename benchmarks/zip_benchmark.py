@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""Benchmark of the ways ckanpackager can build ZIP files
+
+Generates a synthetic CSV file (rows of datastore-like records) and times
+building the ZIP file of a resource containing it with ZIP_COMMAND and with
+the builtin archive writer using various numbers of workers.
+
+Usage: zip_benchmark.py [options]
+
+Options:
+    -h --help       Show this screen.
+    -s SIZE         Size of the CSV file, in MB [default: 1024]
+    -w WORKERS      Comma separated numbers of workers to try with the builtin
+                    writer [default: 1,2,4,8]
+    -z COMMAND      ZIP command to compare against
+                    [default: /usr/bin/zip -j {output} {input}]
+    -t DIR          Directory in which to create the files [default: /tmp]
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import docopt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ckanpackager.lib.resource_file import ResourceFile
+
+
+def write_csv(f, size):
+    """Write rows of pseudo random records to the given file until it is `size` bytes long"""
+    rand = random.Random(42)
+    words = ['Animalia', 'Chordata', 'Aves', 'Passeriformes', 'Fringillidae', 'London', 'Tring',
+             'PreservedSpecimen', 'NHMUK', 'skin', 'skeleton', 'egg', 'spirit', 'unknown']
+    written = 0
+    row_id = 0
+    while written < size:
+        rows = []
+        for _ in range(1000):
+            row_id += 1
+            rows.append('{},{},"{}",{:.6f},{:.6f},{}-{:02d}-{:02d},{}\n'.format(
+                row_id, rand.choice(words), ' '.join(rand.sample(words, 3)),
+                rand.uniform(-90, 90), rand.uniform(-180, 180), rand.randint(1800, 2020),
+                rand.randint(1, 12), rand.randint(1, 28), rand.randint(0, 10 ** 9)))
+        data = ''.join(rows)
+        f.write(data)
+        written += len(data)
+
+
+def build(csv_path, root, temp_dir, zip_command, **kwargs):
+    """Build the ZIP file of a resource holding the CSV file, returning the time taken and size"""
+    resource = ResourceFile({'resource_id': str(time.time())}, root, temp_dir, 0, **kwargs)
+    resource.get_writer('resource.csv')
+    # the CSV file is already written, the resource just needs to find it in its working folder
+    resource.writers['resource.csv'].close()
+    shutil.copy(csv_path, os.path.join(resource.working_folder, 'resource.csv'))
+    start = time.time()
+    resource.create_zip(zip_command)
+    duration = time.time() - start
+    size = os.path.getsize(resource.get_zip_file_name())
+    resource.clean_work_files()
+    os.remove(resource.get_zip_file_name())
+    return duration, size
+
+
+if __name__ == '__main__':
+    args = docopt.docopt(__doc__)
+    size = int(args['-s']) * 1024 * 1024
+    zip_command = args['-z']
+    work = tempfile.mkdtemp(dir=args['-t'])
+    try:
+        csv_path = os.path.join(work, 'data.csv')
+        root = os.path.join(work, 'store')
+        os.mkdir(root)
+        print "Generating {}MB of CSV...".format(args['-s'])
+        with open(csv_path, 'wb') as f:
+            write_csv(f, size)
+        print "{:<20} {:>10} {:>10} {:>12}".format('writer', 'seconds', 'MB/s', 'ZIP size MB')
+        runs = [('command', {'archive_writer': 'command'})]
+        for workers in args['-w'].split(','):
+            runs.append(('builtin, {} workers'.format(workers),
+                         {'archive_writer': 'builtin', 'zip_workers': int(workers)}))
+        for name, kwargs in runs:
+            duration, zip_size = build(csv_path, root, work, zip_command, **kwargs)
+            print "{:<20} {:>10.2f} {:>10.1f} {:>12.1f}".format(
+                name, duration, size / 1048576.0 / duration, zip_size / 1048576.0)
+    finally:
+        shutil.rmtree(work)
@@ -12,6 +12,26 @@ from ckanpackager.controllers.error_handlers import error_handlers
 
 import os
 import time
+import docopt
+
+from ckanpackager.lib.blob_store import BlobStore
+from ckanpackager.lib.build_lock import remove_stale_locks
+from ckanpackager.lib.cache_index import CacheIndex
+from ckanpackager.lib.cache_manager import CacheManager
+from ckanpackager.lib.pending_recipients import remove_stale_recipients
+from ckanpackager.lib.resource_file import remove_stale_resume_folders
+from ckanpackager.lib.shard_parts import remove_stale_shards
+
+USAGE = """Remove expired packages, rebuild the index of cached packages or report on them
+
+Usage: ckanpackager-caretaker [rebuild-index | report]
+
+The index of cached packages is kept up to date as packages are created and
+removed, and rebuilt automatically if it is missing. rebuild-index rebuilds it
+from the files in the store directory, should it get out of step with them.
+report prints the space taken up by the packages, and saved by storing
+identical packages only once.
+"""
 
 # Create the application
 app = Flask(__name__)
@@ -26,11 +46,16 @@ class Caretaker(object):
     Script to remove expired packages after a few days
     '''
 
-    expiry_date = time.time() - (7 * 86400)
-
     def __init__(self):
         global app
         self.dir = app.config['STORE_DIRECTORY']
+        self.index = CacheIndex(self.dir)
+        self.blob_store = BlobStore(self.dir)
+        self.expiry_date = time.time() - app.config.get('FILE_EXPIRY_TIME', 7 * 86400)
+        self.temp_dir = app.config['TEMP_DIRECTORY']
+        # checkpoints older than this aren't resumed from
+        self.resume_expiry_date = time.time() - app.config['CACHE_TIME']
+        self.cache_manager = CacheManager.from_config(app.config)
 
     def _get_symlinked_files(self):
         """
@@ -66,24 +91,69 @@ class Caretaker(object):
     def delete_expired_files(self):
         """
         Loop through all files, deleting if they are:
-          1. older than EXPIRY_TIME
+          1. older than FILE_EXPIRY_TIME (going by the time they were created
+             as recorded in the index, or their modification time for files
+             that aren't indexed - the modification time of a file linked to
+             a blob is the blob's)
           2. Not symlinked - i.e. GBIF Dump
+        along with the build lock files that haven't been used since, the
+        lists of recipients left behind by tasks that died, the
+        working folders of resumable packages that weren't resumed within
+        CACHE_TIME, the
+        parts of packages fetched in shards that were never merged and the
+        blobs no longer linked to, and then evict files if they still take
+        more than CACHE_MAX_BYTES
         @return:
         @rtype:
         """
         symlinked_files = self._get_symlinked_files()
+        created = dict((entry['file_name'], entry['created']) for entry in self.index.files())
         for f in self._list_files():
             # Delete all files with creation date greater than expires after
             # And not a symlink (the gbif export is symlinked and stays until reproduced)
-            if os.stat(f).st_mtime < self.expiry_date and f not in symlinked_files:
+            if created.get(f, os.stat(f).st_mtime) < self.expiry_date and \
+                    f not in symlinked_files:
                 os.remove(f)
+                self.index.remove(f)
+        remove_stale_locks(self.dir, self.expiry_date)
+        remove_stale_recipients(self.dir, self.expiry_date)
+        remove_stale_resume_folders(self.temp_dir, self.resume_expiry_date)
+        remove_stale_shards(self.dir, self.expiry_date)
+        self.blob_store.remove_orphans()
+        if self.cache_manager is not None:
+            self.cache_manager.evict()
+
+    def report(self):
+        """
+        Return a report of the space taken up by the packages
+        @return: The report
+        @rtype: str
+        """
+        total, stored = self.index.sizes()
+        return "{} files, {:.1f}MB ({:.1f}MB on disk, {:.1f}MB saved by deduplication)".format(
+            len(self.index.files()), total / 1048576.0, stored / 1048576.0,
+            (total - stored) / 1048576.0)
+
+    def rebuild_index(self):
+        """
+        Rebuild the index of cached packages from the files in the directory
+        @return: The number of files indexed
+        @rtype: int
+        """
+        return self.index.rebuild()
 
 
 def run():
     """
-    Initiate and call delete expired files
+    Initiate and call delete expired files, or rebuild the index or report
     """
-    Caretaker().delete_expired_files()
+    arguments = docopt.docopt(USAGE, help=True)
+    if arguments['rebuild-index']:
+        print "Indexed {} files".format(Caretaker().rebuild_index())
+    elif arguments['report']:
+        print Caretaker().report()
+    else:
+        Caretaker().delete_expired_files()
 
 
 if __name__ == '__main__':
@@ -5,12 +5,59 @@ SECRET = '8ba6d280d4ce9a416e9b604f3f0ebb'
 STATS_DB = 'sqlite:////var/lib/ckanpackager/stats.db'
 ANONYMIZE_EMAILS = False
 CELERY_BROKER = 'redis://localhost:6379/0'
+CELERY_RESULT_BACKEND = None
 PAGE_SIZE = 5000
+ADAPTIVE_PAGE_SIZE = False
+PAGE_SIZE_MIN = 500
+PAGE_SIZE_MAX = 32000
+PAGE_TARGET_DURATION = 10
+PAGE_MAX_BYTES = 50*1024*1024
+HTTP_POOL_SIZE = 10
+HTTP_KEEP_ALIVE = True
+PREFETCH_PAGES = 2
+PARALLEL_FETCH = {}
+PARALLEL_FETCH_BUFFER = None
+STREAM_RESPONSES = False
+HTTP_COMPRESSION = True
+FETCH_RETRIES = 3
+FETCH_RETRY_BACKOFF = 2
+RESUMABLE_TASKS = False
+DERIVE_FROM_CACHE = False
+SHARD_RECORDS = None
+SHARD_MAX = 8
+SHARD_COUNT_TIMEOUT = 60
+TASK_RETRIES = 3
+TASK_RETRY_DELAY = 60
+HOST_SLOTS = {}
+DEFAULT_HOST_SLOTS = None
+DOMAIN_SLOTS = {}
+DEFAULT_DOMAIN_SLOTS = None
+SLOT_RETRY_DELAY = 30
+PROGRESS_INTERVAL = 5
+PROGRESS_MAX_AGE = 60*60
 SLOW_REQUEST = 50000
+QUEUE_TIERS = [(1000000, 'fast'), (None, 'slow')]
+COUNT_TIMEOUT = 2
+COUNT_CACHE_TIME = 60*5
+PARQUET_COMPRESSION = 'snappy'
+PARQUET_ROW_GROUP_SIZE = 100000
+JSONL_COMPRESSION = None
+FANOUT_FORMATS = []
 STORE_DIRECTORY = "/tmp/ckanpackager"
 TEMP_DIRECTORY = "/tmp"
 CACHE_TIME = 60*60*24
+FILE_EXPIRY_TIME = 60*60*24*7
+CACHE_MAX_BYTES = None
+CACHE_EVICTION_POLICY = 'lru'
+CACHE_EVICTION_MIN_AGE = 60*60*24
+CACHE_BYTES_PER_VALUE = 4
+REVALIDATE_CACHE = False
+REVALIDATE_MAX_AGE = 60*60*24*7
+REVALIDATE_TIMEOUT = 10
 ZIP_COMMAND = "/usr/bin/zip {output} {input}"
+ARCHIVE_WRITER = 'command'
+ZIP_WORKERS = 1
+DEDUPLICATE_ARCHIVES = False
 SMTP_HOST = "localhost"
 SMTP_PORT = 25
 SUCCESS_MESSAGE = "The resource will be emailed to you shortly. This make take a little longer if our servers are busy, so please be patient!"
@@ -38,6 +85,24 @@ available at <a href="http://{ckan_host}/{zip_file_name}">here</a>.</p>
 </body>
 </html>
 """
+EMAIL_FAILURE_SUBJECT = "Resource from {ckan_host}"
+EMAIL_FAILURE_BODY = """Hello,
+
+Sorry, the resource you requested on {ckan_host} could not be prepared. Please try again later.
+
+Best Wishes,
+The Data Portal Bot
+"""
+EMAIL_FAILURE_BODY_HTML = """<html lang="en">
+<body>
+<p>Hello,</p>
+<p>Sorry, the resource you requested on <a href="{ckan_host}">{ckan_host}</a> could not be
+prepared. Please try again later.</p>
+<p>Best Wishes,</p>
+<p>The Data Portal Bot</p>
+</body>
+</html>
+"""
 DOI_BODY = """A DOI has been created for this data: https://doi.org/{doi} (this may take a few hours to become active).
 Please ensure you reference this DOI when citing this data.
 For more information, follow the DOI link.
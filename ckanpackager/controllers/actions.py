@@ -3,6 +3,8 @@ import glob
 from flask import request, Blueprint, current_app
 from flask.json import jsonify
 from ckanpackager import logic
+from ckanpackager.lib.blob_store import BlobStore
+from ckanpackager.lib.cache_index import CacheIndex
 
 actions = Blueprint('actions', __name__)
 
@@ -14,8 +16,11 @@ def clear_caches():
         current_app.config['STORE_DIRECTORY'],
         '*.zip'
     )
+    index = CacheIndex(current_app.config['STORE_DIRECTORY'])
     for file_name in glob.glob(matching_files):
         os.remove(file_name)
+        index.remove(file_name)
+    BlobStore(current_app.config['STORE_DIRECTORY']).remove_orphans()
     return jsonify(
         status='success',
         message='Done.'
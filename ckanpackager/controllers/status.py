@@ -2,8 +2,10 @@ from flask import request, Blueprint, current_app
 from flask.json import jsonify
 
 from ckanpackager import logic
+from ckanpackager.lib.progress import in_flight
 from ckanpackager.lib.statistics import statistics
 from ckanpackager.lib.utils import BadRequestError
+from ckanpackager.task_setup import queue_depths
 
 status = Blueprint('status', __name__)
 
@@ -12,8 +14,26 @@ status = Blueprint('status', __name__)
 @status.route('/status', methods=['POST'])
 def ckanpackager_status():
     logic.authorize_request(request.form)
+    config = current_app.config
+    tiers = config.get('QUEUE_TIERS', None) or []
+    queues = set(['fast', 'slow'] + [queue for _max_cost, queue in tiers])
+    try:
+        depths = queue_depths(sorted(queues))
+    except Exception as e:
+        current_app.logger.warning("Failed reading the queue lengths: {}".format(e))
+        depths = None
+    tasks = in_flight(config['STORE_DIRECTORY'], config.get('PROGRESS_MAX_AGE', 60 * 60))
+    stats = statistics(config['STATS_DB'], config.get(u'ANONYMIZE_EMAILS'))
     return jsonify(
-        worker_count=current_app.config['WORKERS']
+        worker_count=config.get('WORKERS', None),
+        queue_length=sum(depths.values()) if depths is not None else None,
+        queues=depths,
+        processed_requests=stats.get_totals(resource_id='*').get('*', {}).get('requests', 0),
+        in_flight=tasks,
+        throughput={
+            'records_per_second': sum(task['rate'] for task in tasks),
+            'bytes_per_second': sum(task['byte_rate'] for task in tasks),
+        }
     )
 
 
@@ -0,0 +1,114 @@
+"""Storing identical ZIP files only once"""
+import os
+import hashlib
+
+from ckanpackager.lib.cache_index import BLOB_FOLDER
+
+
+def file_digest(path):
+    """
+    Return the SHA-1 digest of a file's content.
+
+    :param path: the path of the file
+    :return: the hex digest
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(64 * 1024)
+            if not data:
+                break
+            sha1.update(data)
+    return sha1.hexdigest()
+
+
+def content_digest(entry_digests):
+    """
+    Return the digest identifying the content of a ZIP file, given the digests of its entries. This
+    only depends on the names and data of the entries, so that archives holding the same files are
+    seen as identical even if they differ in timestamps, entry order or compression.
+
+    :param entry_digests: dictionary of entry name to the hex digest of its data
+    :return: the hex digest
+    """
+    sha1 = hashlib.sha1()
+    for name in sorted(entry_digests):
+        sha1.update('{}\0{}\n'.format(name, entry_digests[name]))
+    return sha1.hexdigest()
+
+
+class BlobStore(object):
+    """
+    Stores ZIP files by content digest. A single copy of each content, the blob, is kept in a hidden
+    folder of the store directory; the files served to users are hard links to it. Removing a
+    served file therefore doesn't affect the others sharing its content, and blobs only linked from
+    the store itself are removed by remove_orphans.
+    """
+
+    def __init__(self, root):
+        """
+        :param root: the store directory
+        """
+        self.root = root
+        self.folder = os.path.join(root, BLOB_FOLDER)
+
+    def path(self, digest):
+        """
+        :param digest: the content digest
+        :return: the path of the blob for the given digest
+        """
+        return os.path.join(self.folder, '{}.zip'.format(digest))
+
+    def store(self, temp_file_name, digest, file_name):
+        """
+        Move a newly built ZIP file to its final name, reusing the stored blob with the same content
+        if there is one.
+
+        :param temp_file_name: the path of the newly built file
+        :param digest: the content digest of the file
+        :param file_name: the file's final name, in the store directory
+        :return: True if an identical file was already stored (and the new one was discarded)
+        """
+        blob = self.path(digest)
+        try:
+            os.link(blob, file_name)
+        except OSError:
+            # no identical file (or no support for hard links)
+            pass
+        else:
+            os.remove(temp_file_name)
+            return True
+        os.rename(temp_file_name, file_name)
+        if not os.path.isdir(self.folder):
+            try:
+                os.makedirs(self.folder)
+            except OSError:
+                # someone else just created it
+                pass
+        try:
+            os.link(file_name, blob)
+        except OSError:
+            # an identical file has just been stored by another task, or hard links aren't
+            # supported: the file is kept on its own
+            pass
+        return False
+
+    def remove_orphans(self):
+        """
+        Remove the blobs which are no longer linked from any served file.
+
+        :return: the number of blobs removed
+        """
+        if not os.path.isdir(self.folder):
+            return 0
+        count = 0
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            try:
+                if os.stat(path).st_nlink == 1:
+                    os.remove(path)
+                    count += 1
+            except OSError:
+                # removed by someone else
+                pass
+        return count
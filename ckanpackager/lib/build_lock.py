@@ -0,0 +1,125 @@
+"""Locks ensuring only one task at a time builds the package for a given request"""
+import os
+import time
+import fcntl
+
+from ckanpackager.lib.cache_index import INDEX_FOLDER
+
+# the folder, in the store directory, holding the lock files
+LOCK_FOLDER = os.path.join(INDEX_FOLDER, 'locks')
+
+
+class BuildLock(object):
+    """
+    Exclusive lock on building the package for a request, shared by all the workers using the same
+    store directory. Tasks for identical requests arriving together take turns: the first one builds
+    the package while the others wait, and then find it in the cache.
+
+    This uses flock on a file in the store directory, so workers on several machines are only
+    coordinated if the store directory is on a file system supporting it across machines.
+    """
+
+    # how often, in seconds, a waiting task checks whether the lock has been released
+    POLL_INTERVAL = 1
+
+    def __init__(self, root, key):
+        """
+        :param root: the store directory
+        :param key: the key of the request, ie. the base name of its ZIP file
+        """
+        self.folder = os.path.join(root, LOCK_FOLDER)
+        self.path = os.path.join(self.folder, '{}.lock'.format(key))
+        self._file = None
+
+    @property
+    def locked(self):
+        """True if this lock is held"""
+        return self._file is not None
+
+    def acquire(self, timeout=0):
+        """
+        Acquire the lock.
+
+        :param timeout: how long to wait for the lock, in seconds, if another task holds it. If 0,
+                        return straight away; if None, wait as long as it takes.
+        :return: True if the lock was acquired, False if it wasn't within the timeout
+        """
+        if self._file is not None:
+            return True
+        if not os.path.isdir(self.folder):
+            try:
+                os.makedirs(self.folder)
+            except OSError:
+                # someone else just created it
+                pass
+        start = time.time()
+        while True:
+            if self._try_acquire():
+                return True
+            if timeout is not None and time.time() - start >= timeout:
+                return False
+            time.sleep(self.POLL_INTERVAL)
+
+    def _try_acquire(self):
+        """
+        Try to acquire the lock without waiting.
+
+        :return: True if the lock was acquired
+        """
+        lock_file = open(self.path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+            return False
+        # the caretaker may have removed the lock file between us opening and locking it, in which
+        # case the lock is worthless: anyone else would be locking a new file. Try again with that.
+        try:
+            same_file = os.fstat(lock_file.fileno()).st_ino == os.stat(self.path).st_ino
+        except OSError:
+            same_file = False
+        if not same_file:
+            lock_file.close()
+            return self._try_acquire()
+        self._file = lock_file
+        # record when the lock was last used, see remove_stale_locks
+        os.utime(self.path, None)
+        return True
+
+    def release(self):
+        """Release the lock, if it is held"""
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+def remove_stale_locks(root, older_than):
+    """
+    Remove the lock files that haven't been used for a while and aren't held.
+
+    :param root: the store directory
+    :param older_than: timestamp before which lock files were last used to be removed
+    :return: the number of lock files removed
+    """
+    folder = os.path.join(root, LOCK_FOLDER)
+    if not os.path.isdir(folder):
+        return 0
+    count = 0
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        try:
+            if os.path.getmtime(path) >= older_than:
+                continue
+        except OSError:
+            continue
+        with open(path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                continue
+            # removing the file while holding the lock means whoever opened it meanwhile will see
+            # it is gone once they get the lock
+            os.remove(path)
+            count += 1
+    return count
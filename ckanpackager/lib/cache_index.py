@@ -0,0 +1,257 @@
+"""Index of the ZIP files cached in the store directory"""
+import os
+import json
+import re
+import sqlite3
+import time
+from contextlib import closing
+
+# the hidden folder in the store directory where ckanpackager keeps its own files. It is skipped
+# when looking for ZIP files
+INDEX_FOLDER = '.ckanpackager'
+# the folder where ZIP files are stored by content digest, see BlobStore
+BLOB_FOLDER = os.path.join(INDEX_FOLDER, 'blobs')
+
+# ZIP files are named {base name}-{pid}-{time}.zip, where the base name is an md5 hex digest
+_FILE_NAME = re.compile(r'^([0-9a-f]{32})-')
+
+# the columns of the files table: the file's name, the base name of its request, its creation time,
+# size and last access time, how long it took to build, the digest of its blob (if it has one) and
+# the version of the upstream data it was built from (if known)
+_FILES_COLUMNS = ['name', 'base', 'created', 'size', 'last_access', 'build_time', 'blob',
+                  'version']
+
+
+class CacheIndex(object):
+    """
+    Keeps track of the ZIP files in the store directory in an SQLite database, keyed on the base
+    name of the request they were built for. This avoids scanning the whole directory to find a
+    cached file.
+
+    The database is created, and filled from the files in the store directory, the first time it is
+    needed. If it is lost, it is rebuilt the same way. Files listed in the index but no longer on
+    disk are dropped when looked up, so the index only ever misses files that were added without
+    going through it (rebuild picks those up).
+
+    Files can also be recorded with a manifest describing their content, so that packages for other
+    requests can be derived from them (see DatastorePackageTask).
+    """
+
+    def __init__(self, root):
+        """
+        :param root: the store directory
+        """
+        self.root = root
+        self.folder = os.path.join(root, INDEX_FOLDER)
+        self.path = os.path.join(self.folder, 'index.db')
+        # whether the tables have been checked to exist and be up to date, as indexes created by
+        # older versions may not be
+        self._checked = False
+
+    def _connect(self):
+        """
+        Open a connection to the index database, creating it if needed.
+
+        :return: an sqlite3 connection
+        """
+        exists = os.path.exists(self.path)
+        if not exists and not os.path.isdir(self.folder):
+            try:
+                os.makedirs(self.folder)
+            except OSError:
+                # someone else just created it
+                pass
+        # other processes may be writing to the index, so wait for them rather than failing
+        connection = sqlite3.connect(self.path, timeout=60)
+        if not exists or not self._checked:
+            with connection:
+                columns = [row[1] for row in connection.execute('PRAGMA table_info(files)')]
+                # the files table is filled when created. Older versions' lack some columns, so
+                # they are replaced
+                rebuild = columns != _FILES_COLUMNS
+                if columns and rebuild:
+                    connection.execute('DROP TABLE files')
+                connection.execute('CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, '
+                                   'base TEXT NOT NULL, created REAL NOT NULL, '
+                                   'size INTEGER NOT NULL, last_access REAL NOT NULL, '
+                                   'build_time REAL NOT NULL, blob TEXT, version TEXT)')
+                connection.execute('CREATE INDEX IF NOT EXISTS files_base ON files (base, created)')
+                connection.execute('CREATE TABLE IF NOT EXISTS manifests (name TEXT PRIMARY KEY, '
+                                   'resource_id TEXT NOT NULL, manifest TEXT NOT NULL)')
+                connection.execute('CREATE INDEX IF NOT EXISTS manifests_resource_id '
+                                   'ON manifests (resource_id)')
+                if rebuild:
+                    self._fill(connection)
+            self._checked = True
+        return connection
+
+    def _fill(self, connection):
+        """
+        Replace the content of the index with the ZIP files in the store directory. The time it
+        took to build the files isn't known, so it is set to 0, nor is the upstream version.
+
+        :param connection: the connection to the index database
+        :return: the number of files indexed
+        """
+        connection.execute('DELETE FROM files')
+        # files sharing their blob are hard links to it
+        blobs = {}
+        blob_folder = os.path.join(self.root, BLOB_FOLDER)
+        if os.path.isdir(blob_folder):
+            for name in os.listdir(blob_folder):
+                blobs[os.stat(os.path.join(blob_folder, name)).st_ino] = os.path.splitext(name)[0]
+        count = 0
+        for name in os.listdir(self.root):
+            match = _FILE_NAME.match(name)
+            path = os.path.join(self.root, name)
+            if match and os.path.isfile(path):
+                stat = os.stat(path)
+                connection.execute('INSERT OR REPLACE INTO files VALUES '
+                                   '(?, ?, ?, ?, ?, 0, ?, NULL)',
+                                   (name, match.group(1), stat.st_mtime, stat.st_size,
+                                    stat.st_mtime, blobs.get(stat.st_ino)))
+                count += 1
+        # manifests can't be rebuilt, but those of the files still there can be kept
+        connection.execute('DELETE FROM manifests WHERE name NOT IN (SELECT name FROM files)')
+        return count
+
+    def rebuild(self):
+        """
+        Rebuild the index from the files in the store directory.
+
+        :return: the number of files indexed
+        """
+        with closing(self._connect()) as connection, connection:
+            return self._fill(connection)
+
+    def add(self, base, file_name, manifest=None, build_time=0, blob=None, version=None,
+            created=None):
+        """
+        Add a ZIP file to the index. Its creation time is recorded rather than taken from the file,
+        as a file linked to a blob (see BlobStore) has the modification time of the blob.
+
+        :param base: the base name of the request the file was built for
+        :param file_name: the full path of the file, which must be in the store directory
+        :param manifest: optionally, a dictionary describing the content of the file (which must
+                         include its 'resource_id'), see manifests
+        :param build_time: the time it took to build the file, in seconds
+        :param blob: the digest of the blob the file is linked to, if it is (see BlobStore)
+        :param version: the version of the upstream data the file was built from, if known
+        :param created: when the file was created, as a timestamp (default: now)
+        """
+        name = os.path.basename(file_name)
+        size = os.path.getsize(file_name)
+        if created is None:
+            created = time.time()
+        with closing(self._connect()) as connection, connection:
+            connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               (name, base, created, size, created, build_time, blob, version))
+            if manifest is not None:
+                connection.execute('INSERT OR REPLACE INTO manifests VALUES (?, ?, ?)',
+                                   (name, manifest['resource_id'], json.dumps(manifest)))
+
+    def touch(self, file_name):
+        """
+        Record that a ZIP file has just been used.
+
+        :param file_name: the full path of the file
+        """
+        with closing(self._connect()) as connection, connection:
+            connection.execute('UPDATE files SET last_access = ? WHERE name = ?',
+                               (time.time(), os.path.basename(file_name)))
+
+    def files(self):
+        """
+        List the ZIP files in the index.
+
+        :return: a list of dictionaries with the full path ('file_name'), 'size', 'created',
+                 'last_access', 'build_time' and 'blob' of each file
+        """
+        with closing(self._connect()) as connection, connection:
+            rows = connection.execute('SELECT name, size, created, last_access, build_time, blob '
+                                      'FROM files').fetchall()
+        return [{'file_name': os.path.join(self.root, name), 'size': size, 'created': created,
+                 'last_access': last_access, 'build_time': build_time, 'blob': blob}
+                for name, size, created, last_access, build_time, blob in rows]
+
+    def sizes(self):
+        """
+        Return the total size of the ZIP files in the index, and the space they actually take up
+        on disk (files sharing a blob only take up its size once).
+
+        :return: a 2-tuple of the sizes, in bytes
+        """
+        with closing(self._connect()) as connection, connection:
+            return connection.execute('SELECT COALESCE(SUM(size), 0), COALESCE(SUM(CASE WHEN '
+                                      'blob IS NULL THEN size END), 0) + COALESCE((SELECT '
+                                      'SUM(size) FROM (SELECT MAX(size) AS size FROM files WHERE '
+                                      'blob IS NOT NULL GROUP BY blob)), 0) '
+                                      'FROM files').fetchone()
+
+    def total_size(self):
+        """
+        :return: the space taken up by the ZIP files in the index, in bytes
+        """
+        return self.sizes()[1]
+
+    def remove(self, file_name):
+        """
+        Remove a ZIP file from the index.
+
+        :param file_name: the full path of the file
+        """
+        name = os.path.basename(file_name)
+        with closing(self._connect()) as connection, connection:
+            connection.execute('DELETE FROM files WHERE name = ?', (name,))
+            connection.execute('DELETE FROM manifests WHERE name = ?', (name,))
+
+    def manifests(self, resource_id, max_age, version=None):
+        """
+        Find the ZIP files with a manifest for the given resource.
+
+        :param resource_id: the resource id
+        :param max_age: the maximum age of the files, in seconds
+        :param version: if given, only files built from this version of the upstream data are
+                        considered
+        :return: a list of (full path of the file, manifest) tuples, most recent first
+        """
+        query = ('SELECT files.name, manifest FROM manifests JOIN files ON files.name = '
+                 'manifests.name WHERE resource_id = ? AND created > ?')
+        params = [resource_id, time.time() - max_age]
+        if version is not None:
+            query += ' AND version = ?'
+            params.append(version)
+        with closing(self._connect()) as connection, connection:
+            rows = connection.execute(query + ' ORDER BY created DESC', params).fetchall()
+        found = []
+        for name, manifest in rows:
+            file_name = os.path.join(self.root, name)
+            if os.path.exists(file_name):
+                found.append((file_name, json.loads(manifest)))
+        return found
+
+    def lookup(self, base, max_age, version=None):
+        """
+        Find the most recent ZIP file built for the given base name.
+
+        :param base: the base name of the request
+        :param max_age: the maximum age of the file, in seconds
+        :param version: if given, only files built from this version of the upstream data are
+                        considered
+        :return: the full path of the file, or None if there isn't one recent enough
+        """
+        query = 'SELECT name FROM files WHERE base = ? AND created > ?'
+        params = [base, time.time() - max_age]
+        if version is not None:
+            query += ' AND version = ?'
+            params.append(version)
+        with closing(self._connect()) as connection, connection:
+            rows = connection.execute(query + ' ORDER BY created DESC', params)
+            for (name,) in rows.fetchall():
+                file_name = os.path.join(self.root, name)
+                if os.path.exists(file_name):
+                    return file_name
+                # the file has been removed behind our back
+                connection.execute('DELETE FROM files WHERE name = ?', (name,))
+                connection.execute('DELETE FROM manifests WHERE name = ?', (name,))
+        return None
@@ -0,0 +1,122 @@
+"""Keeping the ZIP files cached in the store directory within a size budget"""
+import os
+import time
+import logging
+import collections
+
+from ckanpackager.lib.blob_store import BlobStore
+from ckanpackager.lib.cache_index import CacheIndex
+
+
+def _lru_score(entry):
+    """Least recently used files are evicted first"""
+    return entry['last_access']
+
+
+def _cost_score(entry):
+    """
+    Files saving the least build time per byte are evicted first, least recently used first when
+    that is the same (eg. for files whose build time isn't known)
+    """
+    return entry['build_time'] / max(entry['size'], 1), entry['last_access']
+
+
+POLICIES = {
+    'lru': _lru_score,
+    'cost': _cost_score,
+}
+
+
+class CacheManager(object):
+    """
+    Evicts ZIP files from the store directory when their total size goes over a budget. The files
+    to evict are chosen by one of the POLICIES, using the sizes, build times and last access times
+    recorded in the cache index.
+
+    Files that have been used recently, and which users may therefore be about to download, are
+    never evicted, nor are symlinked files (such as the GBIF dump) - so the budget may be exceeded.
+    """
+
+    def __init__(self, root, max_bytes, policy='lru', min_age=0, logger=None):
+        """
+        :param root: the store directory
+        :param max_bytes: the maximum total size of the ZIP files, in bytes
+        :param policy: the name of the eviction policy, 'lru' or 'cost'
+        :param min_age: the time, in seconds, for which files aren't evicted after being used
+        :param logger: the logger to report evictions to
+        """
+        if policy not in POLICIES:
+            raise ValueError('Unknown cache eviction policy: {}'.format(policy))
+        self.root = root
+        self.max_bytes = max_bytes
+        self.score = POLICIES[policy]
+        self.min_age = min_age
+        self.index = CacheIndex(root)
+        self.blob_store = BlobStore(root)
+        self.log = logger or logging.getLogger(__name__)
+
+    @classmethod
+    def from_config(cls, config, logger=None):
+        """
+        Create a cache manager from the given configuration.
+
+        :param config: the configuration dictionary
+        :param logger: the logger to report evictions to
+        :return: a CacheManager, or None if no budget is configured
+        """
+        if not config.get('CACHE_MAX_BYTES', None):
+            return None
+        return cls(config['STORE_DIRECTORY'], config['CACHE_MAX_BYTES'],
+                   config.get('CACHE_EVICTION_POLICY', 'lru'),
+                   config.get('CACHE_EVICTION_MIN_AGE', 0), logger)
+
+    def _symlinked_files(self):
+        """Return the set of symlinks in the store directory and the files they point to"""
+        symlinked = set()
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if os.path.islink(path):
+                symlinked.add(path)
+                symlinked.add(os.path.join(self.root, os.readlink(path)))
+        return symlinked
+
+    def evict(self, required=0):
+        """
+        Evict files until the total size of the cached files, plus the given number of bytes about
+        to be added, fits in the budget.
+
+        :param required: the number of bytes needed for files about to be added
+        :return: a 2-tuple of the number of files evicted and the bytes freed
+        """
+        total = self.index.total_size()
+        if total + required <= self.max_bytes:
+            return 0, 0
+        symlinked = self._symlinked_files()
+        recent = time.time() - self.min_age
+        entries = self.index.files()
+        # files sharing a blob only free space once they have all been evicted
+        links = collections.Counter(entry['blob'] for entry in entries if entry['blob'])
+        count = 0
+        freed = 0
+        for entry in sorted(entries, key=self.score):
+            if total - freed + required <= self.max_bytes:
+                break
+            if entry['last_access'] > recent or entry['file_name'] in symlinked:
+                continue
+            try:
+                os.remove(entry['file_name'])
+            except OSError:
+                # it has already gone
+                pass
+            self.index.remove(entry['file_name'])
+            count += 1
+            if entry['blob']:
+                links[entry['blob']] -= 1
+                if links[entry['blob']]:
+                    continue
+            freed += entry['size']
+        self.blob_store.remove_orphans()
+        self.log.info("Evicted {} cached files ({:.1f}MB) to stay within the cache size budget, "
+                      "{:.1f}MB used".format(count, freed / 1048576.0,
+                                             (total - freed) / 1048576.0))
+        return count, freed
@@ -1,6 +1,19 @@
 import copy
+import httplib
+import json
+import logging
+import socket
+import time
+import zlib
 
+import ijson
 import requests
+from requests.packages.urllib3.exceptions import HTTPError as UrllibHTTPError
+
+from ckanpackager.lib.content_encoding import DecodingReader, accept_encoding
+from ckanpackager.lib.json_stream import stream_records
+from ckanpackager.lib.prefetch import prefetch, fetch_in_order
+from ckanpackager.lib.sessions import get_session, connection_count
 
 
 class StreamError(Exception):
@@ -8,29 +21,83 @@ class StreamError(Exception):
     pass
 
 
+class TransientStreamError(StreamError):
+    """
+    Exception raised when a request to CKAN fails in a way that may not happen again if the request
+    is retried (a dropped connection or a server error, for example)
+    """
+    pass
+
+
 class CkanResource(object):
     """
     Represents and queries a resource on a CKAN server.
     """
 
-    def __init__(self, api_url, key, page_size, params):
+    # the number of records handed over at a time when streaming responses
+    STREAM_BATCH_SIZE = 1000
+
+    def __init__(self, api_url, key, page_size, params, pool_size=10, keep_alive=True,
+                 prefetch_pages=0, parallel=0, parallel_buffer=None, stream=False, page_sizer=None,
+                 retries=0, retry_backoff=1, compress=True, progress=None, logger=None):
         """
         :param api_url: URL for the CKAN API call
         :param key: the CKAN authentication key (may be None)
         :param page_size: the maximum number of records to retrieve with each call
         :param params: request parameters to send to CKAN
+        :param pool_size: the maximum number of connections kept open to the CKAN host
+        :param keep_alive: whether connections to the CKAN host are reused between requests
+        :param prefetch_pages: the number of pages to fetch ahead in the background while records
+                               are being consumed (default: 0, pages are fetched when needed)
+        :param parallel: the number of pages to fetch concurrently when the default offset/limit
+                         paging is used (default: 0, pages are fetched one at a time)
+        :param parallel_buffer: the maximum number of pages held in memory while fetching pages
+                                concurrently (default: twice the number of concurrent fetches)
+        :param stream: if True, records are parsed incrementally as responses are received rather
+                       than once each response has been read in full (default: False)
+        :param page_sizer: a PageSizer used to adjust the page size after each page, based on how
+                           long the page took to retrieve and how big it was. This isn't used when
+                           pages are fetched concurrently. (default: None, the page size is fixed)
+        :param retries: the number of times a request failing with a transient error (a dropped
+                        connection, a timeout or a 5xx/429 response) is retried (default: 0)
+        :param retry_backoff: the number of seconds to wait before the first retry, doubled for
+                              each following retry of the same request (default: 1)
+        :param compress: whether to ask for compressed responses (gzip, deflate and, if the brotli
+                         module is installed, brotli) (default: True)
+        :param progress: the TaskProgress to record the records fetched in (default: None)
+        :param logger: the logger to report page timings to (default: this module's logger)
         """
         self.api_url = api_url
         self.page_size = page_size
+        self.session = get_session(api_url, pool_size, keep_alive)
+        self.prefetch_pages = prefetch_pages
+        self.parallel = parallel
+        self.parallel_buffer = parallel_buffer or 2 * parallel
+        self.stream = stream
+        self.page_sizer = page_sizer
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        # the number of requests that have been retried
+        self.retry_count = 0
+        self.progress = progress
+        self.log = logger if logger is not None else logging.getLogger(__name__)
+        # the number of records matching the request, if get_fields_and_backend has been called
+        # and the response gave it
+        self.total = None
+        # timings of each page requested, see _post
+        self.page_stats = []
         # remove any parameters with no value
         self.params = {k: v for k, v in params.items() if v is not None}
-        self.headers = {}
+        self.headers = {
+            'Accept-Encoding': accept_encoding() if compress else 'identity',
+        }
         if key:
             self.headers['Authorization'] = key
 
         # store other backends that we can handle the pagnination for beyond the default datastore.
         # Each has a 2-tuple containing a function to be called before making any requests to CKAN
-        # and then an after function to be called after each page is retrieved from CKAN.
+        # and then an after function to be called after each page is retrieved from CKAN, with the
+        # number of records the page held.
         self.backends = {
             'solr': (self._solr_before, self._solr_after),
             'versioned-datastore': (self._versioned_datastore_before,
@@ -48,56 +115,506 @@ class CkanResource(object):
         request_params = copy.deepcopy(self.params)
         request_params['offset'] = 0
         request_params['limit'] = 0
-        response = requests.post(self.api_url, json=request_params, headers=self.headers)
-        response.raise_for_status()
-        result = response.json()['result']
+        result = self._fetch_page(request_params)
+        self.total = result.get('total', None)
         return result['fields'], result.get('_backend', None)
 
-    def get_records(self, backend=None):
+    def get_total(self, timeout=5):
         """
-        Retrieves the all records as requested from the CKAN API URL using the appropriate paging
-        mechanism dependant on the given backend.
+        Retrieves the number of records matching the request parameters (ignoring the offset and
+        limit), and the number of fields they have, through a single request for no records.
+        Unlike the requests made to retrieve the records, this one isn't retried and gives up
+        after the given timeout, as it is made while the user waits.
 
-        If an error occurs retrieving the data from the CKAN server, a StreamError will be raised.
+        :param timeout: the number of seconds to wait for the response
+        :return: a 2-tuple of the number of records and the number of fields, or None if the
+                 response doesn't give the number of records
+        """
+        request_params = copy.deepcopy(self.params)
+        request_params['offset'] = 0
+        request_params['limit'] = 0
+        try:
+            response = self.session.post(self.api_url, json=request_params, headers=self.headers,
+                                         timeout=timeout)
+        except requests.exceptions.RequestException as e:
+            raise TransientStreamError("Failed fetching URL {}: {}".format(self.api_url, e))
+        self._check_status(response)
+        try:
+            content = response.json()
+        except ValueError as e:
+            raise StreamError("Failed parsing response from {}: {}".format(self.api_url, e))
+        if not content.get('success', False):
+            raise StreamError("Failed fetching URL {}: {}".format(self.api_url,
+                                                                  content.get('error')))
+        result = content['result']
+        if result.get('total', None) is None:
+            return None
+        return int(result['total']), len(result.get('fields', []))
+
+    def get_version(self, timeout=10):
+        """
+        Retrieves a token identifying the current version of the resource's data, from the
+        resource's last_modified and metadata_modified dates given by the resource_show action
+        (found next to the datastore action of the API URL). This relies on the last_modified date
+        being updated when the data is, as it is when the datastore is loaded by xloader or
+        datapusher.
+
+        :param timeout: the number of seconds to wait for the response
+        :return: the version token, or None if the resource has no such dates
+        """
+        url = '{}/resource_show'.format(self.api_url.rsplit('/', 1)[0])
+        try:
+            response = self.session.post(url, json={'id': self.params['resource_id']},
+                                         headers=self.headers, timeout=timeout)
+        except requests.exceptions.RequestException as e:
+            raise TransientStreamError("Failed fetching URL {}: {}".format(url, e))
+        self._check_status(response)
+        try:
+            content = response.json()
+        except ValueError as e:
+            raise StreamError("Failed parsing response from {}: {}".format(url, e))
+        if not content.get('success', False):
+            raise StreamError("Failed fetching URL {}: {}".format(url, content.get('error')))
+        dates = [content['result'].get(k, None) for k in ('last_modified', 'metadata_modified')]
+        if not any(dates):
+            return None
+        return '|'.join(date or '' for date in dates)
+
+    def get_records(self, backend=None, checkpoint=None, resume=None):
+        """
+        Retrieves the all records as requested from the CKAN API URL, one at a time. See get_pages
+        for the parameters.
 
-        :param backend: the name of the backend to use (default: None)
         :return: a generator of records
         """
+        for records in self.get_pages(backend, checkpoint, resume):
+            for record in records:
+                yield record
+
+    def get_pages(self, backend=None, checkpoint=None, resume=None):
+        """
+        Retrieves the all records as requested from the CKAN API URL, page by page, using the
+        appropriate paging mechanism dependant on the given backend.
+
+        If prefetching is enabled, the pages are fetched in a background thread so that the next
+        page is retrieved from CKAN while the records of the current one are being consumed. If
+        parallel fetching is enabled and the default offset/limit paging is used, pages are fetched
+        concurrently instead (and still returned in order).
+
+        Requests failing with a transient error are retried (see the retries parameter of the
+        constructor), carrying on from the last record received. If an error occurs retrieving the
+        data from the CKAN server and the request can't be retried, a StreamError will be raised.
+
+        The paging state can be checkpointed so that a later call can carry on where this one
+        stopped: after each batch of records has been consumed, the checkpoint function is called
+        with a JSON serialisable dict describing where the next record will come from. Passing
+        this dict as the resume parameter of a later call (with the same parameters and backend)
+        returns the records that follow.
+
+        :param backend: the name of the backend to use (default: None)
+        :param checkpoint: a function called with the paging state after each batch of records has
+                           been consumed (default: None)
+        :param resume: a paging state passed to the checkpoint function by a previous call, to
+                       carry on from (default: None, start from the first record)
+        :return: a generator of lists of records, one for each page
+        """
+        request_params, requested_count, backend = self._initial_params(backend)
+        count = 0
+        skip = 0
+        if resume is not None:
+            count = resume['count']
+            if requested_count and count >= requested_count:
+                return
+            if backend is None:
+                # with offset/limit paging we can go straight to the next record
+                request_params['offset'] = resume['params']['offset'] + resume['skip']
+                if requested_count:
+                    request_params['limit'] = min(request_params['limit'],
+                                                  requested_count - count)
+            else:
+                # otherwise the page the last record came from is requested again, skipping the
+                # records we already have
+                request_params = copy.deepcopy(resume['params'])
+                skip = resume['skip']
+        else:
+            before, _after = self._paging_functions(backend)
+            before(request_params)
+
+        if self.parallel > 1 and backend is None:
+            pages = self._get_pages_in_parallel(request_params, requested_count, count)
+        else:
+            pages = prefetch(self._get_pages(request_params, requested_count, backend, count, skip),
+                             self.prefetch_pages)
+        for records, state in pages:
+            yield records
+            if checkpoint is not None:
+                checkpoint(state)
+
+    def _paging_functions(self, backend):
+        """
+        Return the functions implementing the paging mechanism of the given backend.
+
+        :param backend: the name of the backend, or None for the default offset/limit paging
+        :return: a 2-tuple of the before and after functions
+        """
+        return self.backends.get(backend, (self._default_before, self._default_after))
+
+    def _initial_params(self, backend):
+        """
+        Work out the parameters of the first request to make to retrieve the records.
+
+        :param backend: the name of the backend the resource is stored in
+        :return: a 3-tuple of the request parameters, the number of records requested (0 if all the
+                 records are requested) and the backend whose paging mechanism should be used (None
+                 for the default offset/limit paging)
+        """
         request_params = copy.deepcopy(self.params)
         request_params['offset'] = int(request_params.get('offset', 0))
         requested_count = int(request_params.get('limit', 0))
+        page_size = self.page_size
+        if self.page_sizer is not None and self.parallel <= 1:
+            page_size = self.page_sizer.size
         # if no limit is specified we request all the records and use the default page size
         if requested_count == 0:
-            request_params['limit'] = self.page_size
+            request_params['limit'] = page_size
         else:
             # set the limit to the smaller value so that we don't request a large number of records
             # when all we actually need is one (for example)
-            request_params['limit'] = min(self.page_size, requested_count)
+            request_params['limit'] = min(page_size, requested_count)
 
         # if there is an offset already in the request params then we can't fulfill this request
         # using the solr or versioned-datastore cursor/search after pagination techniques
-        if request_params['offset'] > 0:
+        if request_params['offset'] > 0 or backend not in self.backends:
             backend = None
-        before, after = self.backends.get(backend, (self._default_before, self._default_after))
+        return request_params, requested_count, backend
 
-        before(request_params)
-        count = 0
-        while True:
-            try:
-                response = requests.post(self.api_url, json=request_params, headers=self.headers)
-                response.raise_for_status()
-            except requests.exceptions.HTTPError as e:
-                raise StreamError("Failed fetching URL {}: {}".format(self.api_url, e))
+    def _get_pages(self, request_params, requested_count, backend, count=0, skip=0):
+        """
+        Retrieves the pages of records as requested from the CKAN API URL using the appropriate
+        paging mechanism dependant on the given backend. Pages are only requested while more records
+        are needed, and the last page is truncated if it holds more records than were requested.
 
-            result = response.json()['result']
-            if not result['records']:
-                return
-            for record in result['records']:
-                yield record
-                count += 1
+        :param request_params: the parameters of the first request, already prepared by the
+                               backend's before function
+        :param requested_count: the number of records requested, or 0 for all of them
+        :param backend: the name of the backend to use
+        :param count: the number of records already retrieved (default: 0)
+        :param skip: the number of records at the start of the first page to skip as they have
+                     already been retrieved (default: 0)
+        :return: a generator of 2-tuples of a list of records and the paging state after them
+        """
+        _before, after = self._paging_functions(backend)
+
+        page_count = skip
+        while True:
+            result = {}
+            for records in self._fetch_batches(request_params, result, page_count):
+                if requested_count:
+                    records = records[:requested_count - count]
+                count += len(records)
+                page_count += len(records)
+                yield records, self._paging_state(backend, request_params, page_count, count)
                 if count == requested_count:
                     return
-            after(request_params, result)
+            if not page_count:
+                return
+            after(request_params, result, page_count)
+            page_count = 0
+            if self.page_sizer is not None:
+                self._resize_page(request_params, requested_count - count if requested_count else 0)
+
+    def _resize_page(self, request_params, remaining):
+        """
+        Update the limit of the next request using the page sizer, given the stats of the page that
+        has just been retrieved.
+
+        :param request_params: the parameters of the next request
+        :param remaining: the number of records still needed, or 0 if all the records are requested
+        """
+        stats = self.page_stats[-1]
+        page_size = self.page_sizer.size
+        # only full pages are a good indication of how long a page takes
+        if stats['records'] == page_size:
+            new_size = self.page_sizer.observe(stats['records'], stats['wait'] + stats['transfer'],
+                                               stats['bytes'])
+            if new_size != page_size:
+                self.log.info("Changing page size from {} to {} ({})".format(
+                    page_size, new_size, self.page_sizer.decisions[-1][3]))
+        request_params['limit'] = self.page_sizer.size
+        if remaining:
+            request_params['limit'] = min(request_params['limit'], remaining)
+
+    def _get_pages_in_parallel(self, request_params, requested_count, count=0):
+        """
+        Retrieves the pages of records using the default offset/limit paging, fetching several pages
+        concurrently. As the offset of each page is known in advance, pages can be requested in any
+        order; they are put back in order before being returned.
+
+        The number of pages is worked out from the number of records expected (the total matching
+        the request, if get_fields_and_backend has given it, and the number requested), and a page
+        holding fewer records than it should raises a StreamError: the server may cap the number
+        of records it returns below the page size, and carrying on would leave records out. If the
+        number of records expected isn't known, a page holding fewer records than were asked for is
+        the last one.
+
+        :param request_params: the parameters of the first request
+        :param requested_count: the number of records requested, or 0 for all of them
+        :param count: the number of records already retrieved (default: 0)
+        :return: a generator of 2-tuples of a list of records and the paging state after them
+        """
+        start = request_params['offset']
+        expected = requested_count - count if requested_count else None
+        if self.total is not None:
+            available = max(int(self.total) - start, 0)
+            expected = available if expected is None else min(expected, available)
+        page_count = None
+        if expected is not None:
+            page_count = (expected + self.page_size - 1) // self.page_size
+
+        def fetch(index):
+            page_params = copy.deepcopy(request_params)
+            page_params['offset'] = start + index * self.page_size
+            if expected is not None:
+                page_params['limit'] = min(self.page_size, expected - index * self.page_size)
+            records = self._fetch_page(page_params)['records']
+            short = len(records) < page_params['limit']
+            if short and expected is not None:
+                raise StreamError("Received {} records from offset {} rather than {}, the page size "
+                                  "may be over the server's limit".format(
+                                      len(records), page_params['offset'], page_params['limit']))
+            return (records, page_params), short
+
+        for records, page_params in fetch_in_order(fetch, self.parallel, self.parallel_buffer,
+                                                   page_count):
+            if records:
+                count += len(records)
+                yield records, self._paging_state(None, page_params, len(records), count)
+
+    @staticmethod
+    def _paging_state(backend, request_params, page_count, count):
+        """
+        Describe where the records retrieved so far stop, so that get_records can resume from there.
+
+        :param backend: the name of the backend whose paging mechanism is used
+        :param request_params: the parameters of the request of the current page
+        :param page_count: the number of records retrieved from the current page
+        :param count: the total number of records retrieved
+        :return: a JSON serialisable dict
+        """
+        return {
+            'backend': backend,
+            'params': copy.deepcopy(request_params),
+            'skip': page_count,
+            'count': count,
+        }
+
+    def _fetch_page(self, request_params):
+        """
+        Retrieves a single page of records from CKAN.
+
+        :param request_params: the parameters of the request
+        :return: the result dict
+        """
+        result = {}
+        records = []
+        for batch in self._fetch_batches(request_params, result):
+            records.extend(batch)
+        result['records'] = records
+        return result
+
+    def _fetch_batches(self, request_params, result, skip=0):
+        """
+        Retrieves a single page of records from CKAN, yielding its records in batches (see
+        _request_batches). If the request fails with a transient error it is retried after a delay,
+        skipping the records that were yielded before it failed.
+
+        :param request_params: the parameters of the request
+        :param result: a dict in which to put the values in the result, except the records
+        :param skip: the number of records at the start of the page to skip (default: 0)
+        :return: a generator of lists of records
+        """
+        attempt = 0
+        while True:
+            to_skip = skip
+            try:
+                for records in self._request_batches(request_params, result):
+                    if to_skip:
+                        skipped = min(to_skip, len(records))
+                        records = records[skipped:]
+                        to_skip -= skipped
+                    if records:
+                        skip += len(records)
+                        yield records
+                return
+            except TransientStreamError as e:
+                if not self._wait_to_retry(attempt, e):
+                    raise
+                attempt += 1
+                result.clear()
+
+    def _wait_to_retry(self, attempt, error):
+        """
+        Work out whether a request that failed with a transient error should be retried and if so,
+        wait before it is. The delay doubles with each attempt.
+
+        :param attempt: the number of times the request has already been retried
+        :param error: the error the request failed with
+        :return: True if the request should be retried, False if not
+        """
+        if attempt >= self.retries:
+            return False
+        delay = self.retry_backoff * 2 ** attempt
+        self.retry_count += 1
+        self.log.warning("{} (attempt {} of {}), retrying in {}s".format(error, attempt + 1,
+                                                                          self.retries + 1, delay))
+        time.sleep(delay)
+        return True
+
+    def _request_batches(self, request_params, result):
+        """
+        Retrieves a single page of records from CKAN, yielding its records in batches. If responses
+        are streamed the records are parsed as they arrive and yielded in batches of up to
+        STREAM_BATCH_SIZE records, otherwise all the records of the page come in a single batch.
+
+        The given result dict is filled with the other values in the response's result (such as the
+        cursor for the next page). As these may come after the records in the response, the result
+        dict is only complete once all the batches have been read.
+
+        :param request_params: the parameters of the request
+        :param result: a dict in which to put the values in the result, except the records
+        :return: a generator of lists of records
+        """
+        response, stats = self._post(request_params)
+        self._check_status(response)
+
+        stats['records'] = 0
+        stats['bytes'] = 0
+        stats['wire_bytes'] = 0
+        reader = None
+        complete = False
+        # only count the time spent reading and parsing the response, not the time spent by the
+        # consumer between batches
+        start = time.time()
+        try:
+            reader = DecodingReader(response.raw, response.headers.get('content-encoding', ''))
+            if not self.stream:
+                result.update(json.loads(reader.read())['result'])
+                batch = result.pop('records', [])
+            else:
+                batch = []
+                for record in stream_records(reader, result):
+                    batch.append(record)
+                    if len(batch) == self.STREAM_BATCH_SIZE:
+                        stats['records'] += len(batch)
+                        stats['transfer'] += time.time() - start
+                        yield batch
+                        start = time.time()
+                        batch = []
+            stats['records'] += len(batch)
+            stats['transfer'] += time.time() - start
+            complete = True
+            if batch:
+                yield batch
+        except (socket.error, httplib.HTTPException, UrllibHTTPError,
+                ijson.IncompleteJSONError) as e:
+            # the connection was lost or the response cut short
+            raise TransientStreamError("Failed reading response from {}: {}".format(self.api_url,
+                                                                                   e))
+        except (ijson.JSONError, ValueError, zlib.error) as e:
+            raise StreamError("Failed parsing response from {}: {}".format(self.api_url, e))
+        finally:
+            if complete:
+                # the whole response has been read so the connection can go back to the pool
+                response.close()
+            else:
+                # otherwise there may still be data coming down the connection, so drop it
+                response.raw.close()
+            if reader is not None:
+                stats['bytes'] = reader.bytes_read
+                stats['wire_bytes'] = reader.wire_bytes
+            self._log_page(stats)
+
+    def stats_summary(self):
+        """
+        Summarise the page timings recorded so far by get_records.
+
+        :return: a dict with the number of pages and records fetched, the number of new connections
+                 that had to be opened, the total time spent waiting for response headers
+                 (which includes connection setup) and transferring response bodies, the size of
+                 the response bodies once decoded and as transferred (compressed, if the server
+                 compressed them) and the number of requests retried.
+        """
+        return {
+            'pages': len(self.page_stats),
+            'records': sum(s['records'] for s in self.page_stats),
+            'new_connections': sum(1 for s in self.page_stats if s['new_connection']),
+            'wait': sum(s['wait'] for s in self.page_stats),
+            'transfer': sum(s['transfer'] for s in self.page_stats),
+            'bytes': sum(s['bytes'] for s in self.page_stats),
+            'wire_bytes': sum(s['wire_bytes'] for s in self.page_stats),
+            'retries': self.retry_count,
+        }
+
+    def _post(self, request_params):
+        """
+        Post the given parameters to the CKAN API using the pooled session and time the request. The
+        time to get the response headers (which includes setting up the connection, if a new one was
+        needed) and the time to transfer the body are measured separately.
+
+        Only the response headers are read before returning, the body is left for the caller to
+        read (and decode) from the raw response. The time spent reading the body is then up to the
+        caller to add to the timings.
+
+        :param request_params: a dict of request parameters
+        :return: a 2-tuple of the response and a dict of timings
+        """
+        connections = connection_count(self.session, self.api_url)
+        start = time.time()
+        try:
+            response = self.session.post(self.api_url, json=request_params, headers=self.headers,
+                                         stream=True)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError) as e:
+            raise TransientStreamError("Failed fetching URL {}: {}".format(self.api_url, e))
+        total = time.time() - start
+        wait = response.elapsed.total_seconds()
+        stats = {
+            'new_connection': connection_count(self.session, self.api_url) > connections,
+            'wait': wait,
+            'transfer': max(total - wait, 0),
+        }
+        return response, stats
+
+    def _check_status(self, response):
+        """
+        Raise an error if the given response isn't successful. Server errors and rate limiting
+        responses may not happen again, so a TransientStreamError is raised for those.
+
+        :param response: the response
+        """
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            response.close()
+            message = "Failed fetching URL {}: {}".format(self.api_url, e)
+            if response.status_code >= 500 or response.status_code == 429:
+                raise TransientStreamError(message)
+            raise StreamError(message)
+
+    def _log_page(self, stats):
+        """
+        Record the stats of a page retrieved by get_records.
+
+        :param stats: the dict of page stats
+        """
+        self.page_stats.append(stats)
+        if self.progress is not None:
+            self.progress.fetched(stats['records'], stats['wire_bytes'])
+        self.log.debug("Page {}: {} records, {:.3f}s waiting for response ({} connection), "
+                       "{:.3f}s transferring {} bytes ({} decoded)".format(
+                           len(self.page_stats), stats['records'], stats['wait'],
+                           'new' if stats['new_connection'] else 'reused', stats['transfer'],
+                           stats['wire_bytes'], stats['bytes']))
 
     @staticmethod
     def _default_before(request_params):
@@ -131,34 +648,39 @@ class CkanResource(object):
         del request_params['offset']
 
     @staticmethod
-    def _default_after(request_params, _result):
+    def _default_after(request_params, _result, page_count):
         """
         If using the default way of paginating the data (offset/limit), then we need to update the
-        offset parameter each time a request is completed.
+        offset parameter each time a request is completed. The offset moves on by the number of
+        records received rather than the limit, as CKAN caps the number of records it returns
+        (ckan.datastore.search.rows_max) whatever the limit.
 
         :param request_params: a dict of request parameters
         :param _result: the result dict, not used here
+        :param page_count: the number of records in the page
         """
-        request_params['offset'] += request_params['limit']
+        request_params['offset'] += page_count
 
     @staticmethod
-    def _solr_after(request_params, result):
+    def _solr_after(request_params, result, _page_count):
         """
         If using the solr way of paginating the data (cursor based), then we need to update the
         cursor parameter.
 
         :param request_params: a dict of request parameters
         :param result: the result dict
+        :param _page_count: the number of records in the page, not used here
         """
         request_params['cursor'] = result['next_cursor']
 
     @staticmethod
-    def _versioned_datastore_after(request_params, result):
+    def _versioned_datastore_after(request_params, result, _page_count):
         """
         If using the versioned-datastore way of paginating the data (elasticsearch's search after),
         then we need to update the after parameter.
 
         :param request_params: a dict of request parameters
         :param result: the result dict
+        :param _page_count: the number of records in the page, not used here
         """
         request_params['after'] = result['after']
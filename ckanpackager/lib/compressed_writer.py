@@ -0,0 +1,75 @@
+"""Compressing the files of a package as they are written"""
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# the extension of the files written with each compression
+EXTENSIONS = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+def compression_available(compression):
+    """
+    Return True if files can be written with the given compression. gzip is always available,
+    zstd needs the zstandard module.
+
+    :param compression: the name of the compression ('gzip' or 'zstd'), or None for none
+    :return: True if the compression is available
+    """
+    if compression == 'zstd':
+        return zstandard is not None
+    return compression is None or compression in EXTENSIONS
+
+
+class CompressedWriter(object):
+    """
+    File like object compressing the data written to it into another file object, as a single gzip
+    member or zstd frame. The data can be decompressed as it is read (eg. with zcat or zstdcat),
+    and the output of several writers can be concatenated into a valid stream.
+
+    The compressed stream is only complete once the writer is closed, which closes the output too.
+    """
+
+    def __init__(self, output, compression, level=None):
+        """
+        :param output: the file object to write the compressed data to
+        :param compression: the name of the compression, 'gzip' or 'zstd'
+        :param level: the compression level (default: 6 for gzip, 3 for zstd)
+        """
+        self.output = output
+        self.compression = compression
+        self.closed = False
+        if compression == 'gzip':
+            # 16 more window bits ask zlib for the gzip header and trailer
+            self._compressor = zlib.compressobj(6 if level is None else level, zlib.DEFLATED,
+                                                16 + zlib.MAX_WBITS)
+        elif compression == 'zstd':
+            self._compressor = zstandard.ZstdCompressor(
+                level=3 if level is None else level).compressobj()
+        else:
+            raise ValueError('Unknown compression {}'.format(compression))
+
+    def write(self, data):
+        compressed = self._compressor.compress(data)
+        if compressed:
+            self.output.write(compressed)
+
+    def flush(self):
+        """
+        Data is only written out once the compressor has enough of it, this only flushes the output
+        file.
+        """
+        self.output.flush()
+
+    def close(self):
+        """End the compressed stream and close the output"""
+        if self.closed:
+            return
+        self.output.write(self._compressor.flush())
+        self.output.close()
+        self.closed = True
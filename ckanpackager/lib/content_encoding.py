@@ -0,0 +1,143 @@
+"""Decoding of compressed HTTP response bodies"""
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# the number of bytes read from the wire at a time
+CHUNK_SIZE = 64 * 1024
+
+
+def accept_encoding():
+    """
+    Return the value of the Accept-Encoding header advertising the encodings we can decode. Brotli
+    is only included if the brotli module is installed.
+
+    :return: the header value
+    """
+    encodings = ['gzip', 'deflate']
+    if brotli is not None:
+        encodings.append('br')
+    return ', '.join(encodings)
+
+
+class _DeflateDecoder(object):
+    """
+    Decodes deflate encoded data. Some servers send raw deflate data rather than the zlib format
+    the spec asks for, so the format is chosen from the first two bytes: if they aren't a zlib
+    header the data is decoded as raw deflate data instead.
+    """
+
+    def __init__(self):
+        self._decoder = None
+        # the data received until we have the two header bytes
+        self._start = ''
+
+    def decompress(self, data):
+        if self._decoder is None:
+            self._start += data
+            if len(self._start) < 2:
+                return ''
+            first, second = ord(self._start[0]), ord(self._start[1])
+            if (first * 256 + second) % 31 == 0 and first & 0x0f == zlib.DEFLATED:
+                self._decoder = zlib.decompressobj()
+            else:
+                self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            data, self._start = self._start, ''
+        return self._decoder.decompress(data)
+
+    def flush(self):
+        if self._decoder is None:
+            # fewer than two bytes were received, which can't decode to anything
+            return ''
+        return self._decoder.flush()
+
+
+class _BrotliDecoder(object):
+    """
+    Decodes brotli encoded data, using either of the brotli and brotlipy modules (both are imported
+    as brotli but their decompressors have different APIs).
+    """
+
+    def __init__(self):
+        decoder = brotli.Decompressor()
+        self.decompress = getattr(decoder, 'process', None) or decoder.decompress
+
+    def flush(self):
+        return ''
+
+
+def _decoder(encoding):
+    """
+    Return a decoder for the given content encoding.
+
+    :param encoding: the value of the Content-Encoding header
+    :return: an object with decompress and flush methods like zlib's decompression objects, or None
+             if the content isn't encoded
+    """
+    encoding = encoding.strip().lower()
+    if encoding in ('', 'identity'):
+        return None
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        return _DeflateDecoder()
+    if encoding == 'br' and brotli is not None:
+        return _BrotliDecoder()
+    raise ValueError('Unsupported content encoding: {}'.format(encoding))
+
+
+class DecodingReader(object):
+    """
+    Wraps the raw stream of a response body, decoding it as it is read. The number of bytes read
+    from the wire and the number of bytes they decoded to are counted.
+    """
+
+    def __init__(self, stream, encoding):
+        """
+        :param stream: the raw (undecoded) stream of the response body
+        :param encoding: the value of the response's Content-Encoding header
+        """
+        self.stream = stream
+        self.decoder = _decoder(encoding)
+        # the number of bytes read from the stream
+        self.wire_bytes = 0
+        # the number of decoded bytes read from this reader
+        self.bytes_read = 0
+        self._buffer = ''
+        self._position = 0
+        self._done = False
+
+    def _fill(self):
+        """Read and decode the next chunk from the stream into the buffer"""
+        chunk = self.stream.read(CHUNK_SIZE)
+        self.wire_bytes += len(chunk)
+        if not chunk:
+            self._done = True
+            decoded = self.decoder.flush() if self.decoder is not None else ''
+        elif self.decoder is None:
+            decoded = chunk
+        else:
+            decoded = self.decoder.decompress(chunk)
+        self._buffer = self._buffer[self._position:] + decoded
+        self._position = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            parts = [self._buffer[self._position:]]
+            self._buffer = ''
+            self._position = 0
+            while not self._done:
+                self._fill()
+                parts.append(self._buffer)
+                self._buffer = ''
+            data = ''.join(parts)
+        else:
+            while not self._done and len(self._buffer) - self._position < size:
+                self._fill()
+            data = self._buffer[self._position:self._position + size]
+            self._position += len(data)
+        self.bytes_read += len(data)
+        return data
@@ -0,0 +1,81 @@
+"""Incremental parsing of CKAN API responses"""
+from decimal import Decimal
+
+import ijson
+
+# the prefix (as defined by ijson) of the records in a datastore_search response
+RECORDS_PREFIX = 'result.records.item'
+
+
+class _ObjectBuilder(ijson.ObjectBuilder):
+    """
+    Builds objects from ijson events, converting decimal numbers to floats so that the objects are
+    the same as the ones the json module would produce.
+    """
+
+    def event(self, event, value):
+        if isinstance(value, Decimal):
+            value = float(value)
+        super(_ObjectBuilder, self).event(event, value)
+
+
+def _next(events):
+    """
+    Return the next event, raising an error if there are none left as the document is incomplete
+    (we don't want a StopIteration to quietly end the generator of records).
+
+    :param events: the iterator of ijson (prefix, event, value) events
+    :return: the next (prefix, event, value) event
+    """
+    try:
+        return next(events)
+    except StopIteration:
+        raise ijson.IncompleteJSONError()
+
+
+def _build(events, prefix, event, value):
+    """
+    Build the value starting with the given event from the following events.
+
+    :param events: the iterator of ijson (prefix, event, value) events
+    :param prefix: the prefix of the value's first event
+    :param event: the value's first event
+    :param value: the value associated with the first event
+    :return: the value
+    """
+    if event not in ('start_map', 'start_array'):
+        return float(value) if isinstance(value, Decimal) else value
+    builder = _ObjectBuilder()
+    builder.event(event, value)
+    end_event = event.replace('start', 'end')
+    while True:
+        current, event, value = _next(events)
+        builder.event(event, value)
+        if current == prefix and event == end_event:
+            return builder.value
+
+
+def stream_records(stream, result):
+    """
+    Parse a datastore_search response incrementally, yielding the records as they are read from the
+    stream. The other values in the response's result (for example `next_cursor` or `after`, which
+    usually come after the records) are added to the given result dict as they are found, so the
+    result dict is only complete once all the records have been read.
+
+    :param stream: a file like object to read the JSON response from
+    :param result: a dict in which to put the values in the response's result, except the records
+    :return: a generator of records
+    """
+    events = ijson.parse(stream)
+    complete = False
+    for prefix, event, value in events:
+        if prefix == RECORDS_PREFIX:
+            yield _build(events, prefix, event, value)
+        elif prefix == 'result' and event == 'map_key' and value != 'records':
+            key = value
+            value_prefix, event, value = _next(events)
+            result[key] = _build(events, value_prefix, event, value)
+        elif prefix == '' and event == 'end_map':
+            complete = True
+    if not complete:
+        raise ijson.IncompleteJSONError()
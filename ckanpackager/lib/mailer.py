@@ -0,0 +1,76 @@
+"""Sending the emails telling users where to download their packages"""
+import smtplib
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+
+def build_message(from_addr, subject, text, html):
+    """
+    Build an email with plain text and html alternative bodies. The message has no recipient, see
+    Mailer.send.
+
+    :param from_addr: the sender's address
+    :param subject: the subject line
+    :param text: the plain text body
+    :param html: the html body
+    :return: an email.mime.multipart.MIMEMultipart message
+    """
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = subject
+    msg['From'] = from_addr
+    msg.attach(MIMEText(text, 'plain'))
+    msg.attach(MIMEText(html, 'html'))
+    return msg
+
+
+class Mailer(object):
+    """
+    Sends a message to a list of recipients over a single SMTP connection. Each recipient gets their
+    own copy of the message (so they don't see each other's address), but the message is only built
+    once and the connection, login included, is only set up once.
+    """
+
+    def __init__(self, host, port, login=None, password=None):
+        """
+        :param host: the SMTP host
+        :param port: the SMTP port
+        :param login: the SMTP username, if one is required
+        :param password: the SMTP password, if a username is given
+        """
+        self.host = host
+        self.port = port
+        self.login = login
+        self.password = password
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create a mailer from the SMTP_* settings of the given configuration.
+
+        :param config: the configuration dictionary
+        :return: a Mailer
+        """
+        return cls(config['SMTP_HOST'], config['SMTP_PORT'], config.get('SMTP_LOGIN'),
+                   config.get('SMTP_PASSWORD'))
+
+    def send(self, msg, from_addr, recipients):
+        """
+        Send the message to each of the recipients.
+
+        :param msg: the message, as returned by build_message. Its To header is set to each
+                    recipient in turn.
+        :param from_addr: the envelope sender's address
+        :param recipients: the list of recipient addresses
+        """
+        if not recipients:
+            return
+        server = smtplib.SMTP(self.host, self.port)
+        try:
+            if self.login is not None:
+                server.login(self.login, self.password)
+            for recipient in recipients:
+                del msg['To']
+                msg['To'] = recipient
+                server.sendmail(from_addr, recipient, msg.as_string())
+        finally:
+            server.quit()
@@ -0,0 +1,81 @@
+"""Adaptive sizing of the pages of records requested from CKAN"""
+
+
+class PageSizer(object):
+    """
+    Works out how many records to request in each page, based on how long the previous pages took
+    to retrieve and how large they were. The page size converges towards the number of records that
+    can be retrieved in the target duration, without pages getting bigger than the maximum number
+    of bytes, and always stays within the given bounds.
+    """
+
+    # the most the page size can grow or shrink by between two pages
+    MAX_FACTOR = 2.0
+    # changes smaller than this fraction of the current page size are ignored, to avoid changing the
+    # page size after every page because of small variations in response times
+    MIN_CHANGE = 0.1
+
+    def __init__(self, initial, minimum, maximum, target_duration, max_bytes=None):
+        """
+        :param initial: the size of the first page
+        :param minimum: the smallest page size allowed
+        :param maximum: the largest page size allowed
+        :param target_duration: the number of seconds each page should take to retrieve
+        :param max_bytes: the maximum size, in bytes, of a page (default: no limit)
+        """
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_duration = target_duration
+        self.max_bytes = max_bytes
+        self.size = self._clamp(initial)
+        # the number of pages observed
+        self.pages = 0
+        # list of (observed page number, old size, new size, reason) tuples
+        self.decisions = []
+
+    def _clamp(self, size):
+        return int(max(self.minimum, min(self.maximum, size)))
+
+    def observe(self, records, duration, size):
+        """
+        Update the page size given the measurements of the page that has just been retrieved. Only
+        pages holding as many records as were requested should be observed, the last page of a
+        resource, for example, doesn't tell us much.
+
+        :param records: the number of records in the page
+        :param duration: the number of seconds it took to retrieve the page
+        :param size: the size of the page, in bytes
+        :return: the page size to use for the next page
+        """
+        self.pages += 1
+        if not records or duration <= 0:
+            return self.size
+
+        ideal = records * self.target_duration / float(duration)
+        reason = '{:.2f}s for {} records'.format(duration, records)
+        if self.max_bytes and size:
+            by_bytes = self.max_bytes * records / float(size)
+            if by_bytes < ideal:
+                ideal = by_bytes
+                reason = '{} bytes per record'.format(size // records)
+        ideal = max(self.size / self.MAX_FACTOR, min(self.size * self.MAX_FACTOR, ideal))
+        new_size = self._clamp(ideal)
+        if abs(new_size - self.size) > self.size * self.MIN_CHANGE:
+            self.decisions.append((self.pages, self.size, new_size, reason))
+            self.size = new_size
+        return self.size
+
+    def summary(self):
+        """
+        Summarise the page size decisions made so far.
+
+        :return: a dict with the number of changes made and the smallest, largest and final page
+                 sizes used
+        """
+        sizes = [self.size] + [d[1] for d in self.decisions]
+        return {
+            'changes': len(self.decisions),
+            'smallest': min(sizes),
+            'largest': max(sizes),
+            'final': self.size,
+        }
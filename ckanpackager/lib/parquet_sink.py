@@ -0,0 +1,237 @@
+"""Writes rows into parquet files, a row group at a time"""
+import json
+import os
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# the datastore field types written as integer, floating point and boolean columns, the values of
+# other types are written as text
+_INT_TYPES = frozenset(['int', 'int2', 'int4', 'int8', 'integer', 'smallint', 'bigint'])
+_FLOAT_TYPES = frozenset(['float', 'float4', 'float8', 'real', 'double precision', 'numeric',
+                          'number'])
+_BOOL_TYPES = frozenset(['bool', 'boolean'])
+
+
+def parquet_available():
+    """
+    :return: True if the pyarrow module, which parquet files are written with, is installed
+    """
+    return pyarrow is not None
+
+
+def _to_int(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        return value
+    if isinstance(value, basestring):
+        try:
+            return int(value)
+        except ValueError:
+            # eg. '1.0' or '1e3'
+            pass
+    number = float(value)
+    if not number.is_integer():
+        raise ValueError("Not an integer: {}".format(value))
+    return int(number)
+
+
+def _to_float(value):
+    if value is None or value == '':
+        return None
+    return float(value)
+
+
+def _to_bool(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, basestring):
+        return value.lower() in ('true', 't', '1', 'yes')
+    return bool(value)
+
+
+def _to_text(value):
+    if value is None or isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    if isinstance(value, (list, dict)):
+        # nested values are kept as JSON rather than Python's representation (decimals being
+        # streamed JSON numbers)
+        return json.dumps(value, default=float)
+    return unicode(value)
+
+
+def column_type(field_type):
+    """
+    Return the arrow type of the column of a datastore field, and the function converting its
+    values to that type when they can't be converted as they are.
+
+    :param field_type: the type of the field, as given by CKAN (or None if unknown)
+    :return: a 2-tuple of the arrow type and the conversion function
+    """
+    field_type = (field_type or '').lower()
+    if field_type in _INT_TYPES:
+        return pyarrow.int64(), _to_int
+    if field_type in _FLOAT_TYPES:
+        return pyarrow.float64(), _to_float
+    if field_type in _BOOL_TYPES:
+        return pyarrow.bool_(), _to_bool
+    return pyarrow.string(), _to_text
+
+
+def fallback_type(arrow_type):
+    """
+    Return the arrow type to write a column as when its values don't all fit its type (eg. a
+    value with a fractional part in an integer column): integer columns become floating point
+    columns, and others text columns.
+
+    :param arrow_type: the arrow type of the column
+    :return: a 2-tuple of the arrow type and the conversion function, as for column_type
+    """
+    if pyarrow.types.is_integer(arrow_type):
+        return pyarrow.float64(), _to_float
+    return pyarrow.string(), _to_text
+
+
+class ParquetSink(object):
+    """
+    Writes rows to a parquet file, with a column for each datastore field typed after the field's
+    type. The rows of each call to writerows (a page of records) are converted to an arrow record
+    batch, and the batches are written out as a row group once they hold row_group_size rows, so
+    memory use is bounded by the size of a row group (and a page).
+
+    Like XlsxSink, it has the writerow and writerows methods of csv writers and the flush and close
+    methods and closed attribute of file objects, so that it can be one of the writers of a
+    ResourceFile. The first row written is the header, which is ignored as the columns are named
+    after the fields. The file is complete once the sink is closed.
+
+    A column holding a value that doesn't fit its type is changed to the type given by
+    fallback_type, rather than the value being truncated or the package failing. The rows already
+    written are converted, rewriting the file if row groups have been written.
+    """
+
+    def __init__(self, path, fields, compression='snappy', row_group_size=100000):
+        """
+        :param path: the path of the parquet file
+        :param fields: the list of datastore field dicts (with an 'id' and, if known, a 'type')
+        :param compression: the compression codec of the columns (eg. 'snappy', 'gzip', 'zstd' or
+                            None)
+        :param row_group_size: the number of rows of each row group
+        """
+        self.path = path
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.closed = False
+        types = [column_type(f.get('type', None)) for f in fields]
+        self.schema = pyarrow.schema([pyarrow.field(f['id'], arrow_type)
+                                      for f, (arrow_type, _convert) in zip(fields, types)])
+        self._converters = [convert for _type, convert in types]
+        self._writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression=compression)
+        self._header = False
+        # whether row groups have been written
+        self._written = False
+        self._batches = []
+        # the number of rows of the batches not written yet
+        self._rows = 0
+
+    def _array(self, index, values):
+        """Return the arrow array of the given values of a column"""
+        arrow_type = self.schema.types[index]
+        # arrow truncates floating point values written to integer columns, so these are always
+        # converted
+        if not pyarrow.types.is_integer(arrow_type):
+            try:
+                return pyarrow.array(values, type=arrow_type)
+            except (TypeError, ValueError, OverflowError):
+                # eg. numbers as text, as read back from a csv file
+                pass
+        while True:
+            convert = self._converters[index]
+            try:
+                return pyarrow.array([convert(value) for value in values],
+                                     type=self.schema.types[index])
+            except (TypeError, ValueError, OverflowError):
+                self._change_type(index)
+
+    def _change_type(self, index):
+        """
+        Change the type of a column whose values don't all fit it to its fallback type (see
+        fallback_type), converting the rows already written.
+
+        :param index: the index of the column
+        """
+        arrow_type, convert = fallback_type(self.schema.types[index])
+        self.schema = pyarrow.schema([pyarrow.field(field.name, arrow_type) if i == index
+                                      else field for i, field in enumerate(self.schema)])
+        self._converters[index] = convert
+        self._batches = [self._convert_column(batch, index) for batch in self._batches]
+        if self._written:
+            # the row groups can't be changed, so they are written again to a new file
+            self._writer.close()
+            written = '{}.old'.format(self.path)
+            os.rename(self.path, written)
+            self._writer = pyarrow.parquet.ParquetWriter(self.path, self.schema,
+                                                         compression=self.compression)
+            parquet = pyarrow.parquet.ParquetFile(written)
+            for group in range(parquet.num_row_groups):
+                table = parquet.read_row_group(group)
+                batches = [self._convert_column(batch, index) for batch in table.to_batches()]
+                self._writer.write_table(pyarrow.Table.from_batches(batches, schema=self.schema),
+                                         row_group_size=table.num_rows)
+            os.remove(written)
+
+    def _convert_column(self, batch, index):
+        """Return the record batch with the values of a column converted to the column's type"""
+        convert = self._converters[index]
+        arrays = [batch.column(i) for i in range(batch.num_columns)]
+        arrays[index] = pyarrow.array([convert(value) for value in arrays[index].to_pylist()],
+                                      type=self.schema.types[index])
+        return pyarrow.RecordBatch.from_arrays(arrays, self.schema.names)
+
+    def writerow(self, row):
+        """
+        :param row: the list of values of the row, the first one being the header
+        """
+        self.writerows([row])
+
+    def writerows(self, rows):
+        """
+        :param rows: a list of lists of values
+        """
+        if not self._header:
+            self._header = True
+            rows = rows[1:]
+        if not rows:
+            return
+        columns = zip(*rows)
+        arrays = [self._array(i, list(values)) for i, values in enumerate(columns)]
+        self._batches.append(pyarrow.RecordBatch.from_arrays(arrays, self.schema.names))
+        self._rows += len(rows)
+        while self._rows >= self.row_group_size:
+            self._write_row_group(self.row_group_size)
+
+    def _write_row_group(self, size):
+        """Write the first `size` rows of the batches as a row group"""
+        table = pyarrow.Table.from_batches(self._batches, schema=self.schema)
+        self._writer.write_table(table.slice(0, size), row_group_size=size)
+        self._written = True
+        self._batches = table.slice(size).to_batches()
+        self._rows -= size
+
+    def flush(self):
+        """Nothing to do, rows are written a row group at a time"""
+        pass
+
+    def close(self):
+        """Write the remaining rows and complete the file"""
+        if self.closed:
+            return
+        if self._rows:
+            self._write_row_group(self._rows)
+        self._writer.close()
+        self.closed = True
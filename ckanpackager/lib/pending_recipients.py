@@ -0,0 +1,100 @@
+"""The list of people waiting for a package being built by another task"""
+import os
+import uuid
+
+from ckanpackager.lib.cache_index import INDEX_FOLDER
+
+# the folder, in the store directory, holding the recipient lists
+RECIPIENTS_FOLDER = os.path.join(INDEX_FOLDER, 'recipients')
+
+
+class PendingRecipients(object):
+    """
+    The email addresses to send the link of a package to once it is built, added by the tasks for
+    identical requests that arrived while it was being built. These are kept in a file in the store
+    directory, one address per line, so that they are shared by all the workers.
+    """
+
+    def __init__(self, root, key):
+        """
+        :param root: the store directory
+        :param key: the key of the request, ie. the base name of its ZIP file
+        """
+        self.folder = os.path.join(root, RECIPIENTS_FOLDER)
+        self.path = os.path.join(self.folder, key)
+
+    def add(self, email):
+        """
+        Add a recipient to the list.
+
+        :param email: the email address
+        """
+        if not os.path.isdir(self.folder):
+            try:
+                os.makedirs(self.folder)
+            except OSError:
+                # someone else just created it
+                pass
+        # a single write to a file opened for appending is atomic, so tasks adding themselves at
+        # the same time don't interfere with each other
+        line = email.encode('utf-8') if isinstance(email, unicode) else email
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.replace('\n', '') + '\n')
+        finally:
+            os.close(fd)
+
+    def waiting(self):
+        """
+        :return: True if there are recipients in the list
+        """
+        return os.path.exists(self.path)
+
+    def take(self):
+        """
+        Remove all the recipients from the list and return them.
+
+        :return: the list of email addresses, without duplicates
+        """
+        # move the file out of the way first, so recipients added meanwhile go in a new list
+        taken = '{}.{}'.format(self.path, uuid.uuid4().hex)
+        try:
+            os.rename(self.path, taken)
+        except OSError:
+            return []
+        try:
+            with open(taken) as f:
+                emails = [line.strip() for line in f]
+        finally:
+            os.remove(taken)
+        recipients = []
+        for email in emails:
+            if email and email not in recipients:
+                recipients.append(email)
+        return recipients
+
+
+def remove_stale_recipients(root, older_than):
+    """
+    Remove the recipient lists that haven't been added to for a while. These are left behind by
+    tasks that died while building a package.
+
+    :param root: the store directory
+    :param older_than: timestamp before which lists were last added to to be removed
+    :return: the number of lists removed
+    """
+    folder = os.path.join(root, RECIPIENTS_FOLDER)
+    if not os.path.isdir(folder):
+        return 0
+    count = 0
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        try:
+            if os.path.getmtime(path) >= older_than:
+                continue
+            os.remove(path)
+        except OSError:
+            # it has just been taken
+            continue
+        count += 1
+    return count
@@ -0,0 +1,161 @@
+"""Background prefetching of items from slow iterators (such as pages of results from CKAN)"""
+import sys
+import threading
+import Queue
+
+# marks the end of the items put on the queue by the producer thread
+_DONE = object()
+
+
+def prefetch(iterable, depth):
+    """
+    Iterate over the given iterable in a background thread, keeping up to `depth` items ready in a
+    bounded queue. This lets the consumer work on one item while the next ones are being produced,
+    without holding more than `depth` items in memory.
+
+    Exceptions raised by the iterable are re-raised in the consumer's thread. If the consumer stops
+    iterating early the producer thread stops once it is done with the item it is working on.
+
+    :param iterable: the iterable to consume in the background
+    :param depth: the maximum number of items to fetch ahead. If this is less than 1 the iterable
+                  is consumed directly, without a background thread.
+    :return: a generator of the iterable's items
+    """
+    if depth < 1:
+        for item in iterable:
+            yield item
+        return
+
+    queue = Queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        # don't block forever on a full queue, the consumer might have gone away
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((_DONE, None))
+        except Exception:
+            put((_DONE, sys.exc_info()))
+
+    producer = threading.Thread(target=produce, name='prefetch')
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if item is _DONE:
+                if error is not None:
+                    raise error[0], error[1], error[2]
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def fetch_in_order(fetch, workers, max_buffered, count=None):
+    """
+    Fetch numbered items concurrently and return them in order. This is useful when the location of
+    each item is known ahead of time (for example pages of results using offset based paging).
+
+    Items are fetched by `workers` threads, each calling `fetch(index)` for the next index nobody
+    has claimed yet. Items that arrive out of order wait in a reorder buffer until all the items
+    before them have been returned; to cap memory usage, workers don't start fetching an item more
+    than `max_buffered` places ahead of the next item to return.
+
+    The fetch function must return a 2-tuple of the item and a boolean which is True if this is the
+    last item. Once an item has been flagged as the last one no further items are fetched and any
+    items after it that have already been fetched are dropped. If fetching an item fails, no further
+    items are fetched and the error is raised once all the items before it have been returned.
+
+    :param fetch: the function fetching an item, given its index
+    :param workers: the number of concurrent fetches
+    :param max_buffered: the maximum number of items held in the reorder buffer
+    :param count: the number of items to fetch, or None to fetch until an item is flagged as the
+                  last one
+    :return: a generator of items
+    """
+    # all the state below is shared by the workers and the consumer, guarded by this condition
+    condition = threading.Condition()
+    state = {
+        'next_index': 0,
+        'next_to_return': 0,
+        'last_index': count - 1 if count is not None else None,
+        'failed': False,
+        'stopped': False,
+    }
+    # fetched items (or errors) waiting to be returned, keyed on their index
+    buffered = {}
+
+    def finished(index):
+        return state['last_index'] is not None and index > state['last_index']
+
+    def claim():
+        # wait for an index to fetch that is close enough to the consumer, or for the fetching to be
+        # over (in which case None is returned)
+        with condition:
+            while True:
+                index = state['next_index']
+                if state['stopped'] or state['failed'] or finished(index):
+                    return None
+                if index < state['next_to_return'] + max_buffered:
+                    state['next_index'] += 1
+                    return index
+                condition.wait(0.1)
+
+    def work():
+        while True:
+            index = claim()
+            if index is None:
+                return
+            try:
+                item, last = fetch(index)
+                error = None
+            except Exception:
+                item, last = None, False
+                error = sys.exc_info()
+            with condition:
+                if error is not None:
+                    state['failed'] = True
+                if last and (state['last_index'] is None or index < state['last_index']):
+                    state['last_index'] = index
+                    for dropped in [i for i in buffered if finished(i)]:
+                        del buffered[dropped]
+                if not finished(index):
+                    buffered[index] = (item, error)
+                condition.notify_all()
+            if error is not None:
+                return
+
+    threads = [threading.Thread(target=work, name='fetch-in-order') for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        while True:
+            with condition:
+                index = state['next_to_return']
+                while index not in buffered and not finished(index):
+                    condition.wait(0.1)
+                if index not in buffered:
+                    return
+                item, error = buffered.pop(index)
+                if error is not None:
+                    raise error[0], error[1], error[2]
+                state['next_to_return'] += 1
+                condition.notify_all()
+            yield item
+    finally:
+        with condition:
+            state['stopped'] = True
+            condition.notify_all()
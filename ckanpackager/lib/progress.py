@@ -0,0 +1,154 @@
+"""The progress of the tasks being run, as published by the workers"""
+import os
+import json
+import time
+import uuid
+
+from ckanpackager.lib.cache_index import INDEX_FOLDER
+
+# the folder, in the store directory, holding the progress of each task being run
+PROGRESS_FOLDER = os.path.join(INDEX_FOLDER, 'progress')
+
+
+def _add_rates(state):
+    """
+    Add the rates at which records and bytes are fetched (per second) and the estimated number of
+    seconds left, if the number of records expected is known, to the given task progress.
+
+    :param state: the progress dictionary
+    :return: the dictionary
+    """
+    elapsed = state['updated'] - state['started']
+    state['rate'] = state['records'] / elapsed if elapsed > 0 else 0
+    state['byte_rate'] = state['bytes'] / elapsed if elapsed > 0 else 0
+    state['eta'] = None
+    if state['total'] is not None and state['rate'] > 0:
+        state['eta'] = max(state['total'] - state['records'], 0) / state['rate']
+    return state
+
+
+class TaskProgress(object):
+    """
+    The progress of a task: its current phase, the number of records (and bytes) fetched from CKAN
+    and the number of rows written. This is published to a file in the store directory for the web
+    service to report (see in_flight), at most every `interval` seconds but when the phase changes,
+    so that it can be updated for every page or batch of records at little cost.
+
+    Publishing is best effort: failing to write the file doesn't fail the task.
+    """
+
+    def __init__(self, root, task_id, info=None, interval=5):
+        """
+        :param root: the store directory, or None to keep track of the progress without publishing
+                     it
+        :param task_id: a unique identifier of the task
+        :param info: a dictionary describing the task, published along with its progress
+        :param interval: the minimum time between two updates of the published progress, in seconds
+        """
+        self.path = None
+        if root is not None:
+            self.path = os.path.join(root, PROGRESS_FOLDER, '{}.json'.format(task_id))
+        self.interval = interval
+        now = time.time()
+        self.state = dict(info or {}, id=task_id, phase='starting', records=0, bytes=0, rows=0,
+                          total=None, started=now, updated=now)
+        self._published = 0
+
+    def set_phase(self, phase):
+        """
+        Record the phase the task has reached, and publish the progress.
+
+        :param phase: the name of the phase, eg. 'fetching'
+        """
+        self.state['phase'] = phase
+        self.publish()
+
+    def set_total(self, total):
+        """
+        :param total: the number of records the task is expected to fetch
+        """
+        self.state['total'] = total
+
+    def fetched(self, records, bytes_count=0):
+        """
+        Record that records have been fetched.
+
+        :param records: the number of records fetched since the last call
+        :param bytes_count: the number of bytes they took up
+        """
+        self.state['records'] += records
+        self.state['bytes'] += bytes_count
+        self._update()
+
+    def written(self, rows):
+        """
+        Record the number of rows written so far.
+
+        :param rows: the number of rows
+        """
+        self.state['rows'] = rows
+        self._update()
+
+    def _update(self):
+        """Publish the progress if it hasn't been for long enough"""
+        if self.path is not None and time.time() - self._published >= self.interval:
+            self.publish()
+
+    def publish(self):
+        """Publish the progress"""
+        if self.path is None:
+            return
+        self.state['updated'] = self._published = time.time()
+        folder = os.path.dirname(self.path)
+        temp = '{}.{}.tmp'.format(self.path, uuid.uuid4().hex)
+        try:
+            if not os.path.isdir(folder):
+                try:
+                    os.makedirs(folder)
+                except OSError:
+                    # someone else just created it
+                    pass
+            with open(temp, 'w') as f:
+                json.dump(self.state, f)
+            os.rename(temp, self.path)
+        except (IOError, OSError):
+            pass
+
+    def finish(self):
+        """Remove the published progress, once the task is done"""
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+def in_flight(root, max_age):
+    """
+    Return the progress of the tasks being run, as published by the workers. The progress of tasks
+    that haven't published it for a while (eg. because their worker died) is removed.
+
+    :param root: the store directory
+    :param max_age: the number of seconds after which progress that hasn't been updated is removed
+    :return: a list of progress dictionaries, in the order the tasks started, with the rates at
+             which records and bytes are fetched ('rate' and 'byte_rate', per second) and the
+             estimated number of seconds left ('eta', or None if unknown)
+    """
+    folder = os.path.join(root, PROGRESS_FOLDER)
+    if not os.path.isdir(folder):
+        return []
+    tasks = []
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        try:
+            if os.path.getmtime(path) < time.time() - max_age:
+                os.remove(path)
+                continue
+            if not name.endswith('.json'):
+                continue
+            with open(path) as f:
+                tasks.append(_add_rates(json.load(f)))
+        except (IOError, OSError, ValueError):
+            # finished (or being written) meanwhile
+            continue
+    return sorted(tasks, key=lambda state: state['started'])
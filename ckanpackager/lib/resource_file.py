@@ -1,5 +1,8 @@
 import os
+import csv
+import json
 import time
+import fcntl
 import shlex
 import shutil
 import hashlib
@@ -8,6 +11,21 @@ import unicodecsv
 import subprocess
 from urlparse import urlparse
 
+from ckanpackager.lib.blob_store import BlobStore, content_digest, file_digest
+from ckanpackager.lib.build_lock import BuildLock
+from ckanpackager.lib.cache_index import CacheIndex
+from ckanpackager.lib.compressed_writer import CompressedWriter, EXTENSIONS
+from ckanpackager.lib.parquet_sink import ParquetSink
+from ckanpackager.lib.pending_recipients import PendingRecipients
+from ckanpackager.lib.shard_parts import ShardParts
+from ckanpackager.lib.xlsx_sink import XlsxSink
+from ckanpackager.lib.zip_stream import ZipStreamWriter
+
+
+# the prefix of the names of the folders, in the temporary directory, in which resumable resources
+# are built (see ResourceFile.open_resumable)
+RESUME_FOLDER_PREFIX = 'ckanpackager-'
+
 
 class ArchiveError(Exception):
     """Exception raised when we fail to build the ZIP file"""
@@ -16,7 +34,8 @@ class ArchiveError(Exception):
 
 class ResourceFile():
     """Represents and builds a ZIP resource file from given request parameters"""
-    def __init__(self, request_params, root, temp_dir, cache_time):
+    def __init__(self, request_params, root, temp_dir, cache_time, archive_writer='command',
+                 zip_workers=1, deduplicate=False):
         """Create a new Resource File
 
         @param request_params: Dictionary of parameters defining the request
@@ -24,14 +43,49 @@ class ResourceFile():
         @param temp_dir: Directory in which we can create temporary folder
                          for generating the resource
         @param cache_time: Time (in second) for which a file is valid for the same request
+        @param archive_writer: How the ZIP file is built: 'command' runs the
+                               ZIP command on each file, 'builtin' writes the
+                               archive in process and can stream files
+                               straight into it (see get_writer)
+        @param zip_workers: Number of threads compressing the files when the
+                            builtin archive writer is used
+        @param deduplicate: If True, a ZIP file holding the same files as one
+                            already in the store is replaced by a hard link
+                            to it (see BlobStore)
         """
         self.request_params = request_params
         self.temp_dir = temp_dir
         self.root = root
         self.cache_time = cache_time
+        self.archive_writer = archive_writer
+        self.zip_workers = zip_workers
+        self.deduplicate = deduplicate
+        self.index = CacheIndex(root)
+        self.blob_store = BlobStore(root)
+        # the number of bytes saved by linking the ZIP file to an identical one
+        self.saved_bytes = 0
+        # a description of the content of the ZIP file recorded in the cache
+        # index when it is created, if set
+        self.manifest = None
+        # the version of the upstream data, see set_version
+        self.version = None
+        self.version_max_age = None
+        # when we started, to record how long the ZIP file took to build (see
+        # start_build)
+        self._started = time.time()
         self.working_folder = None
         self.zip_file_name = None
         self.writers = {}
+        # the archive being built by the builtin writer, and the name it will
+        # be given once complete
+        self.archive = None
+        self._archive_name = None
+        # the names of the files written straight into the archive
+        self.streamed = set()
+        # set when the resource is built in a resumable folder, see open_resumable
+        self.resume_folder = None
+        self._resume_key = None
+        self._resume_lock = None
 
     @property
     def format(self):
@@ -54,6 +108,59 @@ class ResourceFile():
         """
         return self.zip_file_name
 
+    def set_version(self, version, max_age):
+        """Set the version of the upstream data the ZIP file is built from
+
+        The version is recorded in the cache index along with the file, and
+        cached files are then only used if they were built from the same
+        version - for up to max_age seconds rather than cache_time.
+
+        @param version: A token identifying the version of the upstream data
+        @param max_age: The maximum age (in seconds) of a cached file
+        """
+        self.version = version
+        self.version_max_age = max_age
+
+    def start_build(self):
+        """Record that the ZIP file is starting to be built, once the build
+        lock is held, so that the time spent waiting for it isn't counted in
+        the time the file took to build (see CacheIndex)
+        """
+        self._started = time.time()
+
+    def build_lock(self):
+        """Return the lock to hold while building the ZIP file
+
+        Tasks building the same file (ie. with the same request parameters,
+        bar the email address) should hold this lock while doing so, and check
+        again whether the file exists once they have it. See
+        pending_recipients.
+
+        @return: A BuildLock
+        """
+        return BuildLock(self.root, self._base_name())
+
+    def pending_recipients(self):
+        """Return the list of recipients waiting for the ZIP file
+
+        Tasks that find the file is being built by another task (ie. they
+        can't get the build lock) add their email address to this list, for
+        the other task to send the link to.
+
+        @return: A PendingRecipients
+        """
+        return PendingRecipients(self.root, self._base_name())
+
+    def shard_parts(self):
+        """Return the parts of the file fetched in shards
+
+        Large datastore packages can be fetched by several tasks, each writing
+        a part of the records, and then merged. See DatastorePackageTask.
+
+        @return: A ShardParts
+        """
+        return ShardParts(self.root, self._base_name())
+
     def set_zip_file_name(self, zip_file_name):
         """Force-set the zip file name.
 
@@ -69,6 +176,7 @@ class ResourceFile():
         :return: the number of lines in the file. 0 is returned if the file doesn't exist
         """
         name = self.clean_name(name)
+        self._check_not_streamed(name)
 
         # ensure all data has been flushed from the writer for this file before we attempt to count
         if name in self.writers and not self.writers[name].closed:
@@ -88,6 +196,7 @@ class ResourceFile():
         :param name: the name of the file
         """
         name = self.clean_name(name)
+        self._check_not_streamed(name)
 
         # ensure all data has been flushed from the writer for this file and close it
         if name in self.writers and not self.writers[name].closed:
@@ -103,9 +212,12 @@ class ResourceFile():
         mapping = {
             'csv': ',',
             'tsv': '\t',
-            # if the format is xlsx then we're going to output a csv and then convert it after, so
-            # use a comma as the delimiter
+            # xlsx, parquet and jsonl records are written to files of their own (see
+            # get_xlsx_writer and get_parquet_writer), any csv file written alongside uses a comma
+            # as the delimiter
             'xlsx': ',',
+            'parquet': ',',
+            'jsonl': ',',
         }
         return mapping.get(self.format)
 
@@ -132,29 +244,76 @@ class ResourceFile():
             mapping = {
                 'csv': '.csv',
                 'tsv': '.tsv',
-                # as with the get_delimiter function above, if we get an xlsx request we're going to
-                # output the data in csv format and then convert it later
+                # as with the get_delimiter function above, csv files written alongside the records
+                # of the other formats keep their extension
                 'xlsx': '.csv',
+                'parquet': '.csv',
+                'jsonl': '.csv',
             }
             name = name[:-4] + mapping[self.format]
 
         return name
 
-    def get_writer(self, name=None):
+    def get_writer(self, name=None, stream=False, compression=None):
         """Get a writer for the given file name in the resource.
 
         Note that writers are automatically closed when clean_work_files is
         called.
 
         @param name: Name of file to create, or None
+        @param stream: If True and the builtin archive writer is used, the
+                       file is written straight into the archive rather than
+                       to the working folder, when possible (only one file
+                       can be streamed at a time, files can't be streamed
+                       while the resource is resumable or when its records
+                       are written to an xlsx or parquet file).
+                       Streamed files can't be read back, counted or deleted.
+        @param compression: If set ('gzip' or 'zstd'), the data is compressed
+                            as it is written, by a CompressedWriter. The name
+                            should have the matching extension, so that the
+                            file is stored in the archive as it is. The file
+                            is only complete once the writer is closed.
         """
         self._create_working_folder()
         name = self.clean_name(name)
         if name not in self.writers:
-            self.writers[name] = open(os.path.join(self.working_folder, name), 'wb')
+            if stream and self._can_stream():
+                writer = self._open_archive().open(name, not self._compressed(name))
+                self.streamed.add(name)
+            else:
+                writer = open(os.path.join(self.working_folder, name), 'wb')
+            if compression is not None:
+                writer = CompressedWriter(writer, compression)
+            self.writers[name] = writer
         return self.writers[name]
 
-    def get_csv_writer(self, name=None):
+    def get_xlsx_writer(self, name):
+        """Get an XlsxSink writing the given xlsx file in the resource, see
+        get_csv_writer. The workbook is saved when the writer is closed.
+
+        @param name: Name of the file to create
+        """
+        self._create_working_folder()
+        if name not in self.writers:
+            self.writers[name] = XlsxSink(os.path.join(self.working_folder, name))
+        return self.writers[name]
+
+    def get_parquet_writer(self, name, fields=None, **kwargs):
+        """Get a ParquetSink writing the given parquet file in the resource,
+        see get_csv_writer. The file is complete once the writer is closed.
+
+        @param name: Name of the file to create
+        @param fields: List of datastore field dicts, the columns of the file.
+                       Only used when the writer is created.
+        @param kwargs: Other parameters of ParquetSink
+        """
+        self._create_working_folder()
+        if name not in self.writers:
+            self.writers[name] = ParquetSink(os.path.join(self.working_folder, name), fields,
+                                             **kwargs)
+        return self.writers[name]
+
+    def get_csv_writer(self, name=None, stream=False, encoded=False):
         """Get a CSV writer for the given file name in the resource.
 
         If name is not defined, this will:
@@ -166,9 +325,21 @@ class ResourceFile():
         called.
 
         @param name: Name of file to create, or None
+        @param stream: Whether to stream the file into the archive when
+                       possible, see get_writer
+        @param encoded: If True, the rows written are already made of UTF-8
+                        byte strings (see RowProjector), and a plain csv
+                        writer, which doesn't convert each cell, is returned
         """
+        if encoded:
+            return csv.writer(
+                self.get_writer(name, stream),
+                delimiter=self.get_delimiter(),
+                quotechar='"',
+                lineterminator="\n"
+            )
         return unicodecsv.writer(
-            self.get_writer(name),
+            self.get_writer(name, stream),
             encoding='utf-8',
             delimiter=self.get_delimiter(),
             quotechar='"',
@@ -178,44 +349,265 @@ class ResourceFile():
     def create_zip(self, zip_command):
         """Create the ZIP file from the files added to this resource
 
-        @param zip_command: Shell ZIP command. {input} and {output} are replaced with the relevant file names
+        The archive is built under a hidden name in the store directory, and
+        only renamed to its final name once complete so that a partial
+        archive is never served.
+
+        When deduplicating, the digest of the files in the archive is computed
+        as it is built, and if an archive with the same files is already
+        stored the new one is discarded and linked to it instead.
+
+        @param zip_command: Shell ZIP command. {input} and {output} are replaced with the relevant
+                            file names. Not used by the builtin archive writer.
         """
         # Ensure we flush all the writers
         for w in self.writers:
             if not self.writers[w].closed:
                 self.writers[w].flush()
-        #FIXME the task should be given a unique worker id rather than rely on this
-        worker_id = os.getpid()
-        zip_file_name = "{base}-{pid}-{time}.zip".format(
-            base=os.path.join(self.root, self._base_name()),
-            pid=worker_id,
-            time=int(time.time())
-        )
-        for resource_file in os.listdir(self.working_folder):
-            cmd = shlex.split(zip_command)
-            for i, v in enumerate(cmd):
-                if v == '{input}':
-                    cmd[i] = os.path.join(self.working_folder, resource_file)
-                if v == '{output}':
-                    cmd[i] = zip_file_name
-            # FIXME: Should we implement a timeout?
-            ret_code = subprocess.Popen(cmd).wait()
-            if ret_code != 0:
-                raise ArchiveError("Failed to create ZIP archive")
+        if self.archive_writer == 'builtin':
+            archive = self._open_archive()
+            # finish the streamed files before adding the others
+            for name in self.streamed:
+                self.writers[name].close()
+            for resource_file in os.listdir(self.working_folder):
+                archive.write_file(os.path.join(self.working_folder, resource_file),
+                                   compress=not self._compressed(resource_file))
+            archive.close()
+            self.archive = None
+            temp_file_name = archive.path
+            zip_file_name = self._archive_name
+            entry_digests = archive.digests
+        else:
+            zip_file_name = self._new_zip_file_name()
+            temp_file_name = self._temp_zip_file_name(zip_file_name)
+            try:
+                for resource_file in os.listdir(self.working_folder):
+                    cmd = shlex.split(zip_command)
+                    if self._compressed(resource_file) and \
+                            os.path.basename(cmd[0]) == 'zip':
+                        # store files that are already compressed as they are
+                        cmd.insert(1, '-0')
+                    for i, v in enumerate(cmd):
+                        if v == '{input}':
+                            cmd[i] = os.path.join(self.working_folder, resource_file)
+                        if v == '{output}':
+                            cmd[i] = temp_file_name
+                    # FIXME: Should we implement a timeout?
+                    ret_code = subprocess.Popen(cmd).wait()
+                    if ret_code != 0:
+                        raise ArchiveError("Failed to create ZIP archive")
+            except Exception:
+                if os.path.exists(temp_file_name):
+                    os.remove(temp_file_name)
+                raise
+            entry_digests = None
+            if self.deduplicate:
+                entry_digests = dict(
+                    (name, file_digest(os.path.join(self.working_folder, name)))
+                    for name in os.listdir(self.working_folder)
+                )
+        blob = None
+        if entry_digests is None:
+            os.rename(temp_file_name, zip_file_name)
+        else:
+            blob = content_digest(entry_digests)
+            size = os.path.getsize(temp_file_name)
+            if self.blob_store.store(temp_file_name, blob, zip_file_name):
+                self.saved_bytes = size
+            if not os.path.exists(self.blob_store.path(blob)) or \
+                    not os.path.samefile(zip_file_name, self.blob_store.path(blob)):
+                # it couldn't be linked to the blob
+                blob = None
         self.zip_file_name = zip_file_name
+        self.index.add(self._base_name(), zip_file_name, self.manifest,
+                       time.time() - self._started, blob, self.version)
+
+    def clean_work_files(self, keep_resumable=False):
+        """Clean up temp files
 
-    def clean_work_files(self):
-        """Clean up temp files"""
+        @param keep_resumable: If True and the resource is being built in a
+                               resumable folder holding a checkpoint, the
+                               folder is kept so that a later attempt can
+                               resume from it
+        """
         # Ensure all writers are closed
         for w in self.writers:
-            if not self.writers[w].closed:
+            if w not in self.streamed and not self.writers[w].closed:
                 self.writers[w].close()
         self.writers.clear()
+        self.streamed.clear()
+        # Remove the archive if it wasn't completed
+        if self.archive is not None:
+            self.archive.abort()
+            self.archive = None
+        if self.resume_folder is not None:
+            if not (keep_resumable and os.path.exists(self._checkpoint_path())):
+                shutil.rmtree(self.resume_folder, True)
+            # release the folder for the next attempt
+            self._resume_lock.close()
+            self._resume_lock = None
+            self.resume_folder = None
         # Remove the temp working folder
-        if self.working_folder and os.path.exists(self.working_folder):
+        elif self.working_folder and os.path.exists(self.working_folder):
             shutil.rmtree(self.working_folder, True)
         self.working_folder = None
 
+    def open_resumable(self, key):
+        """Build the resource in a working folder named after the request
+        rather than in a new temporary folder, so that the files written so
+        far survive a failure and can be resumed from by a later attempt at
+        the same request. This must be called before any writers are
+        created.
+
+        If the folder holds a checkpoint (see save_checkpoint) saved with the
+        same key and less than cache_time seconds ago, the files are restored
+        to the state they were in when the checkpoint was saved and writers
+        appending to them are opened. Otherwise the folder is emptied.
+
+        If another process is already using the folder, a new temporary
+        folder is used instead and the resource can't be resumed.
+
+        @param key: JSON serialisable value describing how the files are
+                    written (for example their columns). Checkpoints saved
+                    with a different key are discarded.
+        @return: The state saved with the checkpoint being resumed from, or
+                 None if the resource is built from scratch
+        """
+        resume_folder = os.path.join(self.temp_dir,
+                                     RESUME_FOLDER_PREFIX + self._base_name())
+        if not os.path.isdir(resume_folder):
+            try:
+                os.mkdir(resume_folder)
+            except OSError:
+                # someone else just created it
+                pass
+        lock = open(os.path.join(resume_folder, 'lock'), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock.close()
+            self._create_working_folder()
+            return None
+
+        self.resume_folder = resume_folder
+        self._resume_key = key
+        self._resume_lock = lock
+        self.working_folder = os.path.join(resume_folder, 'files')
+        checkpoint = self._load_checkpoint()
+        if checkpoint is None or checkpoint['key'] != key:
+            shutil.rmtree(self.working_folder, True)
+            if os.path.exists(self._checkpoint_path()):
+                os.remove(self._checkpoint_path())
+            os.mkdir(self.working_folder)
+            return None
+
+        for name in os.listdir(self.working_folder):
+            if name not in checkpoint['files']:
+                os.remove(os.path.join(self.working_folder, name))
+        for name, size in checkpoint['files'].items():
+            writer = open(os.path.join(self.working_folder, name), 'ab')
+            writer.truncate(size)
+            self.writers[name] = writer
+        return checkpoint['state']
+
+    def save_checkpoint(self, state):
+        """Record the current size of the files being written along with the
+        given state, so that a later attempt can resume from this point (see
+        open_resumable). This does nothing unless open_resumable succeeded.
+
+        @param state: JSON serialisable dict describing how far the resource
+                      has been built
+        """
+        if self.resume_folder is None:
+            return
+        files = {}
+        for name, writer in self.writers.items():
+            if not writer.closed:
+                writer.flush()
+                files[name] = os.fstat(writer.fileno()).st_size
+        checkpoint = {
+            'key': self._resume_key,
+            'files': files,
+            'state': state,
+        }
+        # write the checkpoint next to the old one and swap them, so that a
+        # crash never leaves a partially written checkpoint behind
+        temp_path = self._checkpoint_path() + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.rename(temp_path, self._checkpoint_path())
+
+    def _checkpoint_path(self):
+        """Return the path of the checkpoint file in the resumable folder"""
+        return os.path.join(self.resume_folder, 'checkpoint.json')
+
+    def _load_checkpoint(self):
+        """Load the checkpoint from the resumable folder
+
+        @return: The checkpoint dict, or None if there isn't a valid one
+        """
+        path = self._checkpoint_path()
+        if not os.path.exists(path) or \
+                time.time() - os.path.getmtime(path) >= self.cache_time:
+            return None
+        try:
+            with open(path) as f:
+                checkpoint = json.load(f)
+        except ValueError:
+            return None
+        for name, size in checkpoint['files'].items():
+            # the files may have been modified after the checkpoint was saved
+            # (when being finalized for instance), but not shortened
+            full_path = os.path.join(self.working_folder, name)
+            if not os.path.exists(full_path) or os.path.getsize(full_path) < size:
+                return None
+        return checkpoint
+
+    def _can_stream(self):
+        """Return True if a file can be written straight into the archive"""
+        return (self.archive_writer == 'builtin' and self.resume_folder is None and
+                self.format not in ('xlsx', 'parquet') and
+                (self.archive is None or self.archive.current is None))
+
+    @staticmethod
+    def _compressed(name):
+        """Return True if the given file is already compressed, and so isn't
+        compressed again in the archive"""
+        return name.endswith(tuple(EXTENSIONS.values()))
+
+    def _check_not_streamed(self, name):
+        """Raise an error if the given file is being streamed into the archive"""
+        if name in self.streamed:
+            raise ArchiveError("{} has been written to the archive".format(name))
+
+    def _open_archive(self):
+        """Start the archive of the builtin archive writer, if not done yet
+
+        @return: The ZipStreamWriter
+        """
+        if self.archive is None:
+            self._archive_name = self._new_zip_file_name()
+            self.archive = ZipStreamWriter(self._temp_zip_file_name(self._archive_name),
+                                           workers=self.zip_workers,
+                                           digests=self.deduplicate)
+        return self.archive
+
+    def _new_zip_file_name(self):
+        """Return the full name to give to a new ZIP file"""
+        #FIXME the task should be given a unique worker id rather than rely on this
+        worker_id = os.getpid()
+        return "{base}-{pid}-{time}.zip".format(
+            base=os.path.join(self.root, self._base_name()),
+            pid=worker_id,
+            time=int(time.time())
+        )
+
+    @staticmethod
+    def _temp_zip_file_name(zip_file_name):
+        """Return the hidden name under which the given ZIP file is built"""
+        folder, name = os.path.split(zip_file_name)
+        return os.path.join(folder, '.{}.part'.format(name))
+
     def _create_working_folder(self):
         """Creates a temporary working folder"""
         if self.working_folder is None:
@@ -228,14 +620,9 @@ class ResourceFile():
 
         @return: The full file name, or None
         """
-        zip_base = self._base_name()
-        for base_name in os.listdir(self.root):
-            if base_name.startswith(zip_base):
-                file_name = os.path.join(self.root, base_name)
-                mtime = os.path.getmtime(file_name)
-                if (time.time() - mtime) < self.cache_time:
-                    return file_name
-        return None
+        if self.version is not None:
+            return self.index.lookup(self._base_name(), self.version_max_age, self.version)
+        return self.index.lookup(self._base_name(), self.cache_time)
 
     def _base_name(self):
         """Return the base name for the ZIP file
@@ -250,3 +637,45 @@ class ResourceFile():
                 continue
             md5.update(str(key) + ':' + str(self.request_params[key]) + ';')
         return md5.hexdigest()
+
+
+def remove_stale_resume_folders(temp_dir, older_than):
+    """Remove the folders of resumable resources (see
+    ResourceFile.open_resumable) that haven't been checkpointed for a while
+    and aren't in use, eg. because the task building the resource failed
+    for good
+
+    @param temp_dir: The temporary directory the folders are in
+    @param older_than: Timestamp before which folders were last
+                       checkpointed to be removed
+    @return: The number of folders removed
+    """
+    if not os.path.isdir(temp_dir):
+        return 0
+    count = 0
+    for name in os.listdir(temp_dir):
+        path = os.path.join(temp_dir, name)
+        if not name.startswith(RESUME_FOLDER_PREFIX) or not os.path.isdir(path):
+            continue
+        checkpoint = os.path.join(path, 'checkpoint.json')
+        try:
+            last_used = os.path.getmtime(path)
+            if os.path.exists(checkpoint):
+                last_used = max(last_used, os.path.getmtime(checkpoint))
+            if last_used >= older_than:
+                continue
+            lock = open(os.path.join(path, 'lock'), 'a')
+        except (IOError, OSError):
+            continue
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            # a task is building the resource
+            lock.close()
+            continue
+        try:
+            shutil.rmtree(path, True)
+        finally:
+            lock.close()
+        count += 1
+    return count
@@ -0,0 +1,52 @@
+"""Turns datastore records into CSV rows"""
+from operator import itemgetter
+
+
+class RowProjector(object):
+    """
+    Extracts the given fields from records, in order, as rows of byte strings ready to be written
+    by a plain csv writer (see ResourceFile.get_csv_writer). The cells are the same as unicodecsv
+    would write: fields missing from a record are empty and unicode values are encoded.
+
+    The fields are extracted with a single itemgetter built once for all the records, only falling
+    back to a lookup per field for the records missing some of them.
+    """
+
+    def __init__(self, fields, encoding='utf-8'):
+        """
+        :param fields: the names of the fields to extract
+        :param encoding: the encoding of the unicode values, or None to leave the values as they are
+                         (eg. for an XlsxSink)
+        """
+        self.fields = list(fields)
+        self.encoding = encoding
+        if len(self.fields) > 1:
+            self._get = itemgetter(*self.fields)
+        elif self.fields:
+            # itemgetter returns the value itself, rather than a tuple, when given a single key
+            field = self.fields[0]
+            self._get = lambda record: (record[field],)
+        else:
+            self._get = lambda record: ()
+
+    def project(self, record):
+        """
+        :param record: the record dictionary
+        :return: the row, as a list
+        """
+        try:
+            values = self._get(record)
+        except KeyError:
+            values = [record.get(field, None) for field in self.fields]
+        encoding = self.encoding
+        if encoding is None:
+            return list(values)
+        return [v.encode(encoding) if isinstance(v, unicode) else v for v in values]
+
+    def rows(self, records):
+        """
+        :param records: an iterable of record dictionaries, eg. a page of records
+        :return: the list of their rows, to be passed to a csv writer's writerows
+        """
+        project = self.project
+        return [project(record) for record in records]
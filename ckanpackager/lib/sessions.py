@@ -0,0 +1,56 @@
+"""Pooled HTTP sessions shared by the requests made from a worker process"""
+import threading
+from urlparse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# sessions are shared between all the tasks run by a worker process, keyed on the API host and the
+# pool options. They are created lazily so that each forked celery worker gets its own
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(url, pool_size=10, keep_alive=True):
+    """
+    Return the pooled session to use for requests to the host of the given URL, creating it if
+    needed.
+
+    :param url: a URL on the host we want to talk to
+    :param pool_size: the maximum number of connections kept open to the host
+    :param keep_alive: if False, connections are closed after each request
+    :return: a requests.Session object
+    """
+    key = (urlparse(url).netloc, pool_size, keep_alive)
+    with _sessions_lock:
+        if key not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            if not keep_alive:
+                session.headers['Connection'] = 'close'
+            _sessions[key] = session
+        return _sessions[key]
+
+
+def connection_count(session, url):
+    """
+    Return the number of connections the session has opened so far to the host of the given URL.
+    Comparing this before and after a request tells us whether the request had to set up a new
+    connection or reused a kept-alive one.
+
+    :param session: a session returned by get_session
+    :param url: the URL being requested
+    :return: the number of connections opened
+    """
+    adapter = session.get_adapter(url)
+    return adapter.poolmanager.connection_from_url(url).num_connections
+
+
+def reset_sessions():
+    """Close and forget all the pooled sessions"""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
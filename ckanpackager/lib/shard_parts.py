@@ -0,0 +1,179 @@
+"""The parts of a package fetched in shards by several tasks"""
+import errno
+import os
+import shutil
+import uuid
+
+from ckanpackager.lib.cache_index import INDEX_FOLDER
+
+# the folder, in the store directory, holding the parts of the packages being built in shards
+SHARD_FOLDER = os.path.join(INDEX_FOLDER, 'shards')
+# the name of the file marking the shards of a package as being fetched, see ShardParts.claim
+CLAIM_FILE = 'claimed'
+
+
+def shard_ranges(offset, count, shard_size, max_shards):
+    """
+    Split a range of records into shards of about the same size.
+
+    :param offset: the offset of the first record
+    :param count: the number of records
+    :param shard_size: the number of records from which a shard is added
+    :param max_shards: the maximum number of shards
+    :return: a list of (offset, number of records) tuples, in order
+    """
+    shards = max(1, min(max_shards, -(-count // shard_size)))
+    size = -(-count // shards)
+    return [(offset + start, min(size, count - start)) for start in range(0, count, size)]
+
+
+class ShardParts(object):
+    """
+    The parts of a package being built in shards, one file per shard. These are kept in the store
+    directory so that they are shared by all the workers: each shard task writes its own part, and
+    the task merging them reads them all.
+
+    Parts are written to a temporary file and renamed once complete, so a part that exists is
+    complete. A shard task that is retried, or repeated by an identical request, can therefore skip
+    its part if it exists.
+    """
+
+    def __init__(self, root, key):
+        """
+        :param root: the store directory
+        :param key: the key of the request, ie. the base name of its ZIP file
+        """
+        self.folder = os.path.join(root, SHARD_FOLDER, key)
+
+    def claim(self):
+        """
+        Claim fetching the shards, so that identical requests arriving meanwhile don't fetch them
+        again. The claim lasts until it is released or the parts are removed.
+
+        :return: True if the shards were claimed, False if another task has claimed them
+        """
+        if not os.path.isdir(self.folder):
+            try:
+                os.makedirs(self.folder)
+            except OSError:
+                # someone else just created it
+                pass
+        try:
+            os.close(os.open(os.path.join(self.folder, CLAIM_FILE),
+                             os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+        return True
+
+    def release(self):
+        """Release a claim made with claim, leaving the parts"""
+        try:
+            os.remove(os.path.join(self.folder, CLAIM_FILE))
+        except OSError:
+            pass
+
+    def path(self, index):
+        """
+        :param index: the index of the shard
+        :return: the path of the shard's part
+        """
+        return os.path.join(self.folder, 'part-{:05d}'.format(index))
+
+    def exists(self, index):
+        """
+        :param index: the index of the shard
+        :return: True if the shard's part has been written
+        """
+        return os.path.exists(self.path(index))
+
+    def open(self, index):
+        """
+        Open a temporary file to write the part of a shard to, see commit.
+
+        :param index: the index of the shard
+        :return: the file object
+        """
+        if not os.path.isdir(self.folder):
+            try:
+                os.makedirs(self.folder)
+            except OSError:
+                # someone else just created it
+                pass
+        return open('{}.{}.tmp'.format(self.path(index), uuid.uuid4().hex), 'wb')
+
+    def commit(self, index, part_file, count):
+        """
+        Close a file opened with open, and give it the name of the shard's part.
+
+        :param index: the index of the shard
+        :param part_file: the file object
+        :param count: the number of records in the part
+        """
+        part_file.close()
+        with open('{}.count'.format(self.path(index)), 'w') as f:
+            f.write(str(count))
+        os.rename(part_file.name, self.path(index))
+
+    def count(self, index):
+        """
+        :param index: the index of the shard
+        :return: the number of records in the shard's part
+        """
+        with open('{}.count'.format(self.path(index))) as f:
+            return int(f.read())
+
+    def discard(self, part_file):
+        """
+        Close and remove a file opened with open, when the shard failed.
+
+        :param part_file: the file object
+        """
+        part_file.close()
+        try:
+            os.remove(part_file.name)
+        except OSError:
+            pass
+
+    def copy(self, count, output):
+        """
+        Copy the parts, in order, to the given file object, as they are.
+
+        :param count: the number of shards
+        :param output: the file object to write to
+        """
+        for index in range(count):
+            with open(self.path(index), 'rb') as part:
+                shutil.copyfileobj(part, output, 1024 * 1024)
+
+    def remove(self):
+        """Remove all the parts"""
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def remove_stale_shards(root, older_than):
+    """
+    Remove the parts of the packages whose shards haven't been written to for a while, eg. because
+    the merge task failed.
+
+    :param root: the store directory
+    :param older_than: timestamp before which parts were last written to be removed
+    :return: the number of packages whose parts were removed
+    """
+    folder = os.path.join(root, SHARD_FOLDER)
+    if not os.path.isdir(folder):
+        return 0
+    count = 0
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        try:
+            last_written = max([os.path.getmtime(path)] +
+                               [os.path.getmtime(os.path.join(path, part))
+                                for part in os.listdir(path)])
+        except OSError:
+            continue
+        if last_written < older_than:
+            shutil.rmtree(path, ignore_errors=True)
+            count += 1
+    return count
@@ -0,0 +1,58 @@
+"""Limits on the number of tasks running at the same time for a CKAN host or a requester"""
+import random
+import re
+
+from ckanpackager.lib.build_lock import BuildLock
+
+
+def _slot_key(name, index):
+    """Return the lock key of the given slot, made safe to use as a file name"""
+    return 'slot-{}-{}'.format(re.sub(r'[^\w.-]', '_', name), index)
+
+
+class TaskSlots(object):
+    """
+    The slots a task must hold while it runs: one for each of the limits that apply to it (eg. one
+    for its CKAN host and one for the email domain of its requester). A limit of N means at most N
+    tasks hold one of its slots at the same time.
+
+    Each slot is a lock file (see BuildLock), so limits are shared by all the workers using the same
+    store directory, and slots held by a worker that dies are freed with it.
+    """
+
+    def __init__(self, root, limits):
+        """
+        :param root: the store directory
+        :param limits: a list of (name, number of slots) tuples, one for each limit. Limits whose
+                       number of slots is None don't apply.
+        """
+        self.root = root
+        self.limits = [(name, size) for name, size in limits if size is not None]
+        self._held = []
+
+    def acquire(self):
+        """
+        Acquire a free slot of each limit, without waiting.
+
+        :return: True if the slots were acquired, False (holding none of them) if a limit has no
+                 free slot
+        """
+        for name, size in self.limits:
+            indexes = range(size)
+            # tasks trying in a random order are less likely to compete for the same slot
+            random.shuffle(indexes)
+            for index in indexes:
+                lock = BuildLock(self.root, _slot_key(name, index))
+                if lock.acquire():
+                    self._held.append(lock)
+                    break
+            else:
+                self.release()
+                return False
+        return True
+
+    def release(self):
+        """Release the slots held"""
+        for lock in self._held:
+            lock.release()
+        self._held = []
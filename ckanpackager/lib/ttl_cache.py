@@ -0,0 +1,56 @@
+"""A small in-memory cache whose entries expire after a while"""
+import threading
+import time
+
+
+class TTLCache(object):
+    """
+    Keeps values for a fixed number of seconds. When full, the entries closest to expiry are
+    dropped to make room for new ones. This is safe to use from several threads.
+    """
+
+    def __init__(self, ttl, max_size=1000):
+        """
+        :param ttl: the number of seconds for which values are kept
+        :param max_size: the maximum number of values kept
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        # key -> (expiry time, value)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        :param key: the key of the value
+        :param default: the value to return if there is no (unexpired) value for the key
+        :return: the value for the key
+        """
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                return default
+            if entry[0] <= time.time():
+                del self._entries[key]
+                return default
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """
+        :param key: the key of the value
+        :param value: the value
+        :param ttl: the number of seconds for which to keep this value, if not the default
+        """
+        with self._lock:
+            now = time.time()
+            if key not in self._entries and len(self._entries) >= self.max_size:
+                for expired in [k for k, (expiry, _v) in self._entries.items() if expiry <= now]:
+                    del self._entries[expired]
+                if len(self._entries) >= self.max_size:
+                    del self._entries[min(self._entries, key=lambda k: self._entries[k][0])]
+            self._entries[key] = (now + (self.ttl if ttl is None else ttl), value)
+
+    def clear(self):
+        """Drop all the values"""
+        with self._lock:
+            self._entries.clear()
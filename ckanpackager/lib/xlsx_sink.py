@@ -0,0 +1,84 @@
+"""Writes rows straight into the worksheets of an xlsx workbook"""
+from openpyxl import Workbook
+
+# the maximum number of rows of an Excel worksheet
+MAX_SHEET_ROWS = 1048576
+# the types of the values written to cells as they are, others (eg. lists) are written as text
+_CELL_TYPES = frozenset([unicode, str, int, long, float, bool, type(None)])
+
+
+class XlsxSink(object):
+    """
+    Writes rows to an xlsx workbook as they are given, keeping the type of their values: numbers
+    are written as numbers, text as text. Values of other types (eg. lists) are written as text.
+
+    The workbook is write only, so rows are written out to temporary files as they are added and
+    memory use doesn't grow with their number (see
+    https://openpyxl.readthedocs.io/en/stable/optimized.html#write-only-mode). When a worksheet is
+    full, the rows carry on in a new one ('Data 2', 'Data 3'...) starting with the same header.
+
+    It has the writerow and writerows methods of csv writers, and the flush and close methods and
+    the closed attribute of file objects, so that it can be one of the writers of a ResourceFile.
+    The first row written is the header. The workbook is saved when the sink is closed.
+    """
+
+    def __init__(self, path, sheet_name='Data', max_rows=MAX_SHEET_ROWS):
+        """
+        :param path: the path of the xlsx file
+        :param sheet_name: the name of the first worksheet, and the base name of the others
+        :param max_rows: the maximum number of rows of a worksheet, header included
+        """
+        self.path = path
+        self.sheet_name = sheet_name
+        self.max_rows = max_rows
+        self.closed = False
+        # the number of worksheets
+        self.sheets = 0
+        self._workbook = Workbook(write_only=True)
+        self._header = None
+        self._sheet = None
+        # the number of rows of the current worksheet
+        self._rows = 0
+
+    def _add_sheet(self):
+        """Start a new worksheet, with the header"""
+        self.sheets += 1
+        title = self.sheet_name
+        if self.sheets > 1:
+            title = u'{} {}'.format(self.sheet_name, self.sheets)
+        self._sheet = self._workbook.create_sheet(title)
+        self._sheet.append(self._header or [])
+        self._rows = 1
+
+    def writerow(self, row):
+        """
+        :param row: the list of values of the row, the first one being the header
+        """
+        self.writerows([row])
+
+    def writerows(self, rows):
+        """
+        :param rows: an iterable of lists of values
+        """
+        for row in rows:
+            if self._header is None:
+                self._header = list(row)
+                self._add_sheet()
+                continue
+            if self._rows >= self.max_rows:
+                self._add_sheet()
+            self._sheet.append([v if v.__class__ in _CELL_TYPES else unicode(v) for v in row])
+            self._rows += 1
+
+    def flush(self):
+        """Nothing to do, rows are flushed to the temporary files by the workbook"""
+        pass
+
+    def close(self):
+        """Save the workbook"""
+        if self.closed:
+            return
+        if self._sheet is None:
+            self._add_sheet()
+        self._workbook.save(self.path)
+        self.closed = True
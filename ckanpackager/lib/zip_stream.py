@@ -0,0 +1,311 @@
+"""Writing ZIP archives sequentially, with entries compressed as their data is written"""
+import collections
+import hashlib
+import os
+import struct
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+
+# signatures of the ZIP records we write
+_LOCAL_HEADER = 0x04034b50
+_DATA_DESCRIPTOR = 0x08074b50
+_CENTRAL_HEADER = 0x02014b50
+_ZIP64_END = 0x06064b50
+_ZIP64_LOCATOR = 0x07064b50
+_END = 0x06054b50
+
+# general purpose flags: sizes and CRC in a data descriptor after the data, UTF-8 names
+_FLAGS = 0x08 | 0x800
+_STORED = 0
+_DEFLATED = 8
+# version 4.5 of the spec is needed for ZIP64, made on unix
+_VERSION = 45
+_MADE_BY = (3 << 8) | _VERSION
+_ZIP64_EXTRA = 0x0001
+
+# an empty final deflate block, which ends the deflate streams of blocks compressed in parallel
+_FINAL_BLOCK = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS).flush()
+
+
+def _compress_block(data, level):
+    """
+    Compress a block of data independently of the others. The output ends on a byte boundary and
+    isn't marked as the final block, so the outputs for consecutive blocks can be concatenated into
+    a single deflate stream (which must then be ended with _FINAL_BLOCK).
+
+    :param data: the data to compress
+    :param level: the compression level
+    :return: the compressed data
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ZipEntryWriter(object):
+    """
+    File like object writing data to an entry of a ZipStreamWriter, compressing it on the way. Data
+    is buffered and compressed in blocks of BLOCK_SIZE bytes.
+
+    If the archive has a pool of workers, blocks of PARALLEL_BLOCK_SIZE bytes are compressed
+    independently by the workers, and their outputs are stitched together in order (as pigz does).
+    This costs a little compression, as each block starts without knowledge of the data before it.
+
+    Entries whose data is already compressed can be stored as they are instead.
+    """
+
+    BLOCK_SIZE = 64 * 1024
+    PARALLEL_BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, archive, name, level, compress=True):
+        self.archive = archive
+        self.name = name
+        self.level = level
+        self.method = _DEFLATED if compress else _STORED
+        self.closed = False
+        self.crc = 0
+        self.size = 0
+        self.compressed_size = 0
+        # the SHA-1 digest of the (uncompressed) data, if the archive computes them
+        self.sha1 = hashlib.sha1() if archive.digests is not None else None
+        self._buffer = []
+        self._buffered = 0
+        if archive.pool is None or not compress:
+            self._block_size = self.BLOCK_SIZE
+            self._compressor = None
+            if compress:
+                self._compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        else:
+            self._block_size = self.PARALLEL_BLOCK_SIZE
+            # the blocks being compressed by the workers, in order
+            self._pending = collections.deque()
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self._block_size:
+            self._compress()
+
+    def _compress(self):
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        if self.sha1 is not None:
+            self.sha1.update(data)
+        if self.method == _STORED:
+            self._output(data)
+            return
+        if self.archive.pool is None:
+            self._output(self._compressor.compress(data))
+            return
+        if data:
+            self._pending.append(self.archive.pool.apply_async(_compress_block,
+                                                               (data, self.level)))
+        # write out the blocks that are ready, waiting for the oldest one when enough are queued
+        # to keep all the workers busy (this also caps the memory used by the queued blocks)
+        while self._pending and (self._pending[0].ready() or
+                                 len(self._pending) > 2 * self.archive.workers):
+            self._output(self._pending.popleft().get())
+
+    def _output(self, data):
+        self.compressed_size += len(data)
+        self.archive.file.write(data)
+
+    def flush(self):
+        """
+        Nothing is written to the archive until a whole block has been buffered, this only flushes
+        the archive file.
+        """
+        self.archive.file.flush()
+
+    def close(self):
+        """Finish the entry, the archive can then have other entries added to it"""
+        if self.closed:
+            return
+        self._compress()
+        if self.method == _DEFLATED and self.archive.pool is None:
+            self._output(self._compressor.flush())
+        elif self.method == _DEFLATED:
+            while self._pending:
+                self._output(self._pending.popleft().get())
+            self._output(_FINAL_BLOCK)
+        self.closed = True
+        self.archive._finish_entry(self)
+
+
+class ZipStreamWriter(object):
+    """
+    Writes a ZIP archive sequentially: each entry is compressed as its data is written, so nothing
+    needs to be held in memory or on disk before it goes in the archive. As the size of an entry
+    isn't known when it is started, the sizes and CRC are written in a data descriptor after the
+    data. All the entries use ZIP64 sizes so that there are no limits on their size; ZIP64 records
+    are only added to the central directory when needed.
+
+    Only one entry can be written at a time. With several workers, the entries are compressed by a
+    pool of threads (zlib releases the GIL while compressing).
+    """
+
+    # values at or above these don't fit in the standard fields and need ZIP64 records
+    ZIP64_LIMIT = 0xffffffff
+    ZIP64_COUNT_LIMIT = 0xffff
+
+    def __init__(self, path, level=6, workers=1, digests=False):
+        """
+        :param path: the path of the archive to create
+        :param level: the compression level, from 1 (fastest) to 9 (smallest)
+        :param workers: the number of threads compressing the data (default: 1, the data is
+                        compressed by the thread writing it)
+        :param digests: whether to compute the SHA-1 digest of each entry's data, which are then
+                        available in the digests dictionary
+        """
+        self.path = path
+        self.level = level
+        self.workers = workers
+        self.pool = ThreadPool(workers) if workers > 1 else None
+        self.file = open(path, 'wb')
+        self.closed = False
+        # the entry being written, if any
+        self.current = None
+        # entry name to hex digest of the entries written, if they are computed
+        self.digests = {} if digests else None
+        # (name, header offset, dos time, dos date, compression method, crc, compressed size, size)
+        # for each entry
+        self._entries = []
+
+    def open(self, name, compress=True):
+        """
+        Start a new entry in the archive.
+
+        :param name: the name of the entry
+        :param compress: whether to compress the entry's data, or store it as it is (eg. because it
+                         is already compressed)
+        :return: a ZipEntryWriter to write the entry's data to. It must be closed before another
+                 entry is started.
+        """
+        if self.current is not None:
+            raise ValueError('Entry {} is still being written'.format(self.current.name))
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        entry = ZipEntryWriter(self, name, self.level, compress)
+        entry.offset = self.file.tell()
+        entry.dos_time, entry.dos_date = self._dos_time_and_date(time.time())
+        # the sizes are in the data descriptor, but the ZIP64 extra field must be present for
+        # readers to expect 8 byte sizes in it
+        extra = struct.pack('<HHQQ', _ZIP64_EXTRA, 16, 0, 0)
+        self.file.write(struct.pack('<IHHHHHIIIHH', _LOCAL_HEADER, _VERSION, _FLAGS, entry.method,
+                                    entry.dos_time, entry.dos_date, 0, 0xffffffff, 0xffffffff,
+                                    len(name), len(extra)))
+        self.file.write(name)
+        self.file.write(extra)
+        self.current = entry
+        return entry
+
+    def write_file(self, path, name=None, compress=True):
+        """
+        Add the contents of a file to the archive.
+
+        :param path: the path of the file
+        :param name: the name of the entry (default: the file's base name)
+        :param compress: whether to compress the file, see open
+        """
+        entry = self.open(name or os.path.basename(path), compress)
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(ZipEntryWriter.BLOCK_SIZE)
+                if not data:
+                    break
+                entry.write(data)
+        entry.close()
+
+    def _finish_entry(self, entry):
+        """Write the data descriptor of the entry that has just been written"""
+        crc = entry.crc & 0xffffffff
+        self.file.write(struct.pack('<IIQQ', _DATA_DESCRIPTOR, crc, entry.compressed_size,
+                                    entry.size))
+        if self.digests is not None:
+            self.digests[entry.name] = entry.sha1.hexdigest()
+        self._entries.append((entry.name, entry.offset, entry.dos_time, entry.dos_date, entry.method,
+                              crc, entry.compressed_size, entry.size))
+        self.current = None
+
+    def close(self):
+        """Write the central directory and close the archive file"""
+        if self.closed:
+            return
+        if self.current is not None:
+            self.current.close()
+        directory_offset = self.file.tell()
+        for name, offset, dos_time, dos_date, method, crc, compressed_size, size in self._entries:
+            # only the values that don't fit go in the ZIP64 extra field, in this order
+            zip64 = [value for value in (size, compressed_size, offset)
+                     if self._overflows(value)]
+            extra = ''
+            if zip64:
+                extra = struct.pack('<HH' + 'Q' * len(zip64), _ZIP64_EXTRA, 8 * len(zip64), *zip64)
+            self.file.write(struct.pack('<IHHHHHHIIIHHHHHII', _CENTRAL_HEADER, _MADE_BY, _VERSION,
+                                        _FLAGS, method, dos_time, dos_date, crc,
+                                        self._field(compressed_size), self._field(size),
+                                        len(name), len(extra), 0, 0, 0, 0o100644 << 16,
+                                        self._field(offset)))
+            self.file.write(name)
+            self.file.write(extra)
+        directory_end = self.file.tell()
+        directory_size = directory_end - directory_offset
+        count = len(self._entries)
+
+        if count >= self.ZIP64_COUNT_LIMIT or self._overflows(directory_size) or \
+                self._overflows(directory_offset):
+            self.file.write(struct.pack('<IQHHIIQQQQ', _ZIP64_END, 44, _MADE_BY, _VERSION, 0, 0,
+                                        count, count, directory_size, directory_offset))
+            self.file.write(struct.pack('<IIQI', _ZIP64_LOCATOR, 0, directory_end, 1))
+        count = 0xffff if count >= self.ZIP64_COUNT_LIMIT else count
+        self.file.write(struct.pack('<IHHHHIIH', _END, 0, 0, count, count,
+                                    self._field(directory_size), self._field(directory_offset),
+                                    0))
+        self.file.close()
+        self.closed = True
+        self._stop_pool()
+
+    def abort(self):
+        """Close and delete the archive without finishing it"""
+        if not self.file.closed:
+            self.file.close()
+        self.closed = True
+        self._stop_pool()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _stop_pool(self):
+        """Stop the worker threads, if there are any"""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def _overflows(self, value):
+        """Return True if the given size or offset needs a ZIP64 record"""
+        return value >= self.ZIP64_LIMIT
+
+    def _field(self, value):
+        """
+        Return the value to put in a 4 byte size or offset field: the value itself if it fits, or
+        0xffffffff to say it is in a ZIP64 record.
+        """
+        return 0xffffffff if self._overflows(value) else value
+
+    @staticmethod
+    def _dos_time_and_date(timestamp):
+        """
+        Convert a timestamp to the MS-DOS time and date format used in ZIP headers.
+
+        :param timestamp: the timestamp
+        :return: a 2-tuple of the time and date
+        """
+        t = time.localtime(timestamp)
+        # MS-DOS dates start in 1980
+        year = max(t.tm_year, 1980)
+        dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+        dos_date = ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+        return dos_time, dos_date
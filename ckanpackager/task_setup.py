@@ -1,5 +1,8 @@
+import random
+
 from flask.config import Config
 from celery.utils.log import get_task_logger
+from ckanpackager.lib.ckan_resource import TransientStreamError
 from ckanpackager.tasks.url_package_task import UrlPackageTask
 from ckanpackager.tasks.datastore_package_task import DatastorePackageTask
 from ckanpackager.tasks.dwc_archive_package_task import DwcArchivePackageTask
@@ -8,7 +11,7 @@ config = Config(__file__)
 config.from_object('ckanpackager.config_defaults')
 config.from_envvar('CKANPACKAGER_CONFIG')
 
-from celery import Celery
+from celery import Celery, chord
 
 app = Celery('tasks', broker=config['CELERY_BROKER'])
 app.conf.CELERY_DISABLE_RATE_LIMITS = True
@@ -16,26 +19,210 @@ app.conf.CELERY_ACCEPT_CONTENT = ['json']
 app.conf.CELERY_TASK_SERIALIZER = 'json'
 app.conf.CELERY_CREATE_MISSING_QUEUES = True
 app.conf.CELERY_DEFAULT_QUEUE = 'slow'
+# results are only needed to know when all the shards of a package are done
+app.conf.CELERY_IGNORE_RESULT = True
+if config.get('CELERY_RESULT_BACKEND') or config.get('SHARD_RECORDS'):
+    app.conf.CELERY_RESULT_BACKEND = config.get('CELERY_RESULT_BACKEND') or config['CELERY_BROKER']
 
 
-@app.task
-def run_task(task, request):
+# the classes of the tasks, by name
+TASKS = {
+    'package_url': UrlPackageTask,
+    'package_dwc_archive': DwcArchivePackageTask,
+    'package_datastore': DatastorePackageTask,
+}
+
+
+def _defer(task, deferred, **kwargs):
+    """ Put a task that can't get its slots back on its queue for later
+
+    The task is retried after SLOT_RETRY_DELAY seconds (give or take, so
+    deferred tasks don't all come back together), leaving the workers to
+    tasks for other hosts and requesters meanwhile. Deferred tasks aren't
+    queued in any order: whichever task asks first when a slot frees up
+    gets it. Deferrals don't count towards the TASK_RETRIES retries of
+    failed tasks.
+
+    @param task: The bound task
+    @param deferred: Number of times the task has already been deferred
+    @param kwargs: The other keyword arguments of the task
+    """
+    delay = config.get('SLOT_RETRY_DELAY', 30)
+    kwargs['deferred'] = deferred + 1
+    return task.retry(kwargs=kwargs, countdown=random.uniform(delay, 2 * delay),
+                      max_retries=config['TASK_RETRIES'] + deferred + 1)
+
+
+@app.task(bind=True, max_retries=config['TASK_RETRIES'])
+def run_task(self, task, request, deferred=0):
     """ Run/enqueue the given task for the given request
    
     Note that the request should be validated before
-    this is called.
+    this is called. Tasks that fail fetching data from
+    CKAN in a way that may not happen again (see
+    TransientStreamError) are retried after TASK_RETRY_DELAY seconds
+    (resuming where they stopped if RESUMABLE_TASKS is
+    set). Tasks that fail for good email the requester,
+    and those waiting for the same file, that it
+    couldn't be built. Tasks that can't get a slot for their host
+    or requester (see PackageTask.slots) are deferred,
+    unless their file is cached. Large datastore packages
+    are fetched in shards (see run_shard), unless another
+    task is fetching the same records in shards already, in
+    which case the requester waits for it (see
+    DatastorePackageTask.claim_shards).
  
     @param task: Name of the task. One of package_url,
                  package_dwc_archive or package_datastore
     @param request: Dictionary containing the request
+    @param deferred: Number of times the task has been deferred
+    """
+    logger = get_task_logger(__name__)
+    package_task = TASKS[task](request, config)
+    slots = package_task.slots()
+    if not package_task.cached() and not slots.acquire():
+        logger.info("No free slot for host {}, deferring the task".format(package_task.host()))
+        raise _defer(self, deferred)
+    try:
+        shards = None
+        if task == 'package_datastore':
+            shards = package_task.shard_ranges()
+        if shards:
+            # identical requests wait for the task that claimed the shards
+            if not package_task.claim_shards():
+                return
+            if package_task.cached():
+                # built by the task that had claimed them, just before we did
+                package_task.release_shards()
+                shards = None
+        if shards:
+            logger.info("Fetching the records in {} shards".format(len(shards)))
+            # the shards and the merge go on the queue this task came from
+            queue = self.request.delivery_info.get('routing_key', None)
+            merge = merge_shards.subtask((request, len(shards)), queue=queue, immutable=True)
+            # called instead of the merge if a shard fails for good
+            merge.link_error(shards_failed.subtask((request,), queue=queue, immutable=True))
+            try:
+                chord(
+                    run_shard.subtask((request, index, offset, limit), queue=queue)
+                    for index, (offset, limit) in enumerate(shards)
+                )(merge)
+            except:
+                package_task.release_shards()
+                raise
+        else:
+            package_task.run(logger)
+    except TransientStreamError as e:
+        if self.request.retries < config['TASK_RETRIES'] + deferred:
+            raise self.retry(exc=e, countdown=config['TASK_RETRY_DELAY'],
+                             max_retries=config['TASK_RETRIES'] + deferred)
+        package_task.fail(e)
+        raise
+    except Exception as e:
+        package_task.fail(e)
+        raise
+    finally:
+        slots.release()
+
+
+@app.task(bind=True, max_retries=config['TASK_RETRIES'], ignore_result=False)
+def run_shard(self, request, index, offset, limit, deferred=0):
+    """ Fetch the records of one shard of a datastore package
+
+    Shards failing to fetch data from CKAN (with a TransientStreamError) are
+    retried on their own after TASK_RETRY_DELAY seconds. Shards hold a slot
+    for their host and one for their requester, as the task that split the
+    package did, so a sharded package counts towards the limit of its
+    requester's domain for as long as its shards run. They are deferred when
+    there is none. If a shard fails for good, shards_failed
+    is called instead of merge_shards.
+
+    @param request: Dictionary containing the request
+    @param index: Index of the shard
+    @param offset: Offset of the shard's first record
+    @param limit: Number of records in the shard
+    @param deferred: Number of times the shard has been deferred
+    @return: The number of records fetched
+    """
+    package_task = DatastorePackageTask(request, config)
+    package_task.log = get_task_logger(__name__)
+    slots = package_task.slots()
+    if not slots.acquire():
+        raise _defer(self, deferred)
+    try:
+        return package_task.write_shard(index, offset, limit)
+    except TransientStreamError as e:
+        raise self.retry(exc=e, countdown=config['TASK_RETRY_DELAY'],
+                         max_retries=config['TASK_RETRIES'] + deferred)
+    finally:
+        slots.release()
+
+
+@app.task(bind=True, max_retries=config['TASK_RETRIES'])
+def merge_shards(self, request, shard_count):
+    """ Build the datastore package from the parts fetched by its shards
+
+    Then email the link, as run_task does for packages fetched in one go
+    (or tell the requester the package couldn't be built if this fails for
+    good, releasing the shards for the next request to fetch the missing
+    parts).
+
+    @param request: Dictionary containing the request
+    @param shard_count: Number of shards
     """
     logger = get_task_logger(__name__)
-    if task == 'package_url':
-        UrlPackageTask(request, config).run(logger)
-    elif task == 'package_dwc_archive':
-        DwcArchivePackageTask(request, config).run(logger)
-    elif task == 'package_datastore':
-        DatastorePackageTask(request, config).run(logger)
+    package_task = DatastorePackageTask(request, config)
+    package_task.shard_count = shard_count
+    try:
+        package_task.run(logger)
+    except TransientStreamError as e:
+        if self.request.retries < config['TASK_RETRIES']:
+            raise self.retry(exc=e, countdown=config['TASK_RETRY_DELAY'])
+        package_task.fail(e)
+        package_task.release_shards()
+        raise
+    except Exception as e:
+        package_task.fail(e)
+        package_task.release_shards()
+        raise
+
+
+@app.task
+def shards_failed(request):
+    """ Give up on a datastore package when one of its shards failed for good
+
+    The merge is never run then: the failure is recorded, the requester is
+    told and the parts fetched by the other shards are removed (see
+    DatastorePackageTask.shards_failed).
+
+    @param request: Dictionary containing the request
+    """
+    package_task = DatastorePackageTask(request, config)
+    package_task.log = get_task_logger(__name__)
+    package_task.shards_failed()
+
+
+def queue_depths(queues):
+    """ Return the number of tasks waiting on each of the given queues
+
+    This asks the broker for the size of each queue (eg. LLEN with redis),
+    without reading the tasks.
+
+    @param queues: List of queue names
+    @return: Dictionary of queue name to number of tasks waiting
+    """
+    depths = {}
+    with app.connection() as connection:
+        for queue in queues:
+            # some brokers close the channel when the queue doesn't exist
+            with connection.channel() as channel:
+                try:
+                    depths[queue] = channel.queue_declare(queue=queue,
+                                                          passive=True).message_count
+                except connection.channel_errors:
+                    # the queue doesn't exist (yet)
+                    depths[queue] = 0
+    return depths
 
 
 def add_task(queue, task, request):
@@ -44,7 +231,8 @@ def add_task(queue, task, request):
     Note that the request should be validated before this
     is called.
 
-    @param queue: Queue to add this to. One of 'slow' or 'fast'
+    @param queue: Queue to add this to. One of 'slow' or 'fast', or one of
+                  the QUEUE_TIERS queues
     @param task: Name of the tak. One of package_url,
                  package_dwc_archive or package_datastore
     @param request: Dictionary containing the request
@@ -1,21 +1,67 @@
+import copy
+import csv
 import json
-import os
+import itertools
+import time
+import zipfile
 from contextlib import closing
 from urlparse import urlparse
 
 import unicodecsv
-from openpyxl import Workbook
 
-from ckanpackager.lib.ckan_resource import CkanResource
+from ckanpackager.lib.ckan_resource import CkanResource, StreamError
+from ckanpackager.lib.compressed_writer import EXTENSIONS, compression_available
+from ckanpackager.lib.page_sizer import PageSizer
+from ckanpackager.lib.parquet_sink import parquet_available
+from ckanpackager.lib.progress import TaskProgress
 from ckanpackager.lib.resource_file import ResourceFile
+from ckanpackager.lib.row_projector import RowProjector
+from ckanpackager.lib.shard_parts import shard_ranges
+from ckanpackager.lib.statistics import statistics
+from ckanpackager.lib.ttl_cache import TTLCache
+from ckanpackager.lib.utils import BadRequestError
 from ckanpackager.tasks.package_task import PackageTask
 
 class CkanFailure(Exception):
     """Exception raised when CKAN returns unsuccessful request"""
     pass
 
+
+# the request parameters recorded in the manifest of a package, describing its content
+MANIFEST_PARAMS = ['api_url', 'resource_id', 'filters', 'q', 'plain', 'language', 'sort', 'fields',
+                   'limit', 'offset']
+# the parameters which must be the same for a package to be derived from another
+SAME_RECORDS_PARAMS = ['api_url', 'filters', 'q', 'plain', 'language', 'sort']
+# the number of rows written at a time when deriving a package from a cached one (records fetched
+# from CKAN are written a page at a time)
+DERIVE_BATCH_ROWS = 1000
+# the formats whose records are written to a file of their own by a sink (see
+# DatastorePackageTask._sink) rather than as csv. These files can't be read back to resume from.
+SINK_FORMATS = ('xlsx', 'parquet')
+# the number of records (and fields) matched by recent requests, see DatastorePackageTask.speed
+_totals = TTLCache(300)
+
 class DatastorePackageTask(PackageTask):
     """Represents a datastore packager task."""
+
+    # whether a failed attempt at building the file can be resumed by the next attempt (this relies
+    # on the records being written as they are received, to files that are only appended to)
+    resumable = True
+    # whether the package can be recorded as a superset from which packages for other requests may
+    # be derived, or be derived itself from such a package
+    derivable = True
+    # whether the records can be fetched in shards by several tasks and merged, see shard_ranges
+    shardable = True
+    # whether the records fetched can also be written to packages in the other formats of
+    # FANOUT_FORMATS, see _fanout_packages
+    fanout = True
+    # the number of shards whose parts the package is to be merged from, set by the task merging
+    # them
+    shard_count = None
+    # the (packages, fields, count) of the packages in other formats whose records have been
+    # written, left for _after_build to zip once the requested package has been emailed
+    _fanout_written = None
+
     def schema(self):
         """Define the schema for datastore package tasks
 
@@ -33,7 +79,7 @@ class DatastorePackageTask(PackageTask):
             'offset': (False, None, True),
             'fields': (False, None, True),
             'sort': (False, None, True),
-            'format': (False, None, False),
+            'format': (False, self._check_format, False),
             'doi': (False, None, False),
             'key': (False, None, None),
         }
@@ -42,13 +88,54 @@ class DatastorePackageTask(PackageTask):
         """Return the host name for the request"""
         return urlparse(self.request_params['api_url']).netloc
 
+    def upstream_version(self):
+        """Return a token identifying the current version of the resource's data
+
+        This is taken from the resource's modification dates, see
+        CkanResource.get_version.
+        """
+        ckan_resource = CkanResource(self.request_params['api_url'],
+                                     self.request_params.get('key', None),
+                                     self.config['PAGE_SIZE'],
+                                     {'resource_id': self.request_params['resource_id']},
+                                     compress=self.config.get('HTTP_COMPRESSION', True),
+                                     logger=self.log)
+        return ckan_resource.get_version(self.config.get('REVALIDATE_TIMEOUT', 10))
+
     def speed(self):
-        """ Return the expected task duration.
+        """ Return the queue the task should be put on, given its expected duration.
+
+         Without QUEUE_TIERS, this is 'fast' if the file exists in the cache, or
+         if fewer than the configured SLOW_REQUEST number of rows are requested,
+         and 'slow' otherwise.
 
-         If the file exists in the cache, then this is assumed to be fast,
-         Otherwise this is assumed to be fast only if there less than
-         the configures SLOW_REQUEST number of rows.
+         With QUEUE_TIERS, the number of records the request matches is asked
+         of CKAN (see _estimate_size), and the task is put on the queue of the
+         first tier whose cost (records x fields) it doesn't exceed. Cached
+         files go on the first tier's queue. If CKAN doesn't answer in time,
+         this falls back to SLOW_REQUEST to pick the first or the last tier.
          """
+        tiers = self.config.get('QUEUE_TIERS', None)
+        if not tiers:
+            return self._guess_speed()
+        if super(DatastorePackageTask, self).speed() == 'fast':
+            return tiers[0][1]
+        estimate = self._estimate_size()
+        if estimate is None:
+            return tiers[0][1] if self._guess_speed() == 'fast' else tiers[-1][1]
+        rows, columns = estimate
+        cost = rows * max(columns, 1)
+        for max_cost, queue in tiers:
+            if max_cost is None or cost <= max_cost:
+                return queue
+        return tiers[-1][1]
+
+    def _guess_speed(self):
+        """ Return 'fast' or 'slow' from the number of rows requested
+
+        This is 'fast' if the file exists in the cache, or if a limit below
+        SLOW_REQUEST is given. Requests without a limit are assumed to be slow.
+        """
         if super(DatastorePackageTask, self).speed() == 'fast':
             return 'fast'
         if self.request_params.get('limit', False):
@@ -61,6 +148,54 @@ class DatastorePackageTask(PackageTask):
         else:
             return 'slow'
 
+    def _estimate_size(self):
+        """ Return the number of records and fields the package will have
+
+        The number of records matching the request is given by a single
+        request for no records, which gives up after COUNT_TIMEOUT seconds.
+        The answer is kept for COUNT_CACHE_TIME seconds, so that requests for
+        the same records (eg. with other formats, or by other users) don't
+        ask again.
+
+        @return: a 2-tuple of the number of records and the number of fields,
+                 or None if CKAN didn't give the number of records
+        """
+        schema = self.schema()
+        ckan_params = dict((k, v) for k, v in self.request_params.items()
+                           if schema[k][2] and k not in ('limit', 'offset', 'sort'))
+        key = json.dumps([self.request_params['api_url'], self.request_params.get('key', None),
+                          ckan_params], sort_keys=True)
+        total = _totals.get(key)
+        if total is None:
+            ckan_resource = CkanResource(self.request_params['api_url'],
+                                         self.request_params.get('key', None),
+                                         self.config['PAGE_SIZE'], ckan_params,
+                                         compress=self.config.get('HTTP_COMPRESSION', True),
+                                         logger=self.log)
+            try:
+                total = ckan_resource.get_total(self.config.get('COUNT_TIMEOUT', 2))
+            except StreamError as e:
+                self.log.warning("Failed counting the records: {}".format(e))
+                return None
+            if total is None:
+                return None
+            _totals.set(key, total, self.config.get('COUNT_CACHE_TIME', 300))
+        count, columns = total
+        return self._expected_count(count), columns
+
+    def expected_size(self):
+        """Return the expected size of the ZIP file, from the number of records
+        and fields it will have (see _estimate_size) and the average size of a
+        value in a ZIP file (CACHE_BYTES_PER_VALUE)
+
+        @return: The number of bytes, or None if unknown
+        """
+        estimate = self._estimate_size()
+        if estimate is None:
+            return None
+        rows, columns = estimate
+        return rows * max(columns, 1) * self.config.get('CACHE_BYTES_PER_VALUE', 4)
+
     def create_zip(self, resource):
         """
         Create the ZIP file matching the current request.
@@ -69,95 +204,698 @@ class DatastorePackageTask(PackageTask):
         """
         schema = self.schema()
         ckan_params = dict([(k, v) for (k, v) in self.request_params.items() if schema[k][2]])
-        ckan_resource = CkanResource(self.request_params['api_url'],
-                                     self.request_params.get('key', None),
-                                     self.config['PAGE_SIZE'], ckan_params)
+        ckan_resource = self._ckan_resource(ckan_params)
+        derive = self._may_derive()
+        if self.shard_count is not None:
+            self._merge_shards(resource, ckan_resource, derive)
+            return
+        # the files written by sinks, or compressed, can't be read back to resume from
+        resumable = self.resumable and self.config.get('RESUMABLE_TASKS', False) and \
+            self._format() not in SINK_FORMATS and self._jsonl_compression() is None
+        if derive:
+            superset = self._find_superset(resource)
+            if superset is not None:
+                self._derive_zip(resource, *superset)
+                return
+        succeeded = False
+        # the packages in other formats built from the same records
+        packages = []
         try:
             self.log.info("Fetching fields")
             # read the datastore fields and determine the backend type
             fields, backend = ckan_resource.get_fields_and_backend()
 
-            # write fields to out file as headers
-            fields = self._write_headers(resource, fields)
+            resume = None
+            if resumable:
+                resume = resource.open_resumable({'fields': self._field_names(fields),
+                                                  'backend': backend})
+            if resume is None:
+                packages = self._fanout_packages(resource, fields)
+                # write fields to out file as headers
+                fields = self._write_headers(resource, fields)
+            else:
+                self.log.info("Resuming after record {}".format(resume['count']))
+                self.progress.fetched(resume['count'])
+                fields = self._field_names(fields)
 
             self.log.info("Fetching records")
-            # retrieve the records and write them as we go (ckan_resource.get_records returns a
-            # generator)
-            self._write_records(ckan_resource.get_records(backend), fields, resource)
+            self.progress.set_total(self._expected_count(ckan_resource.total))
+            self.progress.set_phase('fetching')
+            # retrieve the records and write them as we go, a page at a time
+            # (ckan_resource.get_pages returns a generator)
+            checkpoint = resource.save_checkpoint if resumable else None
+            pages = ckan_resource.get_pages(backend, checkpoint=checkpoint, resume=resume)
+            if packages:
+                pages = self._fan_out(pages, fields, packages)
+            count = self._write_records(pages, fields, resource)
+            self._log_fetch_summary(ckan_resource)
+            if derive:
+                if resume is not None:
+                    count += resume['count']
+                resource.manifest = self._manifest(fields, count)
             # finalize the resource
+            self.progress.set_phase('finalizing')
             self._finalize_resource(fields, resource)
             # zip the file
+            self.progress.set_phase('zipping')
+            resource.create_zip(self.config['ZIP_COMMAND'])
+            succeeded = True
+        finally:
+            if succeeded:
+                resource.clean_work_files()
+            else:
+                # keep what we've got so far for the next attempt
+                resource.clean_work_files(keep_resumable=True)
+                for _task, package in packages:
+                    package.clean_work_files()
+        if packages:
+            self._fanout_written = (packages, fields, count)
+
+    def _after_build(self):
+        """
+        Zip the packages in other formats built from the records fetched (see _fanout_packages),
+        once the requested package has been emailed. Failing to build them is only logged.
+        """
+        if self._fanout_written is None:
+            return
+        packages, fields, count = self._fanout_written
+        self._fanout_written = None
+        try:
+            self._finish_fanout(packages, fields, count)
+        except Exception as e:
+            self.log.warning("Failed building the packages in other formats: {}".format(e))
+            for _task, package in packages:
+                package.clean_work_files()
+
+    def _fanout_packages(self, resource, fields):
+        """
+        Return the packages in the other formats of FANOUT_FORMATS to build from the records fetched
+        for the current request, so that requests for the same records in these formats find them in
+        the cache rather than fetching them again. Formats that can't be written, and packages that
+        are already cached, are left out. The headers of the packages are written.
+
+        :param resource: the ResourceFile being built
+        :param fields: the list of datastore field dicts
+        :return: a list of (task, ResourceFile) tuples, one for each package, the task being a copy
+                 of this one requesting the package's format
+        """
+        packages = []
+        if not self.fanout:
+            return packages
+        for fmt in self.config.get('FANOUT_FORMATS', []):
+            if fmt == self._format() or fmt in [task._format() for task, _package in packages]:
+                continue
+            task = copy.copy(self)
+            task.request_params = dict(self.request_params, format=fmt)
+            if fmt == 'csv':
+                # the format of csv packages is usually left out of the request
+                del task.request_params['format']
+            # the records written are counted by this task
+            task.progress = TaskProgress(None, None)
+            try:
+                task._check_format(fmt)
+            except BadRequestError as e:
+                self.log.warning("Not building the {} package: {}".format(fmt, e))
+                continue
+            package = task._resource_file()
+            try:
+                if resource.version is not None:
+                    package.set_version(resource.version, resource.version_max_age)
+                if package.zip_file_exists():
+                    continue
+                task._write_headers(package, fields)
+            except Exception as e:
+                self._drop_package(task, package, e)
+                continue
+            packages.append((task, package))
+        if packages:
+            self.log.info("Building the {} packages too".format(
+                ', '.join(task._format() for task, _package in packages)))
+        return packages
+
+    def _fan_out(self, pages, fields, packages):
+        """
+        Write each page of records to the packages in other formats (see _fanout_packages) as it
+        goes by. A package whose records can't be written is dropped, rather than failing the task.
+
+        :param pages: iterable of lists of records
+        :param fields: the names of the fields
+        :param packages: the list of (task, ResourceFile) tuples of the packages
+        :return: a generator of the pages
+        """
+        for records in pages:
+            for task, package in list(packages):
+                try:
+                    task._write_records([records], fields, package)
+                except Exception as e:
+                    packages.remove((task, package))
+                    self._drop_package(task, package, e)
+            yield records
+
+    def _finish_fanout(self, packages, fields, count):
+        """
+        Create the ZIP files of the packages in other formats once all the records have been
+        written to them, and email their link to the recipients waiting for them. A package built
+        meanwhile by another task is dropped.
+
+        :param packages: the list of (task, ResourceFile) tuples of the packages
+        :param fields: the names of the fields
+        :param count: the number of records written
+        """
+        for task, package in packages:
+            lock = package.build_lock()
+            try:
+                if not lock.acquire() or package.zip_file_exists():
+                    self.log.info("The {} package has been built by another task".format(
+                        task._format()))
+                    continue
+                if task._may_derive():
+                    package.manifest = task._manifest(fields, count)
+                task._finalize_resource(fields, package)
+                package.create_zip(self.config['ZIP_COMMAND'])
+                task._release_build(package, lock, package.pending_recipients(), [])
+            except Exception as e:
+                self._drop_package(task, package, e)
+            finally:
+                package.clean_work_files()
+                lock.release()
+
+    def _drop_package(self, task, package, error):
+        """
+        Give up building a package in another format, see _fanout_packages.
+
+        :param task: the task requesting the package
+        :param package: the ResourceFile of the package
+        :param error: the exception raised building it
+        """
+        self.log.warning("Failed building the {} package: {}".format(task._format(), error))
+        package.clean_work_files()
+
+    def _ckan_resource(self, ckan_params):
+        """
+        Return the CkanResource to fetch the records from, set up as configured.
+
+        :param ckan_params: the parameters to send to CKAN
+        :return: a CkanResource
+        """
+        # concurrent fetching of pages is opt-in per CKAN host
+        parallel = self.config.get('PARALLEL_FETCH', {}).get(self.host(), 0)
+        page_sizer = None
+        if self.config.get('ADAPTIVE_PAGE_SIZE', False):
+            page_sizer = PageSizer(self.config['PAGE_SIZE'],
+                                   self.config['PAGE_SIZE_MIN'],
+                                   self.config['PAGE_SIZE_MAX'],
+                                   self.config['PAGE_TARGET_DURATION'],
+                                   self.config.get('PAGE_MAX_BYTES', None))
+        return CkanResource(self.request_params['api_url'],
+                            self.request_params.get('key', None),
+                            self.config['PAGE_SIZE'], ckan_params,
+                            pool_size=max(self.config.get('HTTP_POOL_SIZE', 10), parallel),
+                            keep_alive=self.config.get('HTTP_KEEP_ALIVE', True),
+                            prefetch_pages=self.config.get('PREFETCH_PAGES', 0),
+                            parallel=parallel,
+                            parallel_buffer=self.config.get('PARALLEL_FETCH_BUFFER', None),
+                            stream=self.config.get('STREAM_RESPONSES', False),
+                            page_sizer=page_sizer,
+                            retries=self.config.get('FETCH_RETRIES', 0),
+                            retry_backoff=self.config.get('FETCH_RETRY_BACKOFF', 1),
+                            compress=self.config.get('HTTP_COMPRESSION', True),
+                            progress=self.progress,
+                            logger=self.log)
+
+    def shard_ranges(self):
+        """
+        Work out whether the records should be fetched in shards, by several tasks, and merged
+        (see task_setup.run_task). This is the case when SHARD_RECORDS is set and the request
+        matches more records than that, unless the package is already cached, can be derived from
+        a cached package, isn't a csv or tsv package (whose parts can be merged as they are) or the
+        resource is paged with a cursor (as offsets far into the records are slow to reach with
+        such backends).
+
+        :return: a list of (offset, number of records) tuples, one for each shard in order, or None
+                 if the records shouldn't be fetched in shards
+        """
+        shard_size = self.config.get('SHARD_RECORDS', None)
+        if not self.shardable or not shard_size or self._format() not in ('csv', 'tsv'):
+            return None
+        resource = self._resource_file()
+        if self.config.get('REVALIDATE_CACHE', False):
+            self._set_upstream_version(resource)
+        if resource.zip_file_exists():
+            return None
+        if self._may_derive() and self._find_superset(resource) is not None:
+            return None
+        schema = self.schema()
+        ckan_params = dict((k, v) for k, v in self.request_params.items()
+                           if schema[k][2] and k not in ('limit', 'offset'))
+        ckan_resource = self._ckan_resource(ckan_params)
+        _fields, backend = ckan_resource.get_fields_and_backend()
+        if backend in ckan_resource.backends:
+            return None
+        total = ckan_resource.get_total(self.config.get('SHARD_COUNT_TIMEOUT', 60))
+        if total is None:
+            return None
+        count = self._expected_count(total[0])
+        if count <= shard_size:
+            return None
+        return shard_ranges(self._range(self.request_params)[0], count, shard_size,
+                            self.config.get('SHARD_MAX', 8))
+
+    def claim_shards(self):
+        """
+        Claim fetching the records in shards for the current request (see shard_ranges), so that
+        identical requests arriving meanwhile don't fetch them all again. If another task has
+        claimed them, the requester is added to the recipients the task merging the shards will
+        email, as _build_zip does for packages fetched in one go. The claim is released when the
+        parts are removed, once merged or when a shard has failed for good.
+
+        :return: True if the shards were claimed, False if another task has claimed them
+        """
+        resource = self._resource_file()
+        parts = resource.shard_parts()
+        if parts.claim():
+            return True
+        resource.pending_recipients().add(self.request_params['email'])
+        # check the shards weren't merged (and the recipients emailed) before we added ourselves,
+        # otherwise it's up to us
+        if not parts.claim():
+            self.log.info("Another task is fetching the same records in shards, it will email "
+                          "the link")
+            return False
+        return True
+
+    def release_shards(self):
+        """Release the claim on fetching the records in shards, see claim_shards"""
+        self._resource_file().shard_parts().release()
+
+    def write_shard(self, index, offset, limit):
+        """
+        Fetch the records of a shard and write them to its part, see shard_ranges. Nothing is
+        fetched if the part has already been written (eg. by an identical request).
+
+        :param index: the index of the shard
+        :param offset: the offset of the shard's first record
+        :param limit: the number of records in the shard
+        :return: the number of records written
+        """
+        resource = self._resource_file()
+        parts = resource.shard_parts()
+        if parts.exists(index):
+            self.log.info("Shard {} has already been fetched".format(index))
+            return parts.count(index)
+        schema = self.schema()
+        ckan_params = dict((k, v) for k, v in self.request_params.items() if schema[k][2])
+        ckan_params.update(offset=offset, limit=limit)
+        ckan_resource = self._ckan_resource(ckan_params)
+        fields, backend = ckan_resource.get_fields_and_backend()
+        self.log.info("Fetching {} records from {} for shard {}".format(limit, offset, index))
+        self.start_progress(shard=index)
+        self.progress.set_total(limit)
+        self.progress.set_phase('fetching')
+        part = parts.open(index)
+        try:
+            writer = csv.writer(part, delimiter=resource.get_delimiter(), quotechar='"',
+                                lineterminator="\n")
+            count = self._write_rows(writer, ckan_resource.get_pages(backend),
+                                     self._field_names(fields), self.progress)
+        except:
+            parts.discard(part)
+            raise
+        finally:
+            self.progress.finish()
+        parts.commit(index, part, count)
+        self._log_fetch_summary(ckan_resource)
+        return count
+
+    def _merge_shards(self, resource, ckan_resource, derive):
+        """
+        Create the ZIP file from the parts written by the shards, copying them as they are after
+        the headers.
+
+        :param resource: the ResourceFile being built
+        :param ckan_resource: the CkanResource the records were fetched from
+        :param derive: whether to record the manifest of the package (see _manifest)
+        """
+        parts = resource.shard_parts()
+        missing = [i for i in range(self.shard_count) if not parts.exists(i)]
+        if missing:
+            raise CkanFailure("Missing the parts of shards {}".format(
+                ', '.join(str(i) for i in missing)))
+        try:
+            self.log.info("Merging {} shards".format(self.shard_count))
+            self.progress.set_phase('merging')
+            fields, _backend = ckan_resource.get_fields_and_backend()
+            fields = self._write_headers(resource, fields)
+            parts.copy(self.shard_count, resource.get_writer('resource.csv'))
+            if derive:
+                resource.manifest = self._manifest(fields, sum(parts.count(i) for i in
+                                                               range(self.shard_count)))
+            self.progress.set_phase('finalizing')
+            self._finalize_resource(fields, resource)
+            self.progress.set_phase('zipping')
             resource.create_zip(self.config['ZIP_COMMAND'])
         finally:
             resource.clean_work_files()
+        parts.remove()
+
+    def shards_failed(self):
+        """
+        Give up on a package fetched in shards when one of the shards has failed for good (see
+        shard_ranges): the package can't be merged, so the failure is recorded in the statistics
+        and Sentry, the requester and the recipients waiting for the package are told (see fail) and
+        the parts fetched by the other shards are removed.
+        """
+        error = "Failed fetching the records in shards"
+        self.log.error(error)
+        stats = statistics(self.config['STATS_DB'], self.config.get(u'ANONYMIZE_EMAILS'))
+        stats.log_error(self.request_params['resource_id'], self.request_params['email'], error)
+        self.sentry.captureMessage(error)
+        try:
+            self.fail(error)
+        finally:
+            self._resource_file().shard_parts().remove()
+
+    def _manifest(self, fields, count):
+        """
+        Return the manifest of the package being built, recorded in the cache index so that
+        packages for other requests can be derived from it (see _find_superset).
+
+        :param fields: the names of the fields in the package
+        :param count: the number of records in the package
+        :return: a dictionary
+        """
+        return {
+            'resource_id': self.request_params['resource_id'],
+            'params': dict((k, self.request_params[k]) for k in MANIFEST_PARAMS
+                           if self.request_params.get(k, None) is not None),
+            'format': self.request_params.get('format', 'csv'),
+            'fields': fields,
+            'rows': count,
+            'created': time.time(),
+        }
 
     @staticmethod
-    def _write_headers(resource, fields):
+    def _range(params):
+        """
+        Return the offset and number of records requested by the given parameters.
+
+        :param params: the request parameters
+        :return: a 2-tuple of the offset and the number of records, or None for all the records
+        """
+        return int(params.get('offset', None) or 0), int(params.get('limit', None) or 0) or None
+
+    def _expected_count(self, total):
+        """Return the number of records the request should give
+
+        @param total: The number of records matching the request, ignoring
+                      its offset and limit, or None if unknown
+        @return: The number of records, or None if unknown
+        """
+        if total is None:
+            return None
+        offset, limit = self._range(self.request_params)
+        count = max(total - offset, 0)
+        return min(count, limit) if limit is not None else count
+
+    def _requested_fields(self, manifest):
+        """
+        Return the fields requested by the current request if they can all be found in the package
+        described by the given manifest.
+
+        :param manifest: the manifest of a cached package
+        :return: the list of field names, or None if they can't be found in the package
+        """
+        if not self.request_params.get('fields', None):
+            # all the fields, which only a package with all the fields has
+            if manifest['params'].get('fields', None):
+                return None
+            return manifest['fields']
+        fields = [f.strip() for f in self.request_params['fields'].split(',')]
+        if set(fields) - set(manifest['fields']):
+            return None
+        return fields
+
+    def _find_superset(self, resource):
+        """
+        Find a cached package that holds all the records and fields requested by the current
+        request: one for the same resource with the same filters, query and sort order, with all
+        the requested fields (or more) and all the requested records (or more).
+
+        :param resource: the ResourceFile being built
+        :return: None if there is no such package, or a 3-tuple of the package's file name, its
+                 manifest and the list of field names to take from it. If there are several, the
+                 one with the fewest records is used.
+        """
+        offset, limit = self._range(self.request_params)
+        found = None
+        # with a known upstream version, only packages built from it will do (see
+        # ResourceFile.set_version)
+        if resource.version is not None:
+            manifests = resource.index.manifests(self.request_params['resource_id'],
+                                                 resource.version_max_age, resource.version)
+        else:
+            manifests = resource.index.manifests(self.request_params['resource_id'],
+                                                 resource.cache_time)
+        for zip_file_name, manifest in manifests:
+            params = manifest['params']
+            # the package's records are read back from the csv or tsv file it holds
+            if manifest['format'] not in ('csv', 'tsv'):
+                continue
+            if any(params.get(k, None) != self.request_params.get(k, None)
+                   for k in SAME_RECORDS_PARAMS):
+                continue
+            fields = self._requested_fields(manifest)
+            if fields is None:
+                continue
+            superset_offset, superset_limit = self._range(params)
+            # the package has all the records from its offset if it got fewer than it asked for
+            complete = superset_limit is None or manifest['rows'] < superset_limit
+            if offset < superset_offset:
+                continue
+            if not complete and (limit is None or
+                                 offset + limit > superset_offset + manifest['rows']):
+                continue
+            if found is None or manifest['rows'] < found[1]['rows']:
+                found = (zip_file_name, manifest, fields)
+        return found
+
+    def _derive_zip(self, resource, zip_file_name, manifest, fields):
+        """
+        Create the ZIP file matching the current request from the records of a cached package
+        holding them, rather than fetching them from CKAN again.
+
+        :param resource: the ResourceFile being built
+        :param zip_file_name: the file name of the cached package
+        :param manifest: the manifest of the cached package
+        :param fields: the names of the fields to take from the cached package
+        """
+        self.log.info("Deriving the file from cached file {}".format(zip_file_name))
+        self.progress.set_phase('deriving')
+        resource.index.touch(zip_file_name)
+        offset, limit = self._range(self.request_params)
+        skip = offset - self._range(manifest['params'])[0]
+        # the records of tsv packages are in resource.tsv (see ResourceFile.clean_name)
+        if manifest['format'] == 'tsv':
+            delimiter, entry = '\t', 'resource.tsv'
+        else:
+            delimiter, entry = ',', 'resource.csv'
+        try:
+            with closing(zipfile.ZipFile(zip_file_name)) as archive:
+                with closing(archive.open(entry)) as f:
+                    reader = unicodecsv.reader(f, encoding='utf-8', delimiter=delimiter,
+                                               quotechar='"', lineterminator="\n")
+                    header = next(reader)
+                    records = (dict(zip(header, row)) for row in reader)
+                    records = itertools.islice(records, skip,
+                                               skip + limit if limit is not None else None)
+                    pages = iter(lambda: list(itertools.islice(records, DERIVE_BATCH_ROWS)), [])
+                    fields = self._write_headers(resource, [{'id': f} for f in fields])
+                    count = self._write_records(pages, fields, resource)
+            self.log.info("Derived {} records".format(count))
+            resource.manifest = self._manifest(fields, count)
+            self.progress.set_phase('finalizing')
+            self._finalize_resource(fields, resource)
+            self.progress.set_phase('zipping')
+            resource.create_zip(self.config['ZIP_COMMAND'])
+        finally:
+            resource.clean_work_files()
+
+    def _log_fetch_summary(self, ckan_resource):
+        """
+        Log a summary of the time spent fetching the records from CKAN.
+
+        :param ckan_resource: the CkanResource the records were fetched from
+        """
+        summary = ckan_resource.stats_summary()
+        self.log.info("Fetched {records} records in {pages} pages using {new_connections} new "
+                      "connections: {wait:.2f}s waiting for responses (including connection "
+                      "setup), {transfer:.2f}s transferring, {retries} requests retried".format(
+                          **summary))
+        if summary['bytes']:
+            self.log.info("Transferred {:.1f}MB for {:.1f}MB of responses ({:.0%} saved by "
+                          "compression)".format(summary['wire_bytes'] / 1048576.0,
+                                                summary['bytes'] / 1048576.0,
+                                                1 - summary['wire_bytes'] / float(summary['bytes'])))
+        if ckan_resource.page_sizer is not None:
+            self.log.info("Page size changed {changes} times, between {smallest} and {largest} "
+                          "records (final page size {final})".format(
+                              **ckan_resource.page_sizer.summary()))
+
+    @staticmethod
+    def _field_names(fields):
+        """Return the names of the given datastore fields
+        @param fields: List of field dicts returned by CKAN
+        """
+        return [f['id'] for f in fields]
+
+    def _write_headers(self, resource, fields):
         # build a list of field names
         field_names = [f['id'] for f in fields]
-        w = resource.get_csv_writer('resource.csv')
+        if self._format() == 'jsonl':
+            # there is no header, but the file must exist even if there are no records
+            self._jsonl_writer(resource)
+            return field_names
+        w = self._sink(resource, fields)
+        if w is None:
+            w = resource.get_csv_writer('resource.csv', stream=True)
         w.writerow(field_names)
         return field_names
 
-    @staticmethod
-    def _write_records(records, fields, resource):
+    def _write_records(self, pages, fields, resource):
         """Stream the records from the input stream to the resource files
-        @param records: json dict of records
+        @param pages: iterable of lists of json dict of records
         @param fields: List
         @param resource: Resource file
         @type resource: ResourceFile
+        @return: The number of records written
+        """
+        if self._format() == 'jsonl':
+            return self._write_lines(self._jsonl_writer(resource), pages, self.progress)
+        w = self._sink(resource)
+        if w is not None:
+            # the rows go straight to the sink, with their values as they are
+            return self._write_rows(w, pages, fields, self.progress, encoding=None)
+        w = resource.get_csv_writer('resource.csv', encoded=True)
+        return self._write_rows(w, pages, fields, self.progress)
+
+    @staticmethod
+    def _write_rows(writer, pages, fields, progress=None, encoding='utf-8'):
+        """Write the given fields of the records as rows of the csv writer,
+        a page at a time
+        @param writer: plain csv writer, the rows being encoded by a RowProjector,
+                       or sink (see _sink)
+        @param pages: iterable of lists of json dict of records
+        @param fields: List
+        @param progress: TaskProgress to record the number of rows written in
+        @param encoding: Encoding of the unicode values, or None to leave them
+                         as they are
+        @return: The number of records written
+        """
+        projector = RowProjector(fields, encoding)
+        count = 0
+        for records in pages:
+            writer.writerows(projector.rows(records))
+            count += len(records)
+            if progress is not None:
+                progress.written(count)
+        return count
+
+    @staticmethod
+    def _write_lines(writer, pages, progress=None):
+        """Write the records as lines of compact JSON, a page at a time. The
+        records are written as they are, keeping nested values.
+        @param writer: file object
+        @param pages: iterable of lists of json dict of records
+        @param progress: TaskProgress to record the number of rows written in
+        @return: The number of records written
         """
-        w = resource.get_csv_writer('resource.csv')
-        for record in records:
-            row = []
-            for field_id in fields:
-                row.append(record.get(field_id, None))
-            w.writerow(row)
+        # decimals come from streamed responses
+        encode = json.JSONEncoder(separators=(',', ':'), default=float).encode
+        count = 0
+        for records in pages:
+            if records:
+                writer.write('\n'.join(map(encode, records)) + '\n')
+            count += len(records)
+            if progress is not None:
+                progress.written(count)
+        return count
 
     def _finalize_resource(self, fields, resource):
         """
         Finalize the resource before ZIPing it. In this implementation, this only does something if
-        the requested format is xlsx in which case we convert the output csv file to xlsx format.
+        the records are written by a sink (xlsx and parquet formats) or as jsonl, whose writer is
+        closed so that its file is complete.
 
         @param fields: List
         @param resource: The resource we are creating
         @type resource: ResourceFile
         """
-        if self.request_params.get('format') == 'xlsx':
-            # make sure the csv writer is flushed and closed
-            writer = resource.get_writer('resource.csv')
-            if not writer.closed:
-                writer.flush()
-                writer.close()
-            # remove the writer from the resource file's writers dict so that we avoid it trying to
-            # manage it after we've deleted it
-            resource.writers.pop('resource.csv')
-
-            csv_path = os.path.join(resource.working_folder, 'resource.csv')
-            xlsx_path = os.path.join(resource.working_folder, 'resource.xlsx')
-
-            # using the write only workbook avoids storing the workbook in memory and thus dodges
-            # running out of RAM, see:
-            # https://openpyxl.readthedocs.io/en/stable/optimized.html#write-only-mode.
-            # Note that there are some restrictions as to what you can do with a write only workbook
-            # but we don't run into any of them in the current implementation and we need it so that
-            # this writer doesn't eat all our RAM (as it says in the doc, RAM usage can be 50x file
-            # size! :O)
-            workbook = Workbook(write_only=True)
-            workbook.create_sheet('Data')
-            worksheet = workbook.active
-            with closing(workbook):
-                with open(csv_path, 'rb') as f:
-                    reader = unicodecsv.reader(
-                        f,
-                        encoding='utf-8',
-                        delimiter=resource.get_delimiter(),
-                        quotechar='"',
-                        lineterminator="\n"
-                    )
-                    for row in reader:
-                        worksheet.append(row)
-
-                workbook.save(xlsx_path)
-            # delete the original csv now that we're done with it
-            os.unlink(csv_path)
+        if self._format() == 'jsonl':
+            self._jsonl_writer(resource).close()
+        w = self._sink(resource)
+        if w is not None:
+            w.close()
+
+    def _format(self):
+        """Return the requested format"""
+        return self.request_params.get('format') or 'csv'
+
+    def _sink(self, resource, fields=None):
+        """
+        Return the writer of the records of the formats written to files of their own, rather than
+        as csv: an XlsxSink or a ParquetSink.
+
+        @param resource: The resource we are creating
+        @type resource: ResourceFile
+        @param fields: List of field dicts returned by CKAN, needed the first time
+        @return: The sink, or None if the records are written as csv
+        """
+        if self._format() == 'xlsx':
+            return resource.get_xlsx_writer('resource.xlsx')
+        if self._format() == 'parquet':
+            return resource.get_parquet_writer(
+                'resource.parquet', fields,
+                compression=self.config.get('PARQUET_COMPRESSION', 'snappy'),
+                row_group_size=self.config.get('PARQUET_ROW_GROUP_SIZE', 100000))
+        return None
+
+    def _jsonl_compression(self):
+        """Return the compression of jsonl packages (JSONL_COMPRESSION) if the
+        requested format is jsonl, None otherwise"""
+        if self._format() == 'jsonl':
+            return self.config.get('JSONL_COMPRESSION', None)
+        return None
+
+    def _jsonl_writer(self, resource):
+        """Return the writer of the records of jsonl packages, compressed as
+        configured
+        @param resource: The resource we are creating
+        @type resource: ResourceFile
+        """
+        compression = self._jsonl_compression()
+        return resource.get_writer('resource.jsonl' + EXTENSIONS.get(compression, ''),
+                                   stream=True, compression=compression)
+
+    def _may_derive(self):
+        """
+        Return True if the package may be derived from a cached one (see _find_superset) and, once
+        built, be recorded as one that others may be derived from. Packages requested with an API
+        key can't, and neither can xlsx, parquet and jsonl packages, whose values would lose their
+        types.
+        """
+        return self.derivable and self.config.get('DERIVE_FROM_CACHE', False) and \
+            not self.request_params.get('key', None) and \
+            self._format() not in ('xlsx', 'parquet', 'jsonl')
+
+    def _check_format(self, value):
+        """Check the requested format can be written
+        @param value: The requested format
+        @return: The format
+        """
+        if value == 'parquet' and not parquet_available():
+            raise BadRequestError("The parquet format isn't available (pyarrow isn't installed)")
+        compression = self.config.get('JSONL_COMPRESSION', None)
+        if value == 'jsonl' and not compression_available(compression):
+            raise BadRequestError("The jsonl format isn't available ({} compression isn't "
+                                  "supported)".format(compression))
+        return value
@@ -1,5 +1,6 @@
 import json
 import time
+import itertools
 
 import ijson
 from decimal import Decimal
@@ -12,6 +13,17 @@ from ckanpackager.tasks.datastore_package_task import DatastorePackageTask
 
 
 class DwcArchivePackageTask(DatastorePackageTask):
+
+    # the archive structure is built while writing the headers and records, so an archive can't be
+    # resumed part way through
+    resumable = False
+    # nor can it be derived from, or give, the csv packages other requests are derived from
+    derivable = False
+    # nor can it be fetched in shards
+    shardable = False
+    # nor can its records be written to packages in other formats
+    fanout = False
+
     def __init__(self, *args):
         super(DwcArchivePackageTask, self).__init__(*args)
         self._dwc_core_terms = GBIFDarwinCoreMapping(
@@ -64,10 +76,10 @@ class DwcArchivePackageTask(DatastorePackageTask):
             w.writerow(terms)
         return archive
 
-    def _write_records(self, records, archive, resource):
+    def _write_records(self, pages, archive, resource):
         """Write the records from the search response to the resource files
 
-        @param records: list of records
+        @param pages: iterable of lists of records
         @type archive: DwcArchiveStructure
         @type resource: ResourceFile
         @returns: Number of rows read
@@ -78,7 +90,7 @@ class DwcArchivePackageTask(DatastorePackageTask):
             else:
                 return x
 
-        for record in records:
+        for record in itertools.chain.from_iterable(pages):
             json_row = dict([(k, no_decimal(v)) for (k, v) in record.items()])
             for extension in archive.extensions():
                 w = resource.get_csv_writer(archive.file_name(extension))
@@ -1,14 +1,15 @@
 import os
-import smtplib
 import hashlib
 import logging
 import traceback
 from datetime import datetime
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
 from ckanpackager.lib.utils import BadRequestError
+from ckanpackager.lib.cache_manager import CacheManager
+from ckanpackager.lib.mailer import Mailer, build_message
+from ckanpackager.lib.progress import TaskProgress
 from ckanpackager.lib.resource_file import ResourceFile
 from ckanpackager.lib.statistics import statistics
+from ckanpackager.lib.task_slots import TaskSlots
 from raven import Client
 
 class PackageTask(object):
@@ -36,6 +37,13 @@ class PackageTask(object):
         self.time = str(datetime.now())
         self.request_params = {}
         self.log = logging.getLogger(__name__)
+        # the progress of the task, only published while it is run (see
+        # start_progress)
+        self.progress = TaskProgress(None, None)
+        # the version of the upstream data, once looked up (see
+        # _set_upstream_version)
+        self._upstream_checked = False
+        self._upstream_version = None
         schema = self.schema()
         if 'email' not in schema:
             schema['email'] = (True, None)
@@ -59,23 +67,68 @@ class PackageTask(object):
     def host(self):
         raise NotImplementedError
   
+    def upstream_version(self):
+        """Return a token identifying the current version of the data to package
+
+        Derived classes that can tell should implement this, see
+        REVALIDATE_CACHE.
+
+        @return: The token, or None if the version isn't known
+        """
+        return None
+
     def speed(self):
         """ Return the task estimated time as either 'fast' or 'slow'.
 
         If the file exists in the cache, then this returns 'fast'. It returns
         'slow' otherwise.
         """
-        resource = ResourceFile(
-            self.request_params,
-            self.config['STORE_DIRECTORY'],
-            self.config['TEMP_DIRECTORY'],
-            self.config['CACHE_TIME']
-        )
-        if resource.zip_file_exists():
+        if self.cached():
             return 'fast'
         else:
             return 'slow'
 
+    def expected_size(self):
+        """Return the expected size of the ZIP file, for room to be made for
+        it in the cache before it is built (see CACHE_MAX_BYTES)
+
+        Derived classes that can tell should implement this.
+
+        @return: The number of bytes, or None if unknown
+        """
+        return None
+
+    def cached(self):
+        """Return True if the file for the request is in the cache
+
+        With REVALIDATE_CACHE, the file must have been built from the current
+        version of the upstream data, as when the task is run.
+        """
+        resource = self._resource_file()
+        if self.config.get('REVALIDATE_CACHE', False):
+            self._set_upstream_version(resource)
+        return resource.zip_file_exists()
+
+    def slots(self):
+        """Return the slots the task must hold while it runs
+
+        These limit the number of tasks running at the same time for the
+        request's host (HOST_SLOTS, or DEFAULT_HOST_SLOTS for hosts not
+        listed) and for the email domain of the requester (DOMAIN_SLOTS, or
+        DEFAULT_DOMAIN_SLOTS), so a slow host or a single requester can't
+        take up all the workers.
+
+        @return: A TaskSlots
+        """
+        host = self.host()
+        domain = self.request_params['email'].rsplit('@', 1)[-1].lower()
+        host_slots = self.config.get('HOST_SLOTS', {}).get(
+            host, self.config.get('DEFAULT_HOST_SLOTS', None))
+        domain_slots = self.config.get('DOMAIN_SLOTS', {}).get(
+            domain, self.config.get('DEFAULT_DOMAIN_SLOTS', None))
+        return TaskSlots(self.config['STORE_DIRECTORY'],
+                         [('host-' + host, host_slots), ('domain-' + domain, domain_slots)])
+
     def run(self, logger=None):
         """Run the task."""
         # create a stats object for database access
@@ -85,7 +138,11 @@ class PackageTask(object):
                 self.log = logger
             else:
                 self.log = logging.getLogger(__name__)
-            self._run()
+            self.start_progress()
+            try:
+                self._run()
+            finally:
+                self.progress.finish()
             stats.log_request(
                 self.request_params['resource_id'],
                 self.request_params['email'],
@@ -104,18 +161,190 @@ class PackageTask(object):
         """Run the task"""
         self.log.info("Task parameters: {}".format(str(self.request_params)))
         # Get/create the file
-        resource = ResourceFile(
+        resource = self._resource_file()
+        if self.config.get('REVALIDATE_CACHE', False):
+            self._set_upstream_version(resource)
+        if resource.zip_file_exists():
+            self.log.info("Found file in cache")
+            resource.index.touch(resource.get_zip_file_name())
+            # recipients may have been left waiting for the file by a task
+            # that built it just as they added themselves (see
+            # DatastorePackageTask.claim_shards)
+            emails = [self.request_params['email']]
+            emails.extend(e for e in resource.pending_recipients().take() if e not in emails)
+            self._send_emails(resource, emails)
+        else:
+            self._build_zip(resource)
+
+    def start_progress(self, **info):
+        """Start publishing the progress of the task
+
+        The progress is published, every PROGRESS_INTERVAL seconds at most,
+        for the web service to report it until the task finishes. See
+        TaskProgress.
+
+        @param info: Additional values describing the task to publish with
+                     its progress
+        """
+        info.update(task=type(self).__name__, host=self.host(),
+                    resource_id=self.request_params['resource_id'])
+        self.progress = TaskProgress(self.config['STORE_DIRECTORY'], str(self), info,
+                                     self.config.get('PROGRESS_INTERVAL', 5))
+        self.progress.publish()
+
+    def _resource_file(self):
+        """Return the ResourceFile for the current request"""
+        return ResourceFile(
             self.request_params,
             self.config['STORE_DIRECTORY'],
             self.config['TEMP_DIRECTORY'],
-            self.config['CACHE_TIME']
+            self.config['CACHE_TIME'],
+            self.config.get('ARCHIVE_WRITER', 'command'),
+            self.config.get('ZIP_WORKERS', 1),
+            self.config.get('DEDUPLICATE_ARCHIVES', False)
         )
-        if not resource.zip_file_exists():
-            self.create_zip(resource)
-        else:
-            self.log.info("Found file in cache")
+
+    def _set_upstream_version(self, resource):
+        """Set the version of the upstream data on the resource, if it can be found
+
+        The cached file is then only used if the upstream data hasn't changed
+        since it was built, however old it is (up to REVALIDATE_MAX_AGE
+        seconds). The version is only looked up once by each task.
+
+        @param resource: The ResourceFile to build
+        """
+        if not self._upstream_checked:
+            self._upstream_checked = True
+            try:
+                self._upstream_version = self.upstream_version()
+            except Exception as e:
+                self.log.warning("Failed getting the upstream version: {}".format(e))
+                return
+            if self._upstream_version is not None:
+                self.log.info("Upstream version: {}".format(self._upstream_version))
+        if self._upstream_version is not None:
+            resource.set_version(self._upstream_version,
+                                 self.config.get('REVALIDATE_MAX_AGE', self.config['CACHE_TIME']))
+
+    def _build_zip(self, resource):
+        """Create the ZIP file and email the link, unless an identical task is
+        already building it
+
+        If another task is building the same file, add the email address to the
+        recipients it will send the link to once done, rather than fetching
+        everything again. Otherwise build the file, and send the link to the
+        recipients added meanwhile along with our own.
+
+        @param resource: The ResourceFile to build
+        """
+        lock = resource.build_lock()
+        recipients = resource.pending_recipients()
+        emails = [self.request_params['email']]
+        if not lock.acquire():
+            recipients.add(self.request_params['email'])
+            # check the other task didn't finish (and send its emails) before
+            # we added ourselves, otherwise it's up to us to send them
+            if not lock.acquire():
+                self.log.info("Another task is building the same file, it will email the link")
+                return
+            emails = []
+        try:
+            if resource.zip_file_exists():
+                self.log.info("Found file built by another task")
+            else:
+                resource.start_build()
+                cache_manager = CacheManager.from_config(self.config, self.log)
+                if cache_manager is not None:
+                    # make room for the file before building it
+                    cache_manager.evict(self.expected_size() or 0)
+                self.create_zip(resource)
+                if resource.saved_bytes:
+                    self.log.info("Found an identical file in the store, saving {:.1f}MB".format(
+                        resource.saved_bytes / 1048576.0))
+                if cache_manager is not None:
+                    cache_manager.evict()
+            self._release_build(resource, lock, recipients, emails)
+        finally:
+            lock.release()
+            self._after_build()
+
+    def _after_build(self):
+        """Do the work left once the ZIP file has been built and the link
+        emailed, if any, outside of the build lock
+
+        This must not raise: the file the task was asked for is built, and
+        any work done here must not make the task fail.
+        """
+        pass
+
+    def _release_build(self, resource, lock, recipients, emails):
+        """Email the link to the ZIP file that has been built, to the given
+        recipients and those waiting for it, and release the build lock
+
+        @param resource: The ResourceFile that has been built
+        @param lock: The build lock of the resource, held by this task
+        @param recipients: The PendingRecipients of the resource
+        @param emails: The list of email addresses to send the link to, on
+                       top of the pending recipients
+        """
+        while True:
+            emails.extend(e for e in recipients.take() if e not in emails)
+            if emails:
+                self._send_emails(resource, emails)
+            # recipients may have added themselves after we took the
+            # list; they leave it to us if they can't get the lock
+            lock.release()
+            if not recipients.waiting() or not lock.acquire():
+                break
+            emails = []
+
+    def fail(self, error):
+        """Tell the requester, and the recipients waiting for the same file
+        (see _build_zip), that the file couldn't be built
+
+        This is for tasks that have failed for good, ie. that won't be
+        retried: the tasks of the waiting recipients have already returned,
+        leaving it to this one to email them.
+
+        @param error: The exception the task failed with
+        """
+        resource = self._resource_file()
+        emails = [self.request_params['email']]
+        emails.extend(e for e in resource.pending_recipients().take() if e not in emails)
+        self.log.info("Failed building the file ({}). Emailing {} recipient(s).".format(
+            error, len(emails)))
+        place_holders = {
+            'resource_id': self.request_params['resource_id'],
+            'ckan_host': self.host(),
+            'doi': self.request_params.get('doi', ''),
+        }
+        from_addr = self.config['EMAIL_FROM'].format(zip_file_name='', doi_body='',
+                                                     doi_body_html='', **place_holders)
+        msg = build_message(
+            from_addr,
+            self.config['EMAIL_FAILURE_SUBJECT'].format(**place_holders),
+            self.config['EMAIL_FAILURE_BODY'].format(**place_holders),
+            self.config['EMAIL_FAILURE_BODY_HTML'].format(**place_holders)
+        )
+        try:
+            Mailer.from_config(self.config).send(msg, from_addr, emails)
+        except Exception as e:
+            # don't hide the error the task failed with
+            self.log.warning("Failed emailing the recipients: {}".format(e))
+
+    def _send_emails(self, resource, emails):
+        """Email the link to the ZIP file
+
+        The message is built once, and sent to all the recipients over a
+        single SMTP connection.
+
+        @param resource: The ResourceFile whose ZIP file has been built
+        @param emails: The list of email addresses to send the link to
+        """
+        self.progress.set_phase('emailing')
         zip_file_name = resource.get_zip_file_name()
-        self.log.info("Got ZIP file {}. Emailing link.".format(zip_file_name))
+        self.log.info("Got ZIP file {}. Emailing link to {} recipient(s).".format(
+            zip_file_name, len(emails)))
         # Email the link
         place_holders = {
             'resource_id': self.request_params['resource_id'],
@@ -135,25 +364,13 @@ class PackageTask(object):
                     self.config['DOI_BODY_HTML'].format(**place_holders)
 
         from_addr = self.config['EMAIL_FROM'].format(**place_holders)
-
-        msg = MIMEMultipart('alternative')
-        # add the basics
-        msg['Subject'] = self.config['EMAIL_SUBJECT'].format(**place_holders)
-        msg['From'] = from_addr
-        msg['To'] = self.request_params['email']
-        # add the body as html and text
-        text = MIMEText(self.config['EMAIL_BODY'].format(**place_holders), 'plain')
-        html = MIMEText(self.config['EMAIL_BODY_HTML'].format(**place_holders), 'html')
-        msg.attach(text)
-        msg.attach(html)
-        # send the email
-        server = smtplib.SMTP(self.config['SMTP_HOST'], self.config['SMTP_PORT'])
-        try:
-            if 'SMTP_LOGIN' in self.config:
-                server.login(self.config['SMTP_LOGIN'], self.config['SMTP_PASSWORD'])
-            server.sendmail(from_addr, self.request_params['email'], msg.as_string())
-        finally:
-            server.quit()
+        msg = build_message(
+            from_addr,
+            self.config['EMAIL_SUBJECT'].format(**place_holders),
+            self.config['EMAIL_BODY'].format(**place_holders),
+            self.config['EMAIL_BODY_HTML'].format(**place_holders)
+        )
+        Mailer.from_config(self.config).send(msg, from_addr, emails)
 
     def __str__(self):
         """Return a unique representation of this task"""
@@ -23,17 +23,33 @@ class UrlPackageTask(PackageTask):
         """ Return the expected task duration """
         return 'fast'
 
+    def upstream_version(self):
+        """Return a token identifying the current version of the file
+
+        This is the file's ETag, or failing that its Last-Modified date, as
+        given in response to a HEAD request.
+        """
+        request = urllib2.Request(self.request_params['resource_url'])
+        request.get_method = lambda: 'HEAD'
+        response = urllib2.urlopen(request, timeout=self.config.get('REVALIDATE_TIMEOUT', 10))
+        try:
+            return response.info().get('ETag') or response.info().get('Last-Modified')
+        finally:
+            response.close()
+
     def create_zip(self, resource):
         """Create the ZIP file matching the current request
 
         @return: The ZIP file name
         """
         try:
-            output_stream = resource.get_writer()
+            output_stream = resource.get_writer(stream=True)
             # use a 30 second timeout to stop us hanging forever if the url is unresponsive
             input_stream = urllib2.urlopen(self.request_params['resource_url'], timeout=30)
             self.log.info("Fetching and saving file.")
+            self.progress.set_phase('fetching')
             shutil.copyfileobj(input_stream, output_stream)
+            self.progress.set_phase('zipping')
             resource.create_zip(self.config['ZIP_COMMAND'])
         finally:
             resource.clean_work_files()
@@ -0,0 +1,56 @@
+"""Test the storage of identical ZIP files"""
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equals, assert_true, assert_false, assert_not_equals
+
+from ckanpackager.lib.blob_store import BlobStore, content_digest
+
+
+class TestBlobStore(object):
+
+    def setUp(self):
+        self._root = tempfile.mkdtemp()
+        self._store = BlobStore(self._root)
+
+    def tearDown(self):
+        shutil.rmtree(self._root)
+
+    def _temp_file(self, content):
+        fd, path = tempfile.mkstemp(dir=self._root, prefix='.')
+        os.write(fd, content)
+        os.close(fd)
+        return path
+
+    def test_store(self):
+        """Check a file identical to a stored one is replaced by a link to it"""
+        first = os.path.join(self._root, 'first.zip')
+        second = os.path.join(self._root, 'second.zip')
+        assert_false(self._store.store(self._temp_file('zip'), 'digest', first))
+        temp_file_name = self._temp_file('zip')
+        assert_true(self._store.store(temp_file_name, 'digest', second))
+        assert_false(os.path.exists(temp_file_name))
+        assert_true(os.path.samefile(first, second))
+        assert_true(os.path.samefile(first, self._store.path('digest')))
+        other = os.path.join(self._root, 'other.zip')
+        assert_false(self._store.store(self._temp_file('other'), 'other-digest', other))
+        assert_false(os.path.samefile(first, other))
+
+    def test_remove_orphans(self):
+        """Check blobs are only removed once no file links to them"""
+        first = os.path.join(self._root, 'first.zip')
+        second = os.path.join(self._root, 'second.zip')
+        self._store.store(self._temp_file('zip'), 'digest', first)
+        self._store.store(self._temp_file('zip'), 'digest', second)
+        os.remove(first)
+        assert_equals(0, self._store.remove_orphans())
+        os.remove(second)
+        assert_equals(1, self._store.remove_orphans())
+        assert_false(os.path.exists(self._store.path('digest')))
+
+    def test_content_digest(self):
+        """Check the content digest doesn't depend on the order of the entries"""
+        assert_equals(content_digest({'a': '1', 'b': '2'}), content_digest({'b': '2', 'a': '1'}))
+        assert_not_equals(content_digest({'a': '1', 'b': '2'}),
+                          content_digest({'a': '2', 'b': '1'}))
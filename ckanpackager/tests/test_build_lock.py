@@ -0,0 +1,60 @@
+"""Test the locks on building packages"""
+import os
+import shutil
+import tempfile
+import time
+
+import mock
+from nose.tools import assert_true, assert_false, assert_equals
+
+from ckanpackager.lib.build_lock import BuildLock, remove_stale_locks
+
+
+class TestBuildLock(object):
+
+    def setUp(self):
+        self._root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._root)
+
+    def test_exclusive(self):
+        """Check only one lock on the same key can be held at a time"""
+        lock = BuildLock(self._root, 'key')
+        other = BuildLock(self._root, 'key')
+        assert_true(lock.acquire())
+        assert_false(other.acquire())
+        assert_true(BuildLock(self._root, 'other-key').acquire())
+        lock.release()
+        assert_true(other.acquire())
+        assert_true(other.locked)
+
+    @mock.patch.object(BuildLock, 'POLL_INTERVAL', 0.1)
+    def test_timeout(self):
+        """Check acquiring a held lock gives up after the timeout"""
+        lock = BuildLock(self._root, 'key')
+        lock.acquire()
+        start = time.time()
+        assert_false(BuildLock(self._root, 'key').acquire(0.3))
+        assert_true(time.time() - start >= 0.3)
+        lock.release()
+
+    def test_remove_stale_locks(self):
+        """Check only the unused lock files are removed"""
+        held = BuildLock(self._root, 'held')
+        held.acquire()
+        stale = BuildLock(self._root, 'stale')
+        stale.acquire()
+        stale.release()
+        recent = BuildLock(self._root, 'recent')
+        recent.acquire()
+        recent.release()
+        for path in (held.path, stale.path):
+            os.utime(path, (time.time() - 100, time.time() - 100))
+        assert_equals(1, remove_stale_locks(self._root, time.time() - 50))
+        assert_false(os.path.exists(stale.path))
+        assert_true(os.path.exists(held.path))
+        assert_true(os.path.exists(recent.path))
+        # the lock can still be used after its file has been removed
+        assert_true(stale.acquire())
+        assert_false(BuildLock(self._root, 'stale').acquire())
@@ -0,0 +1,114 @@
+"""Test the index of cached ZIP files"""
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from nose.tools import assert_equals, assert_is_none, assert_true, assert_false
+
+from ckanpackager.lib.cache_index import CacheIndex
+
+BASE = 'a' * 32
+OTHER_BASE = 'b' * 32
+
+
+class TestCacheIndex(object):
+
+    def setUp(self):
+        self._root = tempfile.mkdtemp()
+        self._index = CacheIndex(self._root)
+
+    def tearDown(self):
+        shutil.rmtree(self._root)
+
+    def _create(self, base, age=0, add=True):
+        """Create a ZIP file for the given base name, modified `age` seconds ago"""
+        file_name = os.path.join(self._root, '{}-1-{}.zip'.format(base, int(time.time() - age)))
+        with open(file_name, 'w') as f:
+            f.write('zip')
+        os.utime(file_name, (time.time() - age, time.time() - age))
+        if add:
+            self._index.add(base, file_name, created=time.time() - age)
+        return file_name
+
+    def test_lookup(self):
+        """Check the most recent file for a base name is found, within the given age"""
+        self._create(BASE, age=100)
+        newest = self._create(BASE, age=10)
+        self._create(OTHER_BASE)
+        assert_equals(newest, self._index.lookup(BASE, 60))
+        assert_is_none(self._index.lookup(BASE, 5))
+        assert_is_none(self._index.lookup('c' * 32, 60))
+
+    def test_remove(self):
+        """Check removed files are no longer found"""
+        file_name = self._create(BASE)
+        os.remove(file_name)
+        self._index.remove(file_name)
+        assert_is_none(self._index.lookup(BASE, 60))
+
+    def test_missing_file(self):
+        """Check files deleted without going through the index are skipped"""
+        older = self._create(BASE, age=10)
+        os.remove(self._create(BASE))
+        assert_equals(older, self._index.lookup(BASE, 60))
+
+    def test_rebuild(self):
+        """Check the index is filled from the store directory when created, and can be rebuilt"""
+        file_name = self._create(BASE, add=False)
+        # not ZIP files built by ckanpackager
+        open(os.path.join(self._root, 'gbif.zip'), 'w').close()
+        assert_equals(file_name, self._index.lookup(BASE, 60))
+        other = self._create(OTHER_BASE, add=False)
+        assert_is_none(self._index.lookup(OTHER_BASE, 60))
+        assert_equals(2, self._index.rebuild())
+        assert_equals(other, self._index.lookup(OTHER_BASE, 60))
+
+    def test_lost_index(self):
+        """Check the index is rebuilt if its database is deleted"""
+        file_name = self._create(BASE)
+        shutil.rmtree(self._index.folder)
+        assert_equals(file_name, CacheIndex(self._root).lookup(BASE, 60))
+
+    def test_hidden_folder(self):
+        """Check the index is kept in a hidden folder of the store directory"""
+        self._create(BASE)
+        assert_true(os.path.basename(self._index.folder).startswith('.'))
+        assert_false(os.path.isfile(self._index.folder))
+
+    def test_manifests(self):
+        """Check manifests are returned for the files of a resource, and kept when rebuilding"""
+        file_name = os.path.join(self._root, '{}-1-1.zip'.format(BASE))
+        open(file_name, 'w').close()
+        self._index.add(BASE, file_name, {'resource_id': 'resource', 'rows': 10})
+        self._create(OTHER_BASE)
+        assert_equals([(file_name, {'resource_id': 'resource', 'rows': 10})],
+                      self._index.manifests('resource', 60))
+        assert_equals([], self._index.manifests('other-resource', 60))
+        # files indexed without a version aren't known to be from any version
+        assert_equals([], self._index.manifests('resource', 60, 'v1'))
+        versioned = os.path.join(self._root, '{}-1-2.zip'.format(BASE))
+        open(versioned, 'w').close()
+        self._index.add(BASE, versioned, {'resource_id': 'resource', 'rows': 5}, version='v1')
+        assert_equals([(versioned, {'resource_id': 'resource', 'rows': 5})],
+                      self._index.manifests('resource', 60, 'v1'))
+        os.remove(versioned)
+        self._index.remove(versioned)
+        self._index.rebuild()
+        assert_equals(1, len(self._index.manifests('resource', 60)))
+        os.remove(file_name)
+        self._index.remove(file_name)
+        assert_equals([], self._index.manifests('resource', 60))
+
+    def test_old_index(self):
+        """Check an index created by an older version is rebuilt"""
+        file_name = self._create(BASE, add=False)
+        os.makedirs(self._index.folder)
+        connection = sqlite3.connect(self._index.path)
+        connection.execute('CREATE TABLE files (name TEXT PRIMARY KEY, base TEXT NOT NULL, '
+                           'created REAL NOT NULL)')
+        connection.commit()
+        connection.close()
+        assert_equals(file_name, self._index.lookup(BASE, 60))
+        assert_equals([3], [entry['size'] for entry in self._index.files()])
@@ -0,0 +1,82 @@
+"""Test the eviction of cached files"""
+import os
+import shutil
+import tempfile
+import time
+
+from nose.tools import assert_equals, assert_raises
+
+from ckanpackager.lib.cache_index import CacheIndex
+from ckanpackager.lib.cache_manager import CacheManager
+
+
+class TestCacheManager(object):
+
+    def setUp(self):
+        self._root = tempfile.mkdtemp()
+        self._index = CacheIndex(self._root)
+
+    def tearDown(self):
+        shutil.rmtree(self._root)
+
+    def _create(self, letter, size, age, build_time=0):
+        """Create a cached file of the given size, last used `age` seconds ago"""
+        file_name = os.path.join(self._root, '{}-1-1.zip'.format(letter * 32))
+        with open(file_name, 'w') as f:
+            f.write('x' * size)
+        os.utime(file_name, (time.time() - age, time.time() - age))
+        self._index.add(letter * 32, file_name, build_time=build_time, created=time.time() - age)
+        return file_name
+
+    def _remaining(self):
+        return sorted(os.path.basename(entry['file_name'])[0] for entry in self._index.files())
+
+    def test_under_budget(self):
+        """Check nothing is evicted when the files fit in the budget"""
+        self._create('a', 100, 100)
+        self._create('b', 100, 50)
+        assert_equals((0, 0), CacheManager(self._root, 200).evict())
+        assert_equals(['a', 'b'], self._remaining())
+
+    def test_lru(self):
+        """Check the least recently used files are evicted first"""
+        a = self._create('a', 100, 300)
+        self._create('b', 100, 200)
+        self._create('c', 100, 100)
+        self._index.touch(a)
+        assert_equals((1, 100), CacheManager(self._root, 250).evict())
+        assert_equals(['a', 'c'], self._remaining())
+        assert_equals(2, len([f for f in os.listdir(self._root) if f.endswith('.zip')]))
+        # make room for a file about to be added
+        assert_equals((1, 100), CacheManager(self._root, 250).evict(required=100))
+        assert_equals(['a'], self._remaining())
+
+    def test_cost(self):
+        """Check the files saving the least build time per byte are evicted first"""
+        self._create('a', 100, 300, build_time=100)
+        self._create('b', 1000, 200, build_time=100)
+        self._create('c', 100, 100, build_time=1)
+        assert_equals((2, 1100), CacheManager(self._root, 500, policy='cost').evict())
+        assert_equals(['a'], self._remaining())
+
+    def test_protected_files(self):
+        """Check recently used and symlinked files aren't evicted"""
+        a = self._create('a', 100, 300)
+        self._create('b', 100, 200)
+        self._create('c', 100, 10)
+        os.symlink(os.path.basename(a), os.path.join(self._root, 'dump.zip'))
+        assert_equals((1, 100), CacheManager(self._root, 100, min_age=60).evict())
+        assert_equals(['a', 'c'], self._remaining())
+
+    def test_unknown_policy(self):
+        """Check an unknown policy is refused"""
+        with assert_raises(ValueError):
+            CacheManager(self._root, 100, policy='random')
+
+    def test_from_config(self):
+        """Check no manager is created without a budget"""
+        assert_equals(None, CacheManager.from_config({'STORE_DIRECTORY': self._root}))
+        manager = CacheManager.from_config({'STORE_DIRECTORY': self._root,
+                                            'CACHE_MAX_BYTES': 100,
+                                            'CACHE_EVICTION_POLICY': 'cost'})
+        assert_equals(100, manager.max_bytes)
@@ -1,11 +1,14 @@
 """Test the CkanResource class"""
 import copy
 import json
+import zlib
 
 import httpretty
-from nose.tools import assert_equals, assert_raises, assert_false
+import mock
+from nose.tools import assert_equals, assert_raises, assert_false, assert_true
 
 from ckanpackager.lib.ckan_resource import CkanResource, StreamError
+from ckanpackager.lib.page_sizer import PageSizer
 
 # for convenience, here's an empty CKAN body response
 EMPTY_BODY = json.dumps({'result': {'records': []}})
@@ -115,6 +118,173 @@ class TestCkanResource(object):
         with assert_raises(StreamError):
             list(r.get_records())
 
+    def test_session_shared_per_host(self):
+        """
+        Ensure resources on the same host share a pooled session, and other hosts don't
+        """
+        r1 = CkanResource('http://somewhere.com/test', None, 1, {})
+        r2 = CkanResource('http://somewhere.com/other', None, 1, {})
+        r3 = CkanResource('http://elsewhere.com/test', None, 1, {})
+        assert_true(r1.session is r2.session)
+        assert_false(r1.session is r3.session)
+
+    @httpretty.activate
+    def test_page_stats(self):
+        """
+        Ensure the timings of each page are recorded
+        """
+        responses = [
+            httpretty.Response(json.dumps({'result': {'records': [1, 2]}})),
+            httpretty.Response(EMPTY_BODY),
+        ]
+        httpretty.register_uri(httpretty.POST, 'http://somewhere.com/test', responses=responses)
+        r = CkanResource('http://somewhere.com/test', None, 2, {})
+        list(r.get_records())
+        assert_equals([s['records'] for s in r.page_stats], [2, 0])
+        summary = r.stats_summary()
+        assert_equals(summary['pages'], 2)
+        assert_equals(summary['records'], 2)
+
+    @httpretty.activate
+    def test_prefetch(self):
+        """
+        Ensure records are returned in order when pages are prefetched, and that pages aren't
+        requested beyond the requested limit
+        """
+        responses = [
+            httpretty.Response(json.dumps({'result': {'records': [i, i + 1]}}))
+            for i in range(0, 10, 2)
+        ]
+        httpretty.register_uri(httpretty.POST, 'http://somewhere.com/test', responses=responses)
+        r = CkanResource('http://somewhere.com/test', None, 2, {'limit': 7}, prefetch_pages=2)
+        assert_equals(list(r.get_records()), list(range(7)))
+        assert_equals(len(httpretty.latest_requests()), 4)
+
+    def test_parallel(self):
+        """
+        Ensure records are returned in order when pages are fetched concurrently, and that fetching
+        stops at the end of the records
+        """
+        def fetch_page(params):
+            return {'records': list(range(params['offset'],
+                                          min(params['offset'] + params['limit'], 25)))}
+
+        r = CkanResource('http://somewhere.com/test', None, 4, {}, parallel=3)
+        # httpretty isn't thread safe so we fake the page requests instead
+        with mock.patch.object(r, '_fetch_page', side_effect=fetch_page):
+            assert_equals(list(r.get_records()), list(range(25)))
+
+    def test_parallel_limit(self):
+        """
+        Ensure the offset and limit are respected when pages are fetched concurrently
+        """
+        def fetch_page(params):
+            return {'records': list(range(params['offset'], params['offset'] + params['limit']))}
+
+        r = CkanResource('http://somewhere.com/test', None, 4, {'offset': 3, 'limit': 10},
+                         parallel=3)
+        with mock.patch.object(r, '_fetch_page', side_effect=fetch_page) as fetch:
+            assert_equals(list(r.get_records()), list(range(3, 13)))
+        assert_equals(sorted((c[0][0]['offset'], c[0][0]['limit']) for c in fetch.call_args_list),
+                      [(3, 4), (7, 4), (11, 2)])
+
+    def test_parallel_capped_pages(self):
+        """
+        Ensure an error is raised when pages fetched concurrently hold fewer records than expected,
+        rather than the records being cut short
+        """
+        def fetch_page(params):
+            # the server returns at most 3 records whatever the limit
+            return {'records': list(range(params['offset'],
+                                          min(params['offset'] + min(params['limit'], 3), 25)))}
+
+        for total, params in [(25, {}), (None, {'limit': 10})]:
+            r = CkanResource('http://somewhere.com/test', None, 4, params, parallel=3)
+            r.total = total
+            with mock.patch.object(r, '_fetch_page', side_effect=fetch_page):
+                with assert_raises(StreamError):
+                    list(r.get_records())
+
+    @httpretty.activate
+    def test_stream(self):
+        """
+        Ensure records are parsed from streamed responses and that the cursor which follows them is
+        used for the next request
+        """
+        responses = [
+            httpretty.Response(json.dumps({'result': {'records': [{'a': 1}, {'a': 2}],
+                                                      'next_cursor': 'next!'}})),
+            httpretty.Response(json.dumps({'result': {'records': [], 'next_cursor': 'end'}})),
+        ]
+        httpretty.register_uri(httpretty.POST, 'http://somewhere.com/test', responses=responses)
+        r = CkanResource('http://somewhere.com/test', None, 2, {}, stream=True)
+        assert_equals(list(r.get_records('solr')), [{'a': 1}, {'a': 2}])
+        assert_equals(json.loads(httpretty.last_request().body)['cursor'], 'next!')
+
+    @httpretty.activate
+    def test_stream_batches(self):
+        """
+        Ensure streamed pages are handed over in batches
+        """
+        responses = [
+            httpretty.Response(json.dumps({'result': {'records': list(range(5))}})),
+            httpretty.Response(EMPTY_BODY),
+        ]
+        httpretty.register_uri(httpretty.POST, 'http://somewhere.com/test', responses=responses)
+        r = CkanResource('http://somewhere.com/test', None, 5, {}, stream=True)
+        r.STREAM_BATCH_SIZE = 2
+        pages = r._get_pages(*r._initial_params(None))
+        assert_equals([records for records, _state in pages], [[0, 1], [2, 3], [4]])
+
+    @httpretty.activate
+    def test_stream_failure(self):
+        """
+        Ensure an exception is raised when a streamed response can't be parsed
+        """
+        httpretty.register_uri(httpretty.POST, 'http://somewhere.com/test',
+                               body='{"result": {"records": [{"a": 1}, {"a"')
+        r = CkanResource('http://somewhere.com/test', None, 5, {}, stream=True)
+        with assert_raises(StreamError):
+            list(r.get_records())
+
+    @httpretty.activate
+    def test_page_sizer(self):
+        """
+        Ensure the page size is changed between pages when a page sizer is given, and that the
+        offsets follow the size of each page
+        """
+        responses = [
+            httpretty.Response(json.dumps({'result': {'records': list(range(2))}})),
+            httpretty.Response(json.dumps({'result': {'records': list(range(4))}})),
+            httpretty.Response(EMPTY_BODY),
+        ]
+        httpretty.register_uri(httpretty.POST, 'http://somewhere.com/test', responses=responses)
+        # the pages will be much quicker than the target duration so the page size doubles, up to
+        # the maximum of 4
+        sizer = PageSizer(2, 1, 4, 10)
+        r = CkanResource('http://somewhere.com/test', None, 2, {}, page_sizer=sizer)
+        assert_equals(len(list(r.get_records())), 6)
+        assert_equals(sizer.pages, 2)
+        assert_equals(sizer.decisions[0][1:3], (2, 4))
+        assert_equals(json.loads(httpretty.last_request().body), {'offset': 6, 'limit': 4})
+
+    @httpretty.activate
+    def test_server_capped_pages(self):
+        """
+        Ensure no records are skipped when the server returns fewer records than were requested
+        """
+        def search(request, uri, headers):
+            params = json.loads(request.body)
+            # the server returns at most 2 records whatever the limit
+            records = list(range(7))[params['offset']:params['offset'] + min(params['limit'], 2)]
+            return 200, headers, json.dumps({'result': {'records': records}})
+
+        httpretty.register_uri(httpretty.POST, 'http://somewhere.com/test', body=search)
+        r = CkanResource('http://somewhere.com/test', None, 3, {})
+        assert_equals(list(r.get_records()), list(range(7)))
+        r = CkanResource('http://somewhere.com/test', None, 3, {'offset': 1, 'limit': 5})
+        assert_equals(list(r.get_records()), list(range(1, 6)))
+
     def test_solr_before(self):
         resource = CkanResource('http://somewhere.com/test', None, 1, {})
         request_params = {'offset': 12}
@@ -126,7 +296,7 @@ class TestCkanResource(object):
         resource = CkanResource('http://somewhere.com/test', None, 1, {})
         request_params = {'cursor': '*'}
         result = {'next_cursor': 'next one!'}
-        resource._solr_after(request_params, result)
+        resource._solr_after(request_params, result, 1)
         assert_equals(request_params['cursor'], 'next one!')
 
     def test_versioned_datastore_before(self):
@@ -139,7 +309,7 @@ class TestCkanResource(object):
         resource = CkanResource('http://somewhere.com/test', None, 1, {})
         request_params = {'cursor': '*'}
         result = {'after': 'next one!'}
-        resource._versioned_datastore_after(request_params, result)
+        resource._versioned_datastore_after(request_params, result, 1)
         assert_equals(request_params['after'], 'next one!')
 
     def test_default_before(self):
@@ -153,5 +323,157 @@ class TestCkanResource(object):
     def test_default_after(self):
         resource = CkanResource('http://somewhere.com/test', None, 1, {})
         request_params = {'offset': 10, 'limit': 32}
-        resource._default_after(request_params, {})
+        resource._default_after(request_params, {}, 32)
         assert_equals(request_params['offset'], 42)
+        # a page capped by the server moves the offset on by the records it held
+        resource._default_after(request_params, {}, 20)
+        assert_equals(request_params['offset'], 62)
+
+    @httpretty.activate
+    def test_retry(self):
+        """
+        Ensure requests failing with a transient error are retried
+        """
+        responses = [
+            httpretty.Response('', status=503),
+            httpretty.Response(json.dumps({'result': {'records': [{'a': 1}]}})),
+            httpretty.Response(EMPTY_BODY),
+        ]
+        httpretty.register_uri(httpretty.POST, 'http://somewhere.com/test', responses=responses)
+        r = CkanResource('http://somewhere.com/test', None, 1, {}, retries=1, retry_backoff=0)
+        assert_equals(list(r.get_records()), [{'a': 1}])
+        assert_equals(r.stats_summary()['retries'], 1)
+
+    @httpretty.activate
+    def test_retry_gives_up(self):
+        """
+        Ensure a StreamError is raised once the retries are used up, and that other errors aren't
+        retried
+        """
+        httpretty.register_uri(httpretty.POST, 'http://somewhere.com/test', status=500)
+        r = CkanResource('http://somewhere.com/test', None, 1, {}, retries=2, retry_backoff=0)
+        with assert_raises(StreamError):
+            list(r.get_records())
+        assert_equals(len(httpretty.latest_requests()), 3)
+
+        httpretty.reset()
+        httpretty.register_uri(httpretty.POST, 'http://somewhere.com/test', status=403)
+        r = CkanResource('http://somewhere.com/test', None, 1, {}, retries=2, retry_backoff=0)
+        with assert_raises(StreamError):
+            list(r.get_records())
+        assert_equals(len(httpretty.latest_requests()), 1)
+
+    @httpretty.activate
+    def test_retry_mid_stream(self):
+        """
+        Ensure a streamed page cut short is requested again with the same cursor and that the
+        records already returned are skipped
+        """
+        page = json.dumps({'result': {'records': [{'a': 1}, {'a': 2}], 'next_cursor': 'next!'}})
+        responses = [
+            httpretty.Response(page[:page.index('{"a": 2}')]),
+            httpretty.Response(page),
+            httpretty.Response(EMPTY_BODY),
+        ]
+        httpretty.register_uri(httpretty.POST, 'http://somewhere.com/test', responses=responses)
+        r = CkanResource('http://somewhere.com/test', None, 2, {}, stream=True, retries=1,
+                         retry_backoff=0)
+        r.STREAM_BATCH_SIZE = 1
+        assert_equals(list(r.get_records('solr')), [{'a': 1}, {'a': 2}])
+        bodies = [json.loads(request.body) for request in httpretty.latest_requests()]
+        assert_equals([body['cursor'] for body in bodies], ['*', '*', 'next!'])
+
+    @httpretty.activate
+    def test_checkpoint_resume(self):
+        """
+        Ensure the paging state passed to the checkpoint function lets a later call carry on after
+        the last record consumed
+        """
+        records = [{'a': i} for i in range(5)]
+
+        def respond(request, uri, headers):
+            body = json.loads(request.body)
+            if 'cursor' in body:
+                start = int(body['cursor'].replace('*', '0'))
+            else:
+                start = body['offset']
+            page = records[start:start + body['limit']]
+            result = {'records': page, 'next_cursor': str(start + len(page))}
+            return 200, headers, json.dumps({'result': result})
+
+        httpretty.register_uri(httpretty.POST, 'http://somewhere.com/test', body=respond)
+        for backend in (None, 'solr'):
+            r = CkanResource('http://somewhere.com/test', None, 2, {}, stream=True)
+            r.STREAM_BATCH_SIZE = 1
+            states = []
+            assert_equals(list(r.get_records(backend, checkpoint=states.append)), records)
+            assert_equals([state['count'] for state in states], [1, 2, 3, 4, 5])
+            for state in states:
+                state = json.loads(json.dumps(state))
+                r = CkanResource('http://somewhere.com/test', None, 2, {})
+                assert_equals(list(r.get_records(backend, resume=state)),
+                              records[state['count']:])
+
+    @httpretty.activate
+    def test_compression(self):
+        """
+        Ensure compressed responses are asked for and decoded, with the bytes transferred and
+        decoded counted
+        """
+        page = json.dumps({'result': {'records': [{'a': 'aaaaaaaaaa'}] * 100}})
+        for stream in (False, True):
+            httpretty.reset()
+            responses = [
+                httpretty.Response(zlib.compress(page), adding_headers={
+                    'Content-Encoding': 'deflate'}),
+                httpretty.Response(EMPTY_BODY),
+            ]
+            httpretty.register_uri(httpretty.POST, 'http://somewhere.com/test',
+                                   responses=responses)
+            r = CkanResource('http://somewhere.com/test', None, 100, {}, stream=stream)
+            assert_equals(len(list(r.get_records())), 100)
+            assert_true('deflate' in httpretty.latest_requests()[0].headers['accept-encoding'])
+            assert_equals(r.page_stats[0]['bytes'], len(page))
+            assert_equals(r.page_stats[0]['wire_bytes'], len(zlib.compress(page)))
+            summary = r.stats_summary()
+            assert_equals(summary['bytes'], len(page) + len(EMPTY_BODY))
+            assert_equals(summary['wire_bytes'], len(zlib.compress(page)) + len(EMPTY_BODY))
+
+        r = CkanResource('http://somewhere.com/test', None, 100, {}, compress=False)
+        list(r.get_records())
+        assert_equals(httpretty.last_request().headers['accept-encoding'], 'identity')
+
+    @httpretty.activate
+    def test_get_version(self):
+        """
+        Ensure the version of the resource is made of its modification dates
+        """
+        def resource_show(last_modified):
+            return httpretty.Response(json.dumps({'success': True, 'result': {
+                'last_modified': last_modified, 'metadata_modified': '2020-01-01T00:00:00'}}))
+
+        httpretty.register_uri(httpretty.POST, 'http://somewhere.com/action/resource_show',
+                               responses=[resource_show('2020-02-02T00:00:00'),
+                                          resource_show(None)])
+        r = CkanResource('http://somewhere.com/action/datastore_search', None, 10,
+                         {'resource_id': 'the-resource'})
+        assert_equals(r.get_version(), '2020-02-02T00:00:00|2020-01-01T00:00:00')
+        assert_equals(json.loads(httpretty.last_request().body), {'id': 'the-resource'})
+        assert_equals(r.get_version(), '|2020-01-01T00:00:00')
+
+    @httpretty.activate
+    def test_get_total(self):
+        """
+        Ensure the number of records and fields is asked for with a request for no records
+        """
+        httpretty.register_uri(httpretty.POST, 'http://somewhere.com/test', responses=[
+            httpretty.Response(json.dumps({'success': True, 'result': {
+                'total': 12, 'fields': [{'id': 'a'}, {'id': 'b'}], 'records': []}})),
+            httpretty.Response(json.dumps({'success': True, 'result': {'records': []}})),
+        ])
+        r = CkanResource('http://somewhere.com/test', None, 10,
+                         {'resource_id': 'the-resource', 'q': 'carrot', 'offset': 5, 'limit': 20})
+        assert_equals(r.get_total(), (12, 2))
+        assert_equals(json.loads(httpretty.last_request().body),
+                      {'resource_id': 'the-resource', 'q': 'carrot', 'offset': 0, 'limit': 0})
+        assert_equals(r.get_total(), None)
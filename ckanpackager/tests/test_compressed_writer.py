@@ -0,0 +1,69 @@
+"""Test compressing files as they are written"""
+import gzip
+from cStringIO import StringIO
+
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equals, assert_true, assert_false, assert_raises
+
+from ckanpackager.lib import compressed_writer
+from ckanpackager.lib.compressed_writer import CompressedWriter, compression_available
+
+
+class Output(object):
+    """File object keeping what was written to it once closed"""
+
+    def __init__(self):
+        self.data = StringIO()
+        self.closed = False
+
+    def write(self, data):
+        self.data.write(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class TestCompressedWriter(object):
+
+    def _write(self, compression, *chunks):
+        output = Output()
+        writer = CompressedWriter(output, compression)
+        for chunk in chunks:
+            writer.write(chunk)
+        writer.close()
+        writer.close()
+        assert_true(writer.closed)
+        assert_true(output.closed)
+        return output.data.getvalue()
+
+    def test_gzip(self):
+        """Check the data is written as gzip, whose members can be concatenated"""
+        data = self._write('gzip', 'some', ' data\n' * 1000) + self._write('gzip', 'more\n')
+        assert_equals('some' + ' data\n' * 1000 + 'more\n',
+                      gzip.GzipFile(fileobj=StringIO(data)).read())
+        assert_true(len(data) < 1000)
+
+    def test_zstd(self):
+        """Check the data is written as zstd frames"""
+        if not compression_available('zstd'):
+            raise SkipTest("zstandard isn't installed")
+        data = self._write('zstd', 'some', ' data\n' * 1000)
+        reader = compressed_writer.zstandard.ZstdDecompressor().stream_reader(StringIO(data))
+        assert_equals('some' + ' data\n' * 1000, reader.read(100000))
+
+    def test_available(self):
+        """Check which compressions are available"""
+        assert_true(compression_available(None))
+        assert_true(compression_available('gzip'))
+        assert_false(compression_available('lzma'))
+        zstandard = compressed_writer.zstandard
+        try:
+            compressed_writer.zstandard = None
+            assert_false(compression_available('zstd'))
+        finally:
+            compressed_writer.zstandard = zstandard
+        with assert_raises(ValueError):
+            CompressedWriter(Output(), 'lzma')
@@ -0,0 +1,105 @@
+"""Test the decoding of compressed responses"""
+import gzip
+import StringIO
+import zlib
+
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equals, assert_raises, assert_true
+
+from ckanpackager.lib import content_encoding
+from ckanpackager.lib.content_encoding import DecodingReader, accept_encoding
+
+BODY = '{"result": {"records": [' + ', '.join(['{"a": %d}' % i for i in range(5000)]) + ']}}'
+
+
+def gzipped(data):
+    out = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as f:
+        f.write(data)
+    return out.getvalue()
+
+
+def raw_deflated(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class TestDecodingReader(object):
+
+    def test_encodings(self):
+        """
+        Ensure gzip, deflate (with and without the zlib wrapper) and unencoded bodies are decoded
+        and the bytes are counted
+        """
+        cases = [
+            ('gzip', gzipped(BODY)),
+            ('deflate', zlib.compress(BODY)),
+            ('deflate', raw_deflated(BODY)),
+            ('', BODY),
+            ('identity', BODY),
+        ]
+        for encoding, data in cases:
+            reader = DecodingReader(StringIO.StringIO(data), encoding)
+            assert_equals(reader.read(), BODY)
+            assert_equals(reader.bytes_read, len(BODY))
+            assert_equals(reader.wire_bytes, len(data))
+
+    def test_one_byte_chunks(self):
+        """
+        Ensure zlib and raw deflate bodies are decoded when they arrive a byte at a time
+        """
+        chunk_size = content_encoding.CHUNK_SIZE
+        try:
+            content_encoding.CHUNK_SIZE = 1
+            for data in (zlib.compress(BODY), raw_deflated(BODY)):
+                reader = DecodingReader(StringIO.StringIO(data), 'deflate')
+                assert_equals(reader.read(), BODY)
+                assert_equals(reader.wire_bytes, len(data))
+        finally:
+            content_encoding.CHUNK_SIZE = chunk_size
+
+    def test_small_reads(self):
+        """
+        Ensure the body can be read in small pieces
+        """
+        reader = DecodingReader(StringIO.StringIO(gzipped(BODY)), 'gzip')
+        pieces = []
+        while True:
+            piece = reader.read(1000)
+            if not piece:
+                break
+            assert_true(len(piece) <= 1000)
+            pieces.append(piece)
+        assert_equals(''.join(pieces), BODY)
+        assert_equals(reader.bytes_read, len(BODY))
+
+    def test_brotli(self):
+        """
+        Ensure brotli bodies are decoded when the brotli module is installed
+        """
+        if content_encoding.brotli is None:
+            raise SkipTest("brotli isn't installed")
+        data = content_encoding.brotli.compress(BODY)
+        reader = DecodingReader(StringIO.StringIO(data), 'br')
+        assert_equals(reader.read(), BODY)
+        assert_equals(reader.wire_bytes, len(data))
+
+    def test_unsupported(self):
+        """
+        Ensure an error is raised for encodings we can't decode
+        """
+        with assert_raises(ValueError):
+            DecodingReader(StringIO.StringIO(BODY), 'compress')
+
+    def test_accept_encoding(self):
+        """
+        Ensure brotli is only advertised when the brotli module is available
+        """
+        brotli = content_encoding.brotli
+        try:
+            content_encoding.brotli = None
+            assert_equals(accept_encoding(), 'gzip, deflate')
+            content_encoding.brotli = object()
+            assert_equals(accept_encoding(), 'gzip, deflate, br')
+        finally:
+            content_encoding.brotli = brotli
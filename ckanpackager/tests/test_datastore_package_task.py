@@ -1,12 +1,26 @@
 """Test the DatastorePackageClass class"""
 
+import os
+import gzip
 import json
+import shutil
 import httpretty
 import urlparse
 import tempfile
-from nose.tools import assert_raises, assert_equals, assert_true
+import zipfile
+import subprocess
+from contextlib import closing
+from io import BytesIO
+import mock
+from nose.plugins.skip import SkipTest
+from openpyxl import load_workbook
+from nose.tools import assert_raises, assert_equals, assert_true, assert_false
+from ckanpackager.lib.ckan_resource import StreamError
+from ckanpackager.lib.parquet_sink import parquet_available
+from ckanpackager.lib.resource_file import ResourceFile
+from ckanpackager.lib.statistics import CkanPackagerStatistics
 from ckanpackager.lib.utils import BadRequestError
-from ckanpackager.tasks.datastore_package_task import DatastorePackageTask
+from ckanpackager.tasks.datastore_package_task import DatastorePackageTask, _totals
 
 
 class FakeCSVWriter(object):
@@ -20,6 +34,9 @@ class FakeCSVWriter(object):
     def writerow(self, row):
         self.rows.append(row)
 
+    def writerows(self, rows):
+        self.rows.extend(rows)
+
 
 class DummyResource(object):
     """
@@ -31,13 +48,13 @@ class DummyResource(object):
         self.create_invoked = False
         self.clean_invoked = False
 
-    def get_csv_writer(self, file_name):
+    def get_csv_writer(self, file_name, stream=False, encoded=False):
         return FakeCSVWriter(self.rows)
 
     def create_zip(self, command):
         self.create_invoked = True
 
-    def clean_work_files(self):
+    def clean_work_files(self, keep_resumable=False):
         self.clean_invoked = True
 
     def zip_file_exits(self):
@@ -134,6 +151,472 @@ class TestDatastorePackageTask(object):
         self._task.create_zip(r)
         assert_true(r.clean_invoked)
 
+    @httpretty.activate
+    def test_resume(self):
+        """
+        Ensure a task failing part way through resumes from the last record written when retried
+        """
+        self._config['RESUMABLE_TASKS'] = True
+        self._config['PAGE_SIZE'] = 2
+        fields = httpretty.Response(json.dumps({'result': {'fields': [{'id': 'field1'}]}}))
+
+        def page(*values):
+            records = [{'field1': value} for value in values]
+            return httpretty.Response(json.dumps({'result': {'records': records}}))
+
+        httpretty.register_uri(httpretty.POST, 'http://example.com/datastore/search',
+                               responses=[fields, page('a', 'b'),
+                                          httpretty.Response('', status=403)])
+        root = tempfile.mkdtemp()
+        temp_dir = tempfile.mkdtemp()
+        try:
+            resource = ResourceFile(self._task.request_params, root, temp_dir, 60)
+            with assert_raises(StreamError):
+                self._task.create_zip(resource)
+
+            httpretty.reset()
+            httpretty.register_uri(httpretty.POST, 'http://example.com/datastore/search',
+                                   responses=[fields, page('c'), page()])
+            resource = ResourceFile(self._task.request_params, root, temp_dir, 60)
+            self._task.create_zip(resource)
+            offsets = [json.loads(r.body)['offset'] for r in httpretty.latest_requests()]
+            # the offset moves on by the records received
+            assert_equals(offsets, [0, 2, 3])
+            p = subprocess.Popen(['unzip', '-p', resource.get_zip_file_name()],
+                                 stdout=subprocess.PIPE)
+            assert_equals(p.stdout.read(), 'field1\na\nb\nc\n')
+        finally:
+            shutil.rmtree(root)
+            shutil.rmtree(temp_dir)
+
+    @httpretty.activate
+    def test_derive_from_cache(self):
+        """
+        Ensure a package holding the requested records and fields is used instead of CKAN
+        """
+        self._config['DERIVE_FROM_CACHE'] = True
+        fields = httpretty.Response(json.dumps(
+            {'result': {'fields': [{'id': 'field1'}, {'id': 'field2'}]}}))
+        records = [{'field1': 'a' + str(i), 'field2': 'b' + str(i)} for i in range(3)]
+        httpretty.register_uri(httpretty.POST, 'http://example.com/datastore/search',
+                               responses=[fields, httpretty.Response(json.dumps(
+                                   {'result': {'records': records}})),
+                                   httpretty.Response(json.dumps({'result': {'records': []}}))])
+        root = tempfile.mkdtemp()
+        temp_dir = tempfile.mkdtemp()
+        try:
+            self._task.create_zip(ResourceFile(self._task.request_params, root, temp_dir, 60))
+
+            # CKAN now fails, so the packages must come from the cache
+            httpretty.reset()
+            httpretty.register_uri(httpretty.POST, 'http://example.com/datastore/search',
+                                   status=403, body='')
+            params = dict(self._task.request_params, fields='field2', offset='1', limit='1',
+                          format='tsv')
+            task = DatastorePackageTask(params, self._config)
+            resource = ResourceFile(task.request_params, root, temp_dir, 60)
+            task.create_zip(resource)
+            p = subprocess.Popen(['unzip', '-p', resource.get_zip_file_name()],
+                                 stdout=subprocess.PIPE)
+            assert_equals(p.stdout.read(), 'field2\nb1\n')
+
+            # different filters select different records
+            params = dict(self._task.request_params, filters='{"field1": "a1"}')
+            task = DatastorePackageTask(params, self._config)
+            with assert_raises(StreamError):
+                task.create_zip(ResourceFile(task.request_params, root, temp_dir, 60))
+
+            # xlsx packages keep the types of the values, which the cached package has lost
+            params = dict(self._task.request_params, format='xlsx')
+            task = DatastorePackageTask(params, self._config)
+            with assert_raises(StreamError):
+                task.create_zip(ResourceFile(task.request_params, root, temp_dir, 60))
+        finally:
+            shutil.rmtree(root)
+            shutil.rmtree(temp_dir)
+
+    @httpretty.activate
+    def test_derive_same_version(self):
+        """
+        Ensure packages are only derived from packages built from the same upstream version
+        """
+        self._config['DERIVE_FROM_CACHE'] = True
+        fields = httpretty.Response(json.dumps(
+            {'result': {'fields': [{'id': 'field1'}, {'id': 'field2'}]}}))
+        records = [{'field1': 'a' + str(i), 'field2': 'b' + str(i)} for i in range(3)]
+        httpretty.register_uri(httpretty.POST, 'http://example.com/datastore/search',
+                               responses=[fields, httpretty.Response(json.dumps(
+                                   {'result': {'records': records}})),
+                                   httpretty.Response(json.dumps({'result': {'records': []}}))])
+        root = tempfile.mkdtemp()
+        temp_dir = tempfile.mkdtemp()
+        try:
+            resource = ResourceFile(self._task.request_params, root, temp_dir, 60)
+            resource.set_version('v1', 60)
+            self._task.create_zip(resource)
+
+            # CKAN now fails, so the packages must come from the cache
+            httpretty.reset()
+            httpretty.register_uri(httpretty.POST, 'http://example.com/datastore/search',
+                                   status=403, body='')
+            task = DatastorePackageTask(dict(self._task.request_params, fields='field2'),
+                                        self._config)
+            resource = ResourceFile(task.request_params, root, temp_dir, 60)
+            resource.set_version('v2', 60)
+            with assert_raises(StreamError):
+                task.create_zip(resource)
+            resource = ResourceFile(task.request_params, root, temp_dir, 60)
+            resource.set_version('v1', 60)
+            task.create_zip(resource)
+            assert_true(resource.zip_file_exists())
+        finally:
+            shutil.rmtree(root)
+            shutil.rmtree(temp_dir)
+
+    @httpretty.activate
+    def test_cached_revalidates(self):
+        """
+        Ensure a cached package built from another upstream version isn't seen as cached, for
+        picking the queue or skipping the slots
+        """
+        self._register_uri()
+        root = tempfile.mkdtemp()
+        temp_dir = tempfile.mkdtemp()
+        self._config.update(STORE_DIRECTORY=root, TEMP_DIRECTORY=temp_dir, REVALIDATE_CACHE=True)
+        try:
+            resource = self._task._resource_file()
+            resource.set_version('v1', 60)
+            self._task.create_zip(resource)
+            for version, cached in [('v1', True), ('v2', False)]:
+                task = DatastorePackageTask(self._task.request_params, self._config)
+                with mock.patch.object(DatastorePackageTask, 'upstream_version',
+                                       return_value=version) as upstream_version:
+                    assert_equals(cached, task.cached())
+                    assert_equals('fast' if cached else 'slow', task.speed())
+                # the version is only asked for once
+                assert_equals(1, upstream_version.call_count)
+        finally:
+            shutil.rmtree(root)
+            shutil.rmtree(temp_dir)
+
+    @httpretty.activate
+    def test_derive_from_tsv(self):
+        """
+        Ensure packages can be derived from a cached tsv package
+        """
+        self._config['DERIVE_FROM_CACHE'] = True
+        fields = httpretty.Response(json.dumps(
+            {'result': {'fields': [{'id': 'field1'}, {'id': 'field2'}]}}))
+        records = [{'field1': 'a' + str(i), 'field2': 'b' + str(i)} for i in range(3)]
+        httpretty.register_uri(httpretty.POST, 'http://example.com/datastore/search',
+                               responses=[fields, httpretty.Response(json.dumps(
+                                   {'result': {'records': records}})),
+                                   httpretty.Response(json.dumps({'result': {'records': []}}))])
+        root = tempfile.mkdtemp()
+        temp_dir = tempfile.mkdtemp()
+        try:
+            task = DatastorePackageTask(dict(self._task.request_params, format='tsv'),
+                                        self._config)
+            task.create_zip(ResourceFile(task.request_params, root, temp_dir, 60))
+
+            # CKAN now fails, so the package must come from the cache
+            httpretty.reset()
+            httpretty.register_uri(httpretty.POST, 'http://example.com/datastore/search',
+                                   status=403, body='')
+            task = DatastorePackageTask(dict(self._task.request_params, fields='field2'),
+                                        self._config)
+            resource = ResourceFile(task.request_params, root, temp_dir, 60)
+            task.create_zip(resource)
+            p = subprocess.Popen(['unzip', '-p', resource.get_zip_file_name()],
+                                 stdout=subprocess.PIPE)
+            assert_equals(p.stdout.read(), 'field2\nb0\nb1\nb2\n')
+        finally:
+            shutil.rmtree(root)
+            shutil.rmtree(temp_dir)
+
+    @httpretty.activate
+    def test_xlsx(self):
+        """
+        Ensure xlsx packages hold a workbook with the records' values, and no csv file
+        """
+        self._config['RESUMABLE_TASKS'] = True
+        fields = httpretty.Response(json.dumps(
+            {'result': {'fields': [{'id': 'field1'}, {'id': 'field2'}]}}))
+        records = [{'field1': i, 'field2': u'caf\xe9'} for i in range(3)] + [{'field1': 3.5}]
+        httpretty.register_uri(httpretty.POST, 'http://example.com/datastore/search',
+                               responses=[fields, httpretty.Response(json.dumps(
+                                   {'result': {'records': records}})),
+                                   httpretty.Response(json.dumps({'result': {'records': []}}))])
+        root = tempfile.mkdtemp()
+        temp_dir = tempfile.mkdtemp()
+        try:
+            task = DatastorePackageTask(dict(self._task.request_params, format='xlsx'),
+                                        self._config)
+            resource = ResourceFile(task.request_params, root, temp_dir, 60)
+            task.create_zip(resource)
+            with closing(zipfile.ZipFile(resource.get_zip_file_name())) as archive:
+                assert_equals(['resource.xlsx'], archive.namelist())
+                workbook = load_workbook(BytesIO(archive.read('resource.xlsx')))
+            assert_equals([(u'field1', u'field2'), (0, u'caf\xe9'), (1, u'caf\xe9'),
+                           (2, u'caf\xe9'), (3.5, None)], list(workbook.active.values))
+        finally:
+            shutil.rmtree(root)
+            shutil.rmtree(temp_dir)
+
+    @httpretty.activate
+    def test_parquet(self):
+        """
+        Ensure parquet packages hold a file with a typed column for each field
+        """
+        if not parquet_available():
+            raise SkipTest("pyarrow isn't installed")
+        import pyarrow.parquet
+        fields = httpretty.Response(json.dumps(
+            {'result': {'fields': [{'id': 'field1', 'type': 'int'}, {'id': 'field2'}]}}))
+        records = [{'field1': i, 'field2': ['a', i]} for i in range(3)]
+        httpretty.register_uri(httpretty.POST, 'http://example.com/datastore/search',
+                               responses=[fields, httpretty.Response(json.dumps(
+                                   {'result': {'records': records}})),
+                                   httpretty.Response(json.dumps({'result': {'records': []}}))])
+        root = tempfile.mkdtemp()
+        temp_dir = tempfile.mkdtemp()
+        try:
+            task = DatastorePackageTask(dict(self._task.request_params, format='parquet'),
+                                        self._config)
+            resource = ResourceFile(task.request_params, root, temp_dir, 60)
+            task.create_zip(resource)
+            with closing(zipfile.ZipFile(resource.get_zip_file_name())) as archive:
+                assert_equals(['resource.parquet'], archive.namelist())
+                table = pyarrow.parquet.read_table(BytesIO(archive.read('resource.parquet')))
+            assert_equals({'field1': [0, 1, 2], 'field2': [u'["a", 0]', u'["a", 1]', u'["a", 2]']},
+                          table.to_pydict())
+        finally:
+            shutil.rmtree(root)
+            shutil.rmtree(temp_dir)
+
+    def test_parquet_unavailable(self):
+        """
+        Ensure parquet packages are rejected when pyarrow isn't installed
+        """
+        with mock.patch('ckanpackager.tasks.datastore_package_task.parquet_available',
+                        return_value=False):
+            with assert_raises(BadRequestError):
+                DatastorePackageTask(dict(self._task.request_params, format='parquet'),
+                                     self._config)
+
+    @httpretty.activate
+    def test_jsonl(self):
+        """
+        Ensure jsonl packages hold the records as they are, one per line, compressed as configured
+        """
+        fields = httpretty.Response(json.dumps(
+            {'result': {'fields': [{'id': 'field1'}, {'id': 'field2'}]}}))
+        records = [{'field1': i, 'field2': [u'caf\xe9', {'a': i}]} for i in range(3)]
+        lines = [json.loads(json.dumps(r)) for r in records]
+        root = tempfile.mkdtemp()
+        temp_dir = tempfile.mkdtemp()
+        try:
+            for compression, archive_writer, name in [(None, 'command', 'resource.jsonl'),
+                                                      ('gzip', 'builtin', 'resource.jsonl.gz')]:
+                httpretty.reset()
+                httpretty.register_uri(httpretty.POST, 'http://example.com/datastore/search',
+                                       responses=[fields, httpretty.Response(json.dumps(
+                                           {'result': {'records': records}})),
+                                           httpretty.Response(json.dumps(
+                                               {'result': {'records': []}}))])
+                self._config['JSONL_COMPRESSION'] = compression
+                task = DatastorePackageTask(dict(self._task.request_params, format='jsonl'),
+                                            self._config)
+                resource = ResourceFile(task.request_params, root, temp_dir, 60,
+                                        archive_writer=archive_writer)
+                task.create_zip(resource)
+                with closing(zipfile.ZipFile(resource.get_zip_file_name())) as archive:
+                    assert_equals([name], archive.namelist())
+                    data = archive.read(name)
+                    if compression is not None:
+                        assert_equals(zipfile.ZIP_STORED, archive.getinfo(name).compress_type)
+                        data = gzip.GzipFile(fileobj=BytesIO(data)).read()
+                assert_equals(lines, [json.loads(line) for line in data.splitlines()])
+                # compact separators, and non ascii characters escaped
+                assert_equals(0, data.count(' '))
+                assert_true('"caf\\u00e9"' in data)
+        finally:
+            shutil.rmtree(root)
+            shutil.rmtree(temp_dir)
+
+    def test_jsonl_unavailable(self):
+        """
+        Ensure jsonl packages are rejected when their compression isn't available
+        """
+        self._config['JSONL_COMPRESSION'] = 'lzma'
+        with assert_raises(BadRequestError):
+            DatastorePackageTask(dict(self._task.request_params, format='jsonl'), self._config)
+
+    @httpretty.activate
+    def test_fanout(self):
+        """
+        Ensure the packages in the FANOUT_FORMATS are built from the same records, and served from
+        the cache
+        """
+        fields = httpretty.Response(json.dumps(
+            {'result': {'fields': [{'id': 'field1'}, {'id': 'field2'}]}}))
+        records = [{'field1': i, 'field2': u'caf\xe9'} for i in range(3)]
+        root = tempfile.mkdtemp()
+        temp_dir = tempfile.mkdtemp()
+        self._config.update(STORE_DIRECTORY=root, TEMP_DIRECTORY=temp_dir, RESUMABLE_TASKS=True,
+                            FANOUT_FORMATS=['xlsx', 'jsonl', 'csv'])
+        try:
+            for formats in [['xlsx', 'jsonl'], ['jsonl']]:
+                httpretty.reset()
+                httpretty.register_uri(httpretty.POST, 'http://example.com/datastore/search',
+                                       responses=[fields, httpretty.Response(json.dumps(
+                                           {'result': {'records': records}})),
+                                           httpretty.Response(json.dumps(
+                                               {'result': {'records': []}}))])
+                params = dict(self._task.request_params, limit=str(len(formats)))
+                task = DatastorePackageTask(params, self._config)
+                if formats == ['jsonl']:
+                    # a package failing to build is dropped
+                    with mock.patch('ckanpackager.lib.xlsx_sink.XlsxSink.writerows',
+                                    side_effect=ValueError):
+                        task.create_zip(task._resource_file())
+                else:
+                    task.create_zip(task._resource_file())
+                assert_true(task.cached())
+                # the other packages are only zipped once the requested one has been sent
+                other = DatastorePackageTask(dict(params, format='jsonl'), self._config)
+                assert_false(other.cached())
+                task._after_build()
+
+                # CKAN now fails, so the packages must come from the cache
+                httpretty.reset()
+                httpretty.register_uri(httpretty.POST, 'http://example.com/datastore/search',
+                                       status=403, body='')
+                for fmt in ['xlsx', 'jsonl']:
+                    other = DatastorePackageTask(dict(params, format=fmt), self._config)
+                    assert_equals(fmt in formats, other.cached())
+                other = DatastorePackageTask(dict(params, format='jsonl'), self._config)
+                resource = other._resource_file()
+                assert_true(resource.zip_file_exists())
+                with closing(zipfile.ZipFile(resource.get_zip_file_name())) as archive:
+                    lines = archive.read('resource.jsonl').splitlines()
+                assert_equals(records[:len(formats)], [json.loads(line) for line in lines])
+            other = DatastorePackageTask(dict(params, format='xlsx', limit='2'), self._config)
+            resource = other._resource_file()
+            assert_true(resource.zip_file_exists())
+            with closing(zipfile.ZipFile(resource.get_zip_file_name())) as archive:
+                workbook = load_workbook(BytesIO(archive.read('resource.xlsx')))
+            assert_equals([(u'field1', u'field2'), (0, u'caf\xe9'), (1, u'caf\xe9')],
+                          list(workbook.active.values))
+        finally:
+            shutil.rmtree(root)
+            shutil.rmtree(temp_dir)
+
+    @httpretty.activate
+    def test_shards(self):
+        """
+        Ensure large requests are split into shards, whose parts are merged in order
+        """
+        def search(request, uri, headers):
+            params = json.loads(request.body)
+            records = [{'field1': 'a' + str(i)} for i in range(5)]
+            records = records[params['offset']:params['offset'] + params['limit']]
+            return 200, headers, json.dumps({'success': True, 'result': {
+                'total': 5, 'fields': [{'id': 'field1'}], 'records': records}})
+
+        httpretty.register_uri(httpretty.POST, 'http://example.com/datastore/search', body=search)
+        root = tempfile.mkdtemp()
+        temp_dir = tempfile.mkdtemp()
+        self._config.update(STORE_DIRECTORY=root, TEMP_DIRECTORY=temp_dir)
+        try:
+            assert_equals(self._task.shard_ranges(), None)
+            self._config.update(SHARD_RECORDS=2, SHARD_MAX=8)
+            assert_equals(self._task.shard_ranges(), [(0, 2), (2, 2), (4, 1)])
+            task = DatastorePackageTask(dict(self._task.request_params, offset='1', limit='3'),
+                                        self._config)
+            assert_equals(task.shard_ranges(), [(1, 2), (3, 1)])
+
+            for index, (offset, limit) in reversed(list(enumerate(self._task.shard_ranges()))):
+                assert_equals(limit, self._task.write_shard(index, offset, limit))
+            # parts already fetched aren't fetched again
+            requests = len(httpretty.latest_requests())
+            assert_equals(2, self._task.write_shard(1, 2, 2))
+            assert_equals(requests, len(httpretty.latest_requests()))
+
+            self._task.shard_count = 3
+            resource = ResourceFile(self._task.request_params, root, temp_dir, 60)
+            self._task.create_zip(resource)
+            p = subprocess.Popen(['unzip', '-p', resource.get_zip_file_name()],
+                                 stdout=subprocess.PIPE)
+            assert_equals(p.stdout.read(), 'field1\na0\na1\na2\na3\na4\n')
+            assert_false(os.path.exists(resource.shard_parts().folder))
+        finally:
+            shutil.rmtree(root)
+            shutil.rmtree(temp_dir)
+
+    @httpretty.activate
+    def test_shards_failed(self):
+        """
+        Ensure a package whose shards failed is given up: the error is recorded, the requester told
+        and the parts fetched removed
+        """
+        def search(request, uri, headers):
+            return 200, headers, json.dumps({'success': True, 'result': {
+                'total': 5, 'fields': [{'id': 'field1'}], 'records': [{'field1': 'a'}]}})
+
+        httpretty.register_uri(httpretty.POST, 'http://example.com/datastore/search', body=search)
+        root = tempfile.mkdtemp()
+        temp_dir = tempfile.mkdtemp()
+        self._config.update(STORE_DIRECTORY=root, TEMP_DIRECTORY=temp_dir, ANONYMIZE_EMAILS=False,
+                            STATS_DB='sqlite:///' + os.path.join(root, 'stats.db'))
+        try:
+            self._task.write_shard(0, 0, 1)
+            parts = self._task._resource_file().shard_parts()
+            assert_true(parts.exists(0))
+            with mock.patch.object(DatastorePackageTask, 'fail') as fail:
+                self._task.shards_failed()
+            assert_equals(1, fail.call_count)
+            assert_false(parts.exists(0))
+            stats = CkanPackagerStatistics(self._config['STATS_DB'], False)
+            errors = stats.get_errors()
+            assert_equals(1, len(errors))
+            assert_equals('someone@0.0.0.0', errors[0]['email'])
+        finally:
+            shutil.rmtree(root)
+            shutil.rmtree(temp_dir)
+
+    def test_claim_shards(self):
+        """
+        Ensure identical requests don't fetch the same records in shards at the same time, but wait
+        for the task fetching them
+        """
+        root = tempfile.mkdtemp()
+        self._config.update(STORE_DIRECTORY=root)
+        try:
+            assert_true(self._task.claim_shards())
+            other = DatastorePackageTask(dict(self._task.request_params,
+                                              email='other@0.0.0.0'), self._config)
+            assert_false(other.claim_shards())
+            recipients = self._task._resource_file().pending_recipients()
+            assert_equals(['other@0.0.0.0'], recipients.take())
+            self._task.release_shards()
+            assert_true(other.claim_shards())
+            # the parts are removed once merged, which releases the claim
+            other._resource_file().shard_parts().remove()
+            assert_true(self._task.claim_shards())
+        finally:
+            shutil.rmtree(root)
+
+    def test_expected_size(self):
+        """
+        Ensure the size of the package is estimated from the number of records and fields
+        """
+        self._config['CACHE_BYTES_PER_VALUE'] = 5
+        with mock.patch.object(DatastorePackageTask, '_estimate_size', return_value=(10, 3)):
+            assert_equals(150, self._task.expected_size())
+        with mock.patch.object(DatastorePackageTask, '_estimate_size', return_value=None):
+            assert_equals(None, self._task.expected_size())
+
     def test_speed_is_fast_with_few_rows(self):
         """
         Ensure the speed is fast when few rows are present
@@ -157,3 +640,43 @@ class TestDatastorePackageTask(object):
             'limit': 4
         }, self._config)
         assert_equals('slow', task.speed())
+
+    @httpretty.activate
+    def test_speed_tiers(self):
+        """
+        Ensure requests are put on the queue of the tier matching their number of records and
+        fields, as given by CKAN
+        """
+        _totals.clear()
+        httpretty.register_uri(httpretty.POST, 'http://example.com/datastore/search',
+                               body=json.dumps({'success': True, 'result': {
+                                   'total': 20, 'fields': [{'id': 'a'}, {'id': 'b'}]}}))
+        self._config['QUEUE_TIERS'] = [(10, 'small'), (100, 'medium'), (None, 'large')]
+
+        def speed(**params):
+            params.update({'resource_id': 'the-resource-id', 'email': 'someone@0.0.0.0',
+                           'api_url': 'http://example.com/datastore/search'})
+            return DatastorePackageTask(params, self._config).speed()
+
+        assert_equals('medium', speed())
+        assert_equals('small', speed(limit=4))
+        assert_equals('small', speed(offset=16))
+        # the number of records is only asked for once
+        assert_equals(1, len(httpretty.latest_requests()))
+        assert_equals('medium', speed(q='carrot', limit=100))
+        assert_equals(2, len(httpretty.latest_requests()))
+        self._config['QUEUE_TIERS'][1] = (30, 'medium')
+        assert_equals('large', speed())
+
+    @httpretty.activate
+    def test_speed_tiers_fallback(self):
+        """
+        Ensure SLOW_REQUEST decides between the first and last tiers when CKAN fails to give the
+        number of records
+        """
+        _totals.clear()
+        httpretty.register_uri(httpretty.POST, 'http://example.com/datastore/search', status=500)
+        self._config['QUEUE_TIERS'] = [(10, 'small'), (100, 'medium'), (None, 'large')]
+        task = DatastorePackageTask(dict(self._task.request_params, limit=1), self._config)
+        assert_equals('small', task.speed())
+        assert_equals('large', self._task.speed())
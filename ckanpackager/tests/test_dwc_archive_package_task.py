@@ -49,7 +49,7 @@ class DummyResource(object):
     def create_zip(self, command):
         self.create_invoked = True
 
-    def clean_work_files(self):
+    def clean_work_files(self, keep_resumable=False):
         self.clean_invoked = True
 
     def count_lines(self, name):
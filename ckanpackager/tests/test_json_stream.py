@@ -0,0 +1,59 @@
+"""Test the incremental parsing of CKAN responses"""
+import json
+import StringIO
+
+import ijson
+from nose.tools import assert_equals, assert_true, assert_raises
+
+from ckanpackager.lib.json_stream import stream_records
+
+
+class TestStreamRecords(object):
+
+    def test_records_and_result(self):
+        """
+        Ensure the records are yielded and the other result values are collected
+        """
+        records = [{'a': 1, 'b': [1, {'c': 'd'}], 'e': None}, {'a': 2, 'b': [], 'e': True}]
+        body = json.dumps({
+            'success': True,
+            'result': {
+                'fields': [{'id': 'a'}, {'id': 'b'}],
+                'records': records,
+                'next_cursor': 'abc',
+                'after': [12, 'x'],
+            }
+        })
+        result = {}
+        assert_equals(list(stream_records(StringIO.StringIO(body), result)), records)
+        assert_equals(result, {'fields': [{'id': 'a'}, {'id': 'b'}], 'next_cursor': 'abc',
+                               'after': [12, 'x']})
+
+    def test_records_are_lazy(self):
+        """
+        Ensure records are yielded before the end of the response has been read
+        """
+        body = json.dumps({'result': {'records': [{'a': 1}, {'a': 2}], 'after': 'z'}})
+        result = {}
+        records = stream_records(StringIO.StringIO(body), result)
+        assert_equals(next(records), {'a': 1})
+        assert_true('after' not in result)
+        list(records)
+        assert_equals(result['after'], 'z')
+
+    def test_floats(self):
+        """
+        Ensure decimal numbers are parsed as floats, as the json module does
+        """
+        body = json.dumps({'result': {'records': [{'a': 1.5, 'b': [2.25]}, 0.5]}})
+        records = list(stream_records(StringIO.StringIO(body), {}))
+        assert_equals(records, [{'a': 1.5, 'b': [2.25]}, 0.5])
+        assert_true(isinstance(records[0]['a'], float))
+
+    def test_incomplete(self):
+        """
+        Ensure an error is raised if the response is cut short
+        """
+        for body in ['{"result": {"records": [{"a": 1}, {"a"', '{"result": {"records": [1, 2]']:
+            with assert_raises(ijson.JSONError):
+                list(stream_records(StringIO.StringIO(body), {}))
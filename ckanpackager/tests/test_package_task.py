@@ -7,6 +7,8 @@ import time
 from nose.tools import assert_equals, assert_raises, assert_not_equals
 from nose.tools import assert_not_in, assert_in
 from ckanpackager.tasks.package_task import PackageTask
+from ckanpackager.lib.cache_index import CacheIndex
+from ckanpackager.lib.resource_file import ResourceFile
 from ckanpackager.lib.utils import BadRequestError
 from ckanpackager.lib.statistics import CkanPackagerStatistics
 from ckanpackager.tests import smtpretty
@@ -42,6 +44,18 @@ class DummyPackageTask(PackageTask):
         return 'nice '+ str(cake)
 
 
+class SizedPackageTask(DummyPackageTask):
+    """A DummyPackageTask knowing the size of its ZIP file, and recording
+       the files in the store directory when it starts building it
+    """
+    def expected_size(self):
+        return 100
+
+    def create_zip(self, resource):
+        self.store_files = os.listdir(self.config['STORE_DIRECTORY'])
+        super(SizedPackageTask, self).create_zip(resource)
+
+
 class TestPackageTask(object):
     """Test the DummyPackageTask task."""
     def setUp(self):
@@ -228,6 +242,17 @@ class TestPackageTask(object):
         }, self._config)
         assert_equals('slow', t.speed())
 
+    def test_slots(self):
+        """Test the limits for the host and the requester's domain apply
+           to tasks, as configured"""
+        self._config.update(HOST_SLOTS={'example.com': 1}, DEFAULT_DOMAIN_SLOTS=2)
+        params = {'resource_id': 'the-resource-id', 'carrot': 'cake'}
+        t = DummyPackageTask(dict(params, email='a@Example.org'), self._config)
+        assert_equals([('host-example.com', 1), ('domain-example.org', 2)],
+                      t.slots().limits)
+        self._config.update(HOST_SLOTS={})
+        assert_equals([('domain-example.org', 2)], t.slots().limits)
+
     @smtpretty.activate(2525)
     def test_speed_is_fast_when_resource_is_cached(self):
         t = DummyPackageTask({
@@ -236,4 +261,70 @@ class TestPackageTask(object):
             'carrot': 'create-zip'
         }, self._config)
         t.run()
-        assert_equals('fast', t.speed())
\ No newline at end of file
+        assert_equals('fast', t.speed())
+
+    @smtpretty.activate(2525)
+    def test_fail(self):
+        """Test a task that failed for good emails its requester and the
+           recipients waiting for the file"""
+        config = dict(self._config, EMAIL_FAILURE_SUBJECT='{resource_id} failed',
+                      EMAIL_FAILURE_BODY='{ckan_host} body',
+                      EMAIL_FAILURE_BODY_HTML='{ckan_host} html body')
+        params = {
+            'resource_id': 'the-resource-id',
+            'email': 'first@example.com',
+            'carrot': 'break'
+        }
+        t = DummyPackageTask(params, config)
+        recipients = t._resource_file().pending_recipients()
+        recipients.add('second@example.com')
+        recipients.add('first@example.com')
+        t.fail(Exception('this is broken'))
+        recipients_emailed = sorted(m.recipients[0] for m in smtpretty.messages)
+        assert_equals(['first@example.com', 'second@example.com'], recipients_emailed)
+        assert_in('example.com body', smtpretty.last_message.body)
+        assert_equals(False, recipients.waiting())
+
+    @smtpretty.activate(2525)
+    def test_evict_before_build(self):
+        """Test room is made in the cache for the expected size of the file
+           before it is built"""
+        config = dict(self._config, EMAIL_BODY_HTML='{resource_id} html body',
+                      CACHE_MAX_BYTES=150, CACHE_EVICTION_MIN_AGE=0)
+        old = os.path.join(config['STORE_DIRECTORY'], '{}-1-1.zip'.format('a' * 32))
+        with open(old, 'w') as f:
+            f.write('x' * 100)
+        CacheIndex(config['STORE_DIRECTORY']).add('a' * 32, old, created=time.time() - 100)
+        t = SizedPackageTask({
+            'resource_id': 'the-resource-id',
+            'email': 'recipient@example.com',
+            'carrot': 'create-zip'
+        }, config)
+        t.run()
+        assert_not_in(os.path.basename(old), t.store_files)
+        assert_equals(True, t.cached())
+
+    @smtpretty.activate(2525)
+    def test_identical_task_adds_recipient(self):
+        """Test a task for a file being built by another task leaves it to
+           that task to email the link, which it then sends to everyone"""
+        config = dict(self._config, EMAIL_BODY_HTML='{resource_id} html body')
+        params = {
+            'resource_id': 'the-resource-id',
+            'email': 'first@example.com',
+            'carrot': 'cake'
+        }
+        lock = ResourceFile(
+            params,
+            config['STORE_DIRECTORY'],
+            config['TEMP_DIRECTORY'],
+            config['CACHE_TIME']
+        ).build_lock()
+        assert_equals(True, lock.acquire())
+        DummyPackageTask(dict(params, email='second@example.com'), config).run()
+        assert_equals(0, len(smtpretty.messages))
+        lock.release()
+        DummyPackageTask(params, config).run()
+        recipients = sorted(m.recipients[0] for m in smtpretty.messages)
+        assert_equals(['first@example.com', 'second@example.com'], recipients)
+        assert_equals(['second@example.com'], smtpretty.last_message.message.get_all('To'))
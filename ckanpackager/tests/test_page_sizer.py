@@ -0,0 +1,59 @@
+"""Test the PageSizer class"""
+from nose.tools import assert_equals
+
+from ckanpackager.lib.page_sizer import PageSizer
+
+
+class TestPageSizer(object):
+
+    def test_grows_fast_pages(self):
+        """
+        Ensure the page size grows when pages are quick, by no more than the maximum factor
+        """
+        sizer = PageSizer(1000, 100, 10000, 10)
+        assert_equals(sizer.observe(1000, 1, 1000), 2000)
+        assert_equals(sizer.observe(2000, 8, 2000), 2500)
+
+    def test_shrinks_slow_pages(self):
+        """
+        Ensure the page size shrinks when pages are slow
+        """
+        sizer = PageSizer(1000, 100, 10000, 10)
+        assert_equals(sizer.observe(1000, 16, 1000), 625)
+
+    def test_bounds(self):
+        """
+        Ensure the page size stays within the bounds
+        """
+        sizer = PageSizer(1000, 800, 1500, 10)
+        assert_equals(sizer.observe(1000, 1, 1000), 1500)
+        assert_equals(sizer.observe(1500, 100, 1000), 800)
+        assert_equals(PageSizer(10, 800, 1500, 10).size, 800)
+
+    def test_max_bytes(self):
+        """
+        Ensure the page size is limited by the maximum number of bytes
+        """
+        sizer = PageSizer(1000, 100, 10000, 10, max_bytes=1000000)
+        # quick, but 1000 bytes per record
+        assert_equals(sizer.observe(1000, 1, 1000000), 1000)
+        sizer = PageSizer(1000, 100, 10000, 10, max_bytes=1000000)
+        assert_equals(sizer.observe(1000, 1, 2000000), 500)
+
+    def test_small_changes_ignored(self):
+        """
+        Ensure the page size doesn't change because of small variations
+        """
+        sizer = PageSizer(1000, 100, 10000, 10)
+        assert_equals(sizer.observe(1000, 9.5, 1000), 1000)
+        assert_equals(sizer.decisions, [])
+
+    def test_summary(self):
+        """
+        Ensure the decisions are summarised
+        """
+        sizer = PageSizer(1000, 100, 10000, 10)
+        sizer.observe(1000, 1, 1000)
+        sizer.observe(2000, 40, 1000)
+        assert_equals(sizer.summary(), {'changes': 2, 'smallest': 1000, 'largest': 2000,
+                                        'final': 1000})
@@ -0,0 +1,92 @@
+"""Test writing rows into parquet files"""
+import os
+import shutil
+import tempfile
+from decimal import Decimal
+
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equals
+
+from ckanpackager.lib.parquet_sink import ParquetSink, parquet_available
+
+
+class TestParquetSink(object):
+
+    def setUp(self):
+        if not parquet_available():
+            raise SkipTest("pyarrow isn't installed")
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'resource.parquet')
+        self._fields = [{'id': 'id', 'type': 'int'}, {'id': 'size', 'type': 'numeric'},
+                        {'id': 'flag', 'type': 'bool'}, {'id': 'name', 'type': 'text'},
+                        {'id': 'other'}]
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _read(self):
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetFile(self._path)
+
+    def test_typed_columns(self):
+        """Check columns are typed after the fields, nested values being kept as JSON"""
+        sink = ParquetSink(self._path, self._fields)
+        sink.writerow(['id', 'size', 'flag', 'name', 'other'])
+        sink.writerows([[1, 2.5, True, u'caf\xe9', [u'a', 1]], [2, None, False, None, {u'k': 1}]])
+        sink.close()
+        parquet = self._read()
+        assert_equals(['int64', 'double', 'bool', 'string', 'string'],
+                      [str(t) for t in parquet.schema.to_arrow_schema().types])
+        assert_equals({'id': [1, 2], 'size': [2.5, None], 'flag': [True, False],
+                       'name': [u'caf\xe9', None], 'other': [u'["a", 1]', u'{"k": 1}']},
+                      parquet.read().to_pydict())
+
+    def test_text_values(self):
+        """Check values read back from csv files are converted to the type of their column"""
+        sink = ParquetSink(self._path, self._fields)
+        sink.writerows([['id', 'size', 'flag', 'name', 'other'], [u'1', u'2.5', u'True', u'a', u''],
+                        [u'', u'', u'False', u'', 3]])
+        sink.close()
+        assert_equals({'id': [1, None], 'size': [2.5, None], 'flag': [True, False],
+                       'name': [u'a', u''], 'other': [u'', u'3']}, self._read().read().to_pydict())
+
+    def test_integer_values(self):
+        """Check integers written as floating point numbers or text aren't truncated"""
+        sink = ParquetSink(self._path, [{'id': 'id', 'type': 'int'}])
+        sink.writerows([['id'], [u'1.0'], [u'1e3'], [2.0], [Decimal('3')],
+                        [u'123456789012345678']])
+        sink.close()
+        assert_equals(['int64'], [str(t) for t in self._read().schema.to_arrow_schema().types])
+        assert_equals({'id': [1, 1000, 2, 3, 123456789012345678]}, self._read().read().to_pydict())
+
+    def test_fallback_types(self):
+        """
+        Check columns holding values that don't fit their type are written as floating point
+        numbers or text, including the row groups already written
+        """
+        fields = [{'id': 'id', 'type': 'int'}, {'id': 'size', 'type': 'float'}]
+        sink = ParquetSink(self._path, fields, row_group_size=2)
+        sink.writerows([['id', 'size'], [1, 1.5], [2, u'2']])
+        sink.writerows([[2.5, u'n/a']])
+        sink.close()
+        parquet = self._read()
+        assert_equals(['double', 'string'],
+                      [str(t) for t in parquet.schema.to_arrow_schema().types])
+        assert_equals({'id': [1.0, 2.0, 2.5], 'size': [u'1.5', u'2.0', u'n/a']},
+                      parquet.read().to_pydict())
+        assert_equals(['resource.parquet'], os.listdir(self._dir))
+
+    def test_row_groups(self):
+        """Check rows are written in row groups of the given size, with the given codec"""
+        sink = ParquetSink(self._path, [{'id': 'id', 'type': 'int'}], compression='gzip',
+                           row_group_size=2)
+        sink.writerow(['id'])
+        sink.writerows([[0], [1], [2]])
+        sink.writerows([[3], [4]])
+        sink.close()
+        sink.close()
+        metadata = self._read().metadata
+        assert_equals([2, 2, 1], [metadata.row_group(i).num_rows
+                                  for i in range(metadata.num_row_groups)])
+        assert_equals('GZIP', metadata.row_group(0).column(0).compression)
+        assert_equals({'id': range(5)}, self._read().read().to_pydict())
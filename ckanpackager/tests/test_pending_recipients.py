@@ -0,0 +1,43 @@
+"""Test the lists of recipients waiting for a package"""
+import os
+import shutil
+import tempfile
+import time
+
+from nose.tools import assert_equals, assert_true, assert_false
+
+from ckanpackager.lib.pending_recipients import PendingRecipients, remove_stale_recipients
+
+
+class TestPendingRecipients(object):
+
+    def setUp(self):
+        self._root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._root)
+
+    def test_take(self):
+        """Check recipients are returned once, in order and without duplicates"""
+        recipients = PendingRecipients(self._root, 'key')
+        assert_false(recipients.waiting())
+        recipients.add('a@example.com')
+        PendingRecipients(self._root, 'key').add(u'b@example.com')
+        recipients.add('a@example.com')
+        PendingRecipients(self._root, 'other-key').add('c@example.com')
+        assert_true(recipients.waiting())
+        assert_equals(['a@example.com', 'b@example.com'], recipients.take())
+        assert_false(recipients.waiting())
+        assert_equals([], recipients.take())
+        assert_equals(['c@example.com'], PendingRecipients(self._root, 'other-key').take())
+
+    def test_remove_stale_recipients(self):
+        """Check only the lists that haven't been added to for a while are removed"""
+        stale = PendingRecipients(self._root, 'stale')
+        stale.add('a@example.com')
+        os.utime(stale.path, (time.time() - 100, time.time() - 100))
+        recent = PendingRecipients(self._root, 'recent')
+        recent.add('b@example.com')
+        assert_equals(1, remove_stale_recipients(self._root, time.time() - 50))
+        assert_false(stale.waiting())
+        assert_true(recent.waiting())
@@ -0,0 +1,119 @@
+"""Test the prefetch function"""
+import threading
+import time
+
+from nose.tools import assert_equals, assert_raises, assert_true
+
+from ckanpackager.lib.prefetch import prefetch, fetch_in_order
+
+
+class TestPrefetch(object):
+
+    def test_items_in_order(self):
+        """
+        Ensure all the items are returned in order, with and without a background thread
+        """
+        for depth in (0, 1, 5):
+            assert_equals(list(prefetch(iter(range(100)), depth)), list(range(100)))
+
+    def test_errors_are_raised(self):
+        """
+        Ensure errors raised by the iterable are raised in the consumer
+        """
+        def broken():
+            yield 1
+            raise ValueError('broken')
+
+        items = prefetch(broken(), 2)
+        assert_equals(next(items), 1)
+        with assert_raises(ValueError):
+            next(items)
+
+    def test_fetches_ahead(self):
+        """
+        Ensure items are produced while the consumer is busy, but no more than the depth allows
+        """
+        produced = []
+
+        def producer():
+            for i in range(10):
+                produced.append(i)
+                yield i
+
+        items = prefetch(producer(), 2)
+        assert_equals(next(items), 0)
+        time.sleep(0.5)
+        # the first item has been consumed, 2 are waiting in the queue and the producer is holding
+        # on to the fourth one
+        assert_equals(len(produced), 4)
+        assert_equals(list(items), list(range(1, 10)))
+
+    def test_producer_stops_when_consumer_stops(self):
+        """
+        Ensure the background thread goes away if the consumer stops iterating
+        """
+        def endless():
+            i = 0
+            while True:
+                yield i
+                i += 1
+
+        items = prefetch(endless(), 1)
+        next(items)
+        items.close()
+        time.sleep(0.5)
+        assert_true(all(t.name != 'prefetch' for t in threading.enumerate()))
+
+
+class TestFetchInOrder(object):
+
+    def test_items_in_order(self):
+        """
+        Ensure items are returned in order even if they are fetched out of order
+        """
+        def fetch(index):
+            # make the early items slower than the later ones
+            time.sleep(0.01 * (10 - index % 10))
+            return index, False
+
+        assert_equals(list(fetch_in_order(fetch, 4, 8, 30)), list(range(30)))
+
+    def test_last_item(self):
+        """
+        Ensure fetching stops at the item flagged as the last one
+        """
+        def fetch(index):
+            return index, index == 12
+
+        assert_equals(list(fetch_in_order(fetch, 3, 6)), list(range(13)))
+
+    def test_buffer_is_capped(self):
+        """
+        Ensure items aren't fetched too far ahead of the consumer
+        """
+        fetched = []
+
+        def fetch(index):
+            fetched.append(index)
+            return index, index == 20
+
+        items = fetch_in_order(fetch, 4, 3)
+        assert_equals(next(items), 0)
+        time.sleep(0.5)
+        # item 0 has been returned, so items 1 to 3 may be fetched but nothing beyond
+        assert_equals(sorted(fetched), [0, 1, 2, 3])
+        assert_equals(list(items), list(range(1, 21)))
+
+    def test_errors_are_raised_in_order(self):
+        """
+        Ensure the items before a failed one are returned before the error is raised
+        """
+        def fetch(index):
+            if index == 5:
+                raise ValueError('broken')
+            return index, False
+
+        items = fetch_in_order(fetch, 3, 6)
+        assert_equals([next(items) for _ in range(5)], list(range(5)))
+        with assert_raises(ValueError):
+            next(items)
@@ -0,0 +1,66 @@
+"""Test the progress published by the tasks"""
+import os
+import shutil
+import tempfile
+import time
+
+import mock
+from nose.tools import assert_equals, assert_is_none, assert_false
+
+from ckanpackager.lib.progress import TaskProgress, in_flight
+
+
+class TestProgress(object):
+
+    def setUp(self):
+        self._root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._root)
+
+    def test_publish(self):
+        """Check progress is published when the phase changes, and otherwise at most every interval"""
+        progress = TaskProgress(self._root, 'task', {'host': 'example.com'}, interval=60)
+        assert_equals([], in_flight(self._root, 60))
+        progress.set_total(100)
+        progress.set_phase('fetching')
+        progress.fetched(10, 1000)
+        [task] = in_flight(self._root, 60)
+        assert_equals(('task', 'example.com', 'fetching', 0, 100),
+                      (task['id'], task['host'], task['phase'], task['records'], task['total']))
+        progress.written(10)
+        progress.set_phase('zipping')
+        [task] = in_flight(self._root, 60)
+        assert_equals((10, 1000, 10), (task['records'], task['bytes'], task['rows']))
+        progress.finish()
+        assert_equals([], in_flight(self._root, 60))
+
+    def test_rates(self):
+        """Check the fetch rate and the time left are worked out from the time taken so far"""
+        with mock.patch('time.time', return_value=1000):
+            progress = TaskProgress(self._root, 'task')
+            other = TaskProgress(self._root, 'other')
+        progress.set_total(100)
+        progress.fetched(20, 400)
+        with mock.patch('time.time', return_value=1010):
+            progress.publish()
+            other.publish()
+            tasks = in_flight(self._root, time.time())
+        assert_equals((2, 40, 40), (tasks[0]['rate'], tasks[0]['byte_rate'], tasks[0]['eta']))
+        assert_is_none(tasks[1]['eta'])
+
+    def test_stale(self):
+        """Check progress that hasn't been updated for a while is dropped"""
+        progress = TaskProgress(self._root, 'task')
+        progress.publish()
+        os.utime(progress.path, (time.time() - 100, time.time() - 100))
+        assert_equals([], in_flight(self._root, 60))
+        assert_false(os.path.exists(progress.path))
+
+    def test_unpublished(self):
+        """Check progress without a store directory is kept track of, but not published"""
+        progress = TaskProgress(None, None)
+        progress.set_phase('fetching')
+        progress.fetched(5)
+        progress.finish()
+        assert_equals(5, progress.state['records'])
@@ -3,10 +3,13 @@ import time
 import tempfile
 import shutil
 import subprocess
+import zipfile
 from collections import OrderedDict
+from contextlib import closing
 from nose.tools import assert_true, assert_false, assert_equals, assert_in
-from nose.tools import assert_not_in
-from ckanpackager.lib.resource_file import ResourceFile, ArchiveError
+from nose.tools import assert_not_in, assert_raises
+from ckanpackager.lib.resource_file import ResourceFile, ArchiveError, remove_stale_resume_folders
+from ckanpackager.lib.cache_index import INDEX_FOLDER
 
 
 class TestResourcefile(object):
@@ -21,6 +24,10 @@ class TestResourcefile(object):
         shutil.rmtree(self._tempdir)
         shutil.rmtree(self._root)
 
+    def _store_files(self):
+        """List the files in the store directory, other than the cache index"""
+        return [f for f in os.listdir(self._root) if f != INDEX_FOLDER]
+
     def test_zip_file_created(self):
         """Create a simple resource with one file, and make sure the zip file
            is created as expected.
@@ -135,6 +142,22 @@ class TestResourcefile(object):
         assert_in('one.csv', out)
         assert_in('two.csv', out)
 
+    def test_compressed_files_stored(self):
+        """Test that files already compressed are stored in the zip file
+        as they are by the zip command"""
+        req = {'resource_id': '123'}
+        resource = ResourceFile(req, self._root, self._tempdir, 60*60*24)
+        resource.get_writer('one.txt').write('hello world' * 100)
+        # this isn't compressed really, so zip would compress it
+        resource.get_writer('two.jsonl.gz').write('hello again' * 100)
+        resource.create_zip(self._zip)
+        resource.clean_work_files()
+        with closing(zipfile.ZipFile(resource.get_zip_file_name())) as archive:
+            compression = dict((info.filename, info.compress_type)
+                               for info in archive.infolist())
+        assert_equals({'one.txt': zipfile.ZIP_DEFLATED, 'two.jsonl.gz': zipfile.ZIP_STORED},
+                      compression)
+
     def test_request_id_default_file_name(self):
         """Test that default file names based on request_id work"""
         # Create a resource
@@ -222,3 +245,201 @@ class TestResourcefile(object):
         # Ensure work folder has been removed
         assert_equals([], os.listdir(self._tempdir))
 
+
+    def test_resume(self):
+        """Ensure a resumable resource keeps its files when cleaned up after
+        a failure, and that they are restored to the last checkpoint"""
+        req = {'resource_id': '123', 'hello': 'world'}
+        resource = ResourceFile(req, self._root, self._tempdir, 60*60*24)
+        assert_equals(None, resource.open_resumable(['one']))
+        w = resource.get_writer('data.csv')
+        w.write('hello\n')
+        resource.save_checkpoint({'count': 1})
+        w.write('half a li')
+        resource.clean_work_files(keep_resumable=True)
+
+        resource2 = ResourceFile(req, self._root, self._tempdir, 60*60*24)
+        assert_equals({'count': 1}, resource2.open_resumable(['one']))
+        resource2.get_writer('data.csv').write('world\n')
+        resource2.create_zip(self._zip)
+        resource2.clean_work_files()
+        p = subprocess.Popen(
+            ['unzip', '-p', resource2.get_zip_file_name()],
+            stdout=subprocess.PIPE
+        )
+        assert_equals("hello\nworld\n", p.stdout.read())
+        # the folder has gone now that the resource has been built
+        assert_equals([], os.listdir(self._tempdir))
+
+    def test_resume_other_key(self):
+        """Ensure a checkpoint saved with another key isn't resumed from"""
+        req = {'resource_id': '123', 'hello': 'world'}
+        resource = ResourceFile(req, self._root, self._tempdir, 60*60*24)
+        resource.open_resumable(['one'])
+        resource.get_writer('data.csv').write('hello\n')
+        resource.save_checkpoint({'count': 1})
+        resource.clean_work_files(keep_resumable=True)
+
+        resource2 = ResourceFile(req, self._root, self._tempdir, 60*60*24)
+        assert_equals(None, resource2.open_resumable(['two']))
+        assert_equals([], os.listdir(resource2.working_folder))
+        resource2.clean_work_files()
+
+    def test_resume_in_use(self):
+        """Ensure a resumable folder in use by another resource isn't shared"""
+        req = {'resource_id': '123', 'hello': 'world'}
+        resource = ResourceFile(req, self._root, self._tempdir, 60*60*24)
+        resource.open_resumable(['one'])
+        resource2 = ResourceFile(req, self._root, self._tempdir, 60*60*24)
+        assert_equals(None, resource2.open_resumable(['one']))
+        assert_true(resource.working_folder != resource2.working_folder)
+        resource2.clean_work_files()
+        resource.clean_work_files()
+        assert_equals([], os.listdir(self._tempdir))
+
+    def test_remove_stale_resume_folders(self):
+        """Ensure only the resumable folders that haven't been checkpointed
+        for a while, and aren't in use, are removed"""
+        folders = []
+        for i in range(3):
+            resource = ResourceFile({'resource_id': str(i)}, self._root, self._tempdir, 60)
+            resource.open_resumable(['one'])
+            resource.get_writer('data.csv').write('hello\n')
+            resource.save_checkpoint({'count': 1})
+            folders.append(resource.resume_folder)
+            if i < 2:
+                resource.clean_work_files(keep_resumable=True)
+            for path in (folders[i], os.path.join(folders[i], 'checkpoint.json')):
+                if i != 1:
+                    os.utime(path, (time.time() - 100, time.time() - 100))
+        other = os.path.join(self._tempdir, 'other')
+        os.mkdir(other)
+        os.utime(other, (time.time() - 100, time.time() - 100))
+        assert_equals(1, remove_stale_resume_folders(self._tempdir, time.time() - 50))
+        # the first is stale, the second recent and the third in use
+        assert_equals([False, True, True], [os.path.exists(f) for f in folders])
+        assert_true(os.path.exists(other))
+        resource.clean_work_files()
+
+    def test_builtin_archive(self):
+        """Ensure the builtin archive writer streams files into the archive
+        and adds the others, leaving nothing else behind"""
+        req = {'resource_id': '123', 'hello': 'world'}
+        resource = ResourceFile(req, self._root, self._tempdir, 60*60*24,
+                                archive_writer='builtin')
+        w = resource.get_csv_writer('one.csv', stream=True)
+        w.writerow(['one', 'two'])
+        # only one file can be streamed at a time
+        resource.get_writer('two.txt', stream=True).write('hello')
+        assert_equals(set(['one.csv']), resource.streamed)
+        with assert_raises(ArchiveError):
+            resource.count_lines('one.csv')
+        resource.create_zip(self._zip)
+        resource.clean_work_files()
+        assert_equals([os.path.basename(resource.get_zip_file_name())],
+                      self._store_files())
+        assert_equals([], os.listdir(self._tempdir))
+        p = subprocess.Popen(['unzip', '-p', resource.get_zip_file_name(), 'one.csv'],
+                             stdout=subprocess.PIPE)
+        assert_equals("one,two\n", p.stdout.read())
+        p = subprocess.Popen(['unzip', '-p', resource.get_zip_file_name(), 'two.txt'],
+                             stdout=subprocess.PIPE)
+        assert_equals("hello", p.stdout.read())
+
+    def test_builtin_archive_failure(self):
+        """Ensure a partial archive is removed when the resource isn't
+        completed, and isn't seen as cached meanwhile"""
+        req = {'resource_id': '123', 'hello': 'world'}
+        resource = ResourceFile(req, self._root, self._tempdir, 60*60*24,
+                                archive_writer='builtin')
+        resource.get_writer(stream=True).write('hello')
+        assert_equals(1, len(self._store_files()))
+        assert_false(ResourceFile(req, self._root, self._tempdir, 60*60*24).zip_file_exists())
+        resource.clean_work_files()
+        assert_equals([], self._store_files())
+
+    def test_builtin_archive_xlsx(self):
+        """Ensure csv files to be converted to xlsx aren't streamed"""
+        req = {'resource_id': '123', 'format': 'xlsx'}
+        resource = ResourceFile(req, self._root, self._tempdir, 60*60*24,
+                                archive_writer='builtin')
+        resource.get_csv_writer('one.csv', stream=True).writerow(['one'])
+        assert_equals(set(), resource.streamed)
+        resource.clean_work_files()
+
+    def test_deduplicate(self):
+        """Ensure a ZIP file holding the same files as a stored one is linked
+        to it, whichever way they are built"""
+        zip_files = []
+        for i, archive_writer in enumerate(['command', 'builtin', 'builtin']):
+            resource = ResourceFile({'resource_id': str(i)}, self._root, self._tempdir,
+                                    60*60*24, archive_writer=archive_writer,
+                                    deduplicate=True)
+            resource.get_writer('one.csv', stream=True).write('one,two\n')
+            resource.get_writer('two.txt').write('hello')
+            resource.create_zip(self._zip)
+            resource.clean_work_files()
+            assert_equals(i > 0, resource.saved_bytes > 0)
+            zip_files.append(resource.get_zip_file_name())
+        assert_true(os.path.samefile(zip_files[0], zip_files[1]))
+        assert_true(os.path.samefile(zip_files[0], zip_files[2]))
+        total, stored = resource.index.sizes()
+        assert_equals(3 * stored, total)
+        # different content isn't linked
+        resource = ResourceFile({'resource_id': '4'}, self._root, self._tempdir, 60*60*24,
+                                deduplicate=True)
+        resource.get_writer('one.csv').write('one,three\n')
+        resource.create_zip(self._zip)
+        resource.clean_work_files()
+        assert_equals(0, resource.saved_bytes)
+        assert_false(os.path.samefile(zip_files[0], resource.get_zip_file_name()))
+
+    def test_deduplicate_old_blob(self):
+        """Ensure a ZIP file linked to an old blob is recorded as new, rather
+        than with the blob's modification time"""
+        zip_files = []
+        for i in range(2):
+            resource = ResourceFile({'resource_id': str(i)}, self._root, self._tempdir, 60*60,
+                                    deduplicate=True)
+            resource.get_writer('one.csv').write('one,two\n')
+            resource.create_zip(self._zip)
+            resource.clean_work_files()
+            zip_files.append(resource.get_zip_file_name())
+            if i == 0:
+                # the first file and its blob are 3 days old
+                old = time.time() - 3 * 24 * 60 * 60
+                os.utime(zip_files[0], (old, old))
+        assert_true(os.path.samefile(zip_files[0], zip_files[1]))
+        assert_true(ResourceFile({'resource_id': '1'}, self._root, self._tempdir,
+                                 60*60).zip_file_exists())
+        created = dict((entry['file_name'], entry['created']) for entry in resource.index.files())
+        assert_true(created[zip_files[1]] > time.time() - 60)
+
+    def test_build_time(self):
+        """Ensure the build time recorded is counted from start_build"""
+        resource = ResourceFile({'resource_id': '123'}, self._root, self._tempdir, 60)
+        # eg. waiting for the build lock
+        resource._started -= 100
+        resource.start_build()
+        resource.get_writer().write('hello world')
+        resource.create_zip(self._zip)
+        resource.clean_work_files()
+        assert_true(resource.index.files()[0]['build_time'] < 50)
+
+    def test_version(self):
+        """Ensure a cached file is only found for the upstream version it was
+        built from, for as long as the version's maximum age"""
+        req = {'resource_id': '123'}
+        resource = ResourceFile(req, self._root, self._tempdir, 1)
+        resource.set_version('v1', 60*60)
+        resource.get_writer().write('hello world')
+        resource.create_zip(self._zip)
+        resource.clean_work_files()
+        time.sleep(1)
+        assert_false(ResourceFile(req, self._root, self._tempdir, 1).zip_file_exists())
+        resource2 = ResourceFile(req, self._root, self._tempdir, 1)
+        resource2.set_version('v1', 60*60)
+        assert_true(resource2.zip_file_exists())
+        resource3 = ResourceFile(req, self._root, self._tempdir, 1)
+        resource3.set_version('v2', 60*60)
+        assert_false(resource3.zip_file_exists())
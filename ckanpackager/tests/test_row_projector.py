@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""Test the projection of datastore records into CSV rows"""
+import csv
+from cStringIO import StringIO
+
+import unicodecsv
+from nose.tools import assert_equals
+
+from ckanpackager.lib.row_projector import RowProjector
+
+
+class TestRowProjector(object):
+
+    def test_project(self):
+        """Check fields are extracted in order, with missing fields empty"""
+        projector = RowProjector(['b', 'a'])
+        assert_equals([2, 1], projector.project({'a': 1, 'b': 2, 'c': 3}))
+        assert_equals([None, 1], projector.project({'a': 1}))
+        assert_equals(['x'], RowProjector(['a']).project({'a': 'x'}))
+        assert_equals([None], RowProjector(['a']).project({}))
+        assert_equals([], RowProjector([]).project({'a': 1}))
+
+    def test_same_as_unicodecsv(self):
+        """Check the rows written are the same as unicodecsv writes from the records"""
+        fields = ['id', 'name', 'size', 'tags', 'flag', 'big']
+        records = [
+            {'id': 1, 'name': u'Fringillidae é', 'size': 1.5, 'tags': [u'a', u'b'], 'flag': True,
+             'big': 10 ** 20},
+            {'id': 2, 'name': u'quote " and, comma', 'size': None},
+            {'id': 3, 'name': 'bytes', 'size': 0, 'tags': {u'k': u'v'}, 'flag': False, 'big': -1},
+        ]
+        expected = StringIO()
+        w = unicodecsv.writer(expected, encoding='utf-8', quotechar='"', lineterminator="\n")
+        for record in records:
+            w.writerow([record.get(field, None) for field in fields])
+        output = StringIO()
+        w = csv.writer(output, quotechar='"', lineterminator="\n")
+        projector = RowProjector(fields)
+        w.writerows(projector.rows(records[:2]))
+        w.writerows(projector.rows(records[2:]))
+        assert_equals(expected.getvalue(), output.getvalue())
+
+    def test_rows(self):
+        """Check the rows of a page of records are returned as a list"""
+        projector = RowProjector(['a'])
+        assert_equals([[0], [1], [2]], projector.rows({'a': i} for i in range(3)))
+        assert_equals([], projector.rows([]))
@@ -0,0 +1,69 @@
+"""Test the parts of packages fetched in shards"""
+import os
+import shutil
+import tempfile
+import time
+from StringIO import StringIO
+
+from nose.tools import assert_equals, assert_true, assert_false
+
+from ckanpackager.lib.shard_parts import ShardParts, shard_ranges, remove_stale_shards
+
+
+class TestShardParts(object):
+
+    def setUp(self):
+        self._root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._root)
+
+    def test_shard_ranges(self):
+        """Check records are split into shards of about the same size, up to a maximum"""
+        assert_equals([(0, 10)], shard_ranges(0, 10, 10, 4))
+        assert_equals([(5, 4), (9, 4), (13, 3)], shard_ranges(5, 11, 4, 4))
+        assert_equals([(0, 50), (50, 50)], shard_ranges(0, 100, 10, 2))
+
+    def test_parts(self):
+        """Check parts are only visible once committed, and copied in order"""
+        parts = ShardParts(self._root, 'key')
+        second = parts.open(1)
+        second.write('c\n')
+        assert_false(parts.exists(1))
+        parts.commit(1, second, 1)
+        first = parts.open(0)
+        first.write('a\nb\n')
+        parts.commit(0, first, 2)
+        failed = parts.open(2)
+        parts.discard(failed)
+        assert_true(parts.exists(1))
+        assert_false(parts.exists(2))
+        assert_equals(2, parts.count(0))
+        output = StringIO()
+        parts.copy(2, output)
+        assert_equals('a\nb\nc\n', output.getvalue())
+        parts.remove()
+        assert_false(os.path.exists(parts.folder))
+
+    def test_claim(self):
+        """Check the shards can only be claimed once until released or removed"""
+        parts = ShardParts(self._root, 'key')
+        assert_true(parts.claim())
+        assert_false(ShardParts(self._root, 'key').claim())
+        assert_true(ShardParts(self._root, 'other').claim())
+        parts.release()
+        assert_true(parts.claim())
+        parts.remove()
+        assert_true(parts.claim())
+
+    def test_remove_stale_shards(self):
+        """Check only the parts that haven't been written to for a while are removed"""
+        old = ShardParts(self._root, 'old')
+        old.commit(0, old.open(0), 0)
+        recent = ShardParts(self._root, 'recent')
+        recent.commit(0, recent.open(0), 0)
+        for name in [old.folder, old.path(0), old.path(0) + '.count']:
+            os.utime(name, (time.time() - 100, time.time() - 100))
+        assert_equals(1, remove_stale_shards(self._root, time.time() - 50))
+        assert_false(os.path.exists(old.folder))
+        assert_true(recent.exists(0))
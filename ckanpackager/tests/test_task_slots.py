@@ -0,0 +1,38 @@
+"""Test the limits on the number of tasks running at the same time"""
+import shutil
+import tempfile
+
+from nose.tools import assert_true, assert_false
+
+from ckanpackager.lib.task_slots import TaskSlots
+
+
+class TestTaskSlots(object):
+
+    def setUp(self):
+        self._root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._root)
+
+    def test_limits(self):
+        """Check a slot of each limit is needed, and slots are freed when released"""
+        first = TaskSlots(self._root, [('host-a', 1), ('domain-x', 2)])
+        assert_true(first.acquire())
+        # no slot left for host a
+        second = TaskSlots(self._root, [('host-a', 1), ('domain-x', 2)])
+        assert_false(second.acquire())
+        # the slot of domain x it took was released
+        third = TaskSlots(self._root, [('host-b', 1), ('domain-x', 2)])
+        assert_true(third.acquire())
+        assert_false(TaskSlots(self._root, [('host-c', 1), ('domain-x', 2)]).acquire())
+        first.release()
+        assert_true(second.acquire())
+        # limits without a number of slots don't apply
+        assert_true(TaskSlots(self._root, [('host-a', None), ('domain-x', None)]).acquire())
+
+    def test_names(self):
+        """Check names that aren't valid file names can be used"""
+        slots = TaskSlots(self._root, [('domain-../a/b', 1)])
+        assert_true(slots.acquire())
+        assert_false(TaskSlots(self._root, [('domain-../a/b', 1)]).acquire())
@@ -0,0 +1,33 @@
+"""Test the in-memory cache with expiring entries"""
+import time
+
+import mock
+from nose.tools import assert_equals, assert_is_none
+
+from ckanpackager.lib.ttl_cache import TTLCache
+
+
+class TestTTLCache(object):
+
+    def test_expiry(self):
+        """Check values are only returned until they expire"""
+        cache = TTLCache(10)
+        now = time.time()
+        with mock.patch('time.time', return_value=now):
+            cache.set('a', 1)
+            cache.set('b', 2, ttl=20)
+            assert_equals(1, cache.get('a'))
+            assert_is_none(cache.get('c'))
+        with mock.patch('time.time', return_value=now + 15):
+            assert_equals('gone', cache.get('a', 'gone'))
+            assert_equals(2, cache.get('b'))
+
+    def test_max_size(self):
+        """Check the values closest to expiry are dropped when the cache is full"""
+        cache = TTLCache(10, max_size=2)
+        cache.set('a', 1, ttl=5)
+        cache.set('b', 2)
+        cache.set('c', 3)
+        assert_is_none(cache.get('a'))
+        assert_equals(2, cache.get('b'))
+        assert_equals(3, cache.get('c'))
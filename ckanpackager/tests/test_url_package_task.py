@@ -13,7 +13,7 @@ class DummyResource(object):
         self.create_invoked = False
         self.clean_invoked = False
 
-    def get_writer(self):
+    def get_writer(self, stream=False):
         return self.stream
 
     def create_zip(self, command):
@@ -83,3 +83,18 @@ class TestUrlPackageTask(object):
         r = DummyResource()
         self._task.create_zip(r)
         assert_true(r.clean_invoked)
+
+    @httpretty.activate
+    def test_upstream_version(self):
+        """Ensure the upstream version is the ETag, or the Last-Modified date"""
+        httpretty.register_uri(
+            httpretty.HEAD,
+            'http://example.com/the/resource/url.txt',
+            responses=[
+                httpretty.Response('', etag='"abc"', last_modified='Mon, 01 Jun 2020 00:00:00 GMT'),
+                httpretty.Response('', last_modified='Mon, 01 Jun 2020 00:00:00 GMT'),
+            ]
+        )
+        assert_equals('"abc"', self._task.upstream_version())
+        assert_equals('Mon, 01 Jun 2020 00:00:00 GMT', self._task.upstream_version())
+        assert_equals('HEAD', httpretty.last_request().method)
@@ -0,0 +1,52 @@
+"""Test writing rows straight into xlsx workbooks"""
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equals, assert_true
+from openpyxl import load_workbook
+
+from ckanpackager.lib.xlsx_sink import XlsxSink
+
+
+class TestXlsxSink(object):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'resource.xlsx')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _read(self):
+        workbook = load_workbook(self._path)
+        return [(ws.title, [list(row) for row in ws.values]) for ws in workbook.worksheets]
+
+    def test_typed_cells(self):
+        """Check values keep their type, others being written as text"""
+        sink = XlsxSink(self._path)
+        sink.writerow([u'a', u'b', u'c', u'd'])
+        sink.writerows([[1, 2.5, u'caf\xe9', None], [True, [u'x'], 10 ** 12, u'']])
+        sink.close()
+        assert_true(sink.closed)
+        assert_equals([(u'Data', [[u'a', u'b', u'c', u'd'],
+                                  [1, 2.5, u'caf\xe9', None],
+                                  [True, u"[u'x']", 10 ** 12, None]])], self._read())
+
+    def test_rollover(self):
+        """Check rows carry on in new sheets, with the header, once a sheet is full"""
+        sink = XlsxSink(self._path, max_rows=3)
+        sink.writerow([u'id'])
+        sink.writerows([[i] for i in range(5)])
+        sink.close()
+        assert_equals(3, sink.sheets)
+        assert_equals([(u'Data', [[u'id'], [0], [1]]),
+                       (u'Data 2', [[u'id'], [2], [3]]),
+                       (u'Data 3', [[u'id'], [4]])], self._read())
+
+    def test_empty(self):
+        """Check a workbook is saved even when no row was written, and only once"""
+        sink = XlsxSink(self._path)
+        sink.close()
+        sink.close()
+        assert_equals(1, len(self._read()))
@@ -0,0 +1,112 @@
+"""Test the streaming ZIP writer"""
+import os
+import shutil
+import subprocess
+import tempfile
+import zipfile
+
+import mock
+from nose.tools import assert_equals, assert_raises, assert_false
+
+from ckanpackager.lib.zip_stream import ZipStreamWriter, ZipEntryWriter
+
+
+class TestZipStreamWriter(object):
+
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp()
+        self._path = os.path.join(self._tempdir, 'test.zip')
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+    def _write(self, archive):
+        entry = archive.open('rows.csv')
+        for i in range(20000):
+            entry.write('{},some,data\n'.format(i))
+        entry.close()
+        other = os.path.join(self._tempdir, 'other.txt')
+        with open(other, 'w') as f:
+            f.write('hello world')
+        archive.write_file(other)
+        archive.open('empty.txt').close()
+        archive.close()
+
+    def _check(self):
+        with zipfile.ZipFile(self._path) as archive:
+            assert_equals(archive.namelist(), ['rows.csv', 'other.txt', 'empty.txt'])
+            assert_equals(archive.testzip(), None)
+            rows = archive.read('rows.csv').splitlines()
+            assert_equals(len(rows), 20000)
+            assert_equals(rows[1234], '1234,some,data')
+            assert_equals(archive.read('other.txt'), 'hello world')
+            assert_equals(archive.read('empty.txt'), '')
+        assert_equals(subprocess.call(['unzip', '-tqq', self._path]), 0)
+
+    def test_archive(self):
+        """
+        Ensure the archive can be read by zipfile and unzip
+        """
+        self._write(ZipStreamWriter(self._path))
+        self._check()
+
+    def test_zip64(self):
+        """
+        Ensure the ZIP64 records are valid, by making all the values use them
+        """
+        archive = ZipStreamWriter(self._path)
+        archive.ZIP64_LIMIT = 0
+        archive.ZIP64_COUNT_LIMIT = 0
+        self._write(archive)
+        self._check()
+
+    def test_parallel(self):
+        """
+        Ensure entries compressed in blocks by several workers are valid
+        """
+        with mock.patch.object(ZipEntryWriter, 'PARALLEL_BLOCK_SIZE', 1000):
+            archive = ZipStreamWriter(self._path, workers=3)
+            self._write(archive)
+        assert_equals(archive.pool, None)
+        self._check()
+
+    def test_stored(self):
+        """
+        Ensure entries can be stored without compressing them, along with compressed ones
+        """
+        for workers in (1, 3):
+            archive = ZipStreamWriter(self._path, workers=workers)
+            entry = archive.open('rows.csv.gz', compress=False)
+            entry.write('already compressed')
+            entry.close()
+            self._write(archive)
+            self._check_stored()
+
+    def _check_stored(self):
+        with zipfile.ZipFile(self._path) as archive:
+            info = archive.getinfo('rows.csv.gz')
+            assert_equals(info.compress_type, zipfile.ZIP_STORED)
+            assert_equals(info.compress_size, len('already compressed'))
+            assert_equals(archive.read('rows.csv.gz'), 'already compressed')
+            assert_equals(archive.getinfo('rows.csv').compress_type, zipfile.ZIP_DEFLATED)
+            assert_equals(archive.testzip(), None)
+        assert_equals(subprocess.call(['unzip', '-tqq', self._path]), 0)
+
+    def test_one_entry_at_a_time(self):
+        """
+        Ensure an entry can't be started while another is being written
+        """
+        archive = ZipStreamWriter(self._path)
+        archive.open('one.txt')
+        with assert_raises(ValueError):
+            archive.open('two.txt')
+        archive.close()
+
+    def test_abort(self):
+        """
+        Ensure aborting removes the archive
+        """
+        archive = ZipStreamWriter(self._path)
+        archive.open('one.txt').write('data')
+        archive.abort()
+        assert_false(os.path.exists(self._path))
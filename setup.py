@@ -9,6 +9,12 @@ setup(
     description='Service to package CKAN data into ZIP files and email the link to the file to users',
     url='http://github.com/NaturalHistoryMuseum/ckanpackager',
     packages=find_packages(exclude='tests'),
+    extras_require={
+        # parquet packages, zstd compressed jsonl packages and brotli compressed responses
+        'parquet': ['pyarrow==0.16.0'],
+        'zstd': ['zstandard==0.14.1'],
+        'brotli': ['Brotli==1.0.9'],
+    },
     entry_points={
         'console_scripts': [
             'ckanpackager = ckanpackager.cli:run',